@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Send work to Carto with several requests in flight at once.
+
+When Carto requests are sent one at a time, the time to send many batches is
+the sum of the round trips.  On a high latency link most of that time is
+spent waiting.  This engine keeps up to N requests in flight, so the time is
+limited by the bandwidth of the link (or the server) instead.
+
+The engine is built on asyncio, but the requests are still made with the
+(blocking) carto clients and their pooled, compressing, retrying sessions
+(see `carto_transport.py`), each in its own worker thread.  An asyncio event
+loop schedules the work:
+
+* Items (e.g. batches of rows) are read one at a time from an iterable in a
+  reader thread, and only when a client is free to send it, so at most N + 1
+  items are in memory (backpressure).
+* Each item is sent with a free client in a sender thread.
+* Each item that was sent is acknowledged (e.g. tracked in SQL Server) in a
+  single writer thread, so the acknowledgements never run at the same time.
+  Items that failed are never acknowledged.
+* After the first error, no new items are read; the items in flight are
+  finished (and acknowledged if they succeed).  Ctrl+C is handled the same
+  way, and then raised again.
+
+Requires Python 3.5 or later; `upload.py` does not import it on Python 2.
+
+No third party requirements.
+"""
+
+import asyncio
+import concurrent.futures
+
+
+def send_all(items, send, acknowledge, clients):
+    """
+    Send each item in items with up to len(clients) requests in flight.
+
+    items is an iterable; reading it may block (e.g. on a database).
+    send(client, item) sends an item with a client that no other thread is
+    using, and returns a result.  acknowledge(item, result) is called for each
+    item that was sent; only one acknowledge is running at a time.
+    Return a list of the exceptions raised by items, send, and acknowledge;
+    the list is empty if everything was sent and acknowledged.
+    """
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(send_all_async(loop, items, send, acknowledge, clients))
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        # Let the requests in flight finish and be acknowledged.
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        raise
+    finally:
+        loop.close()
+
+
+async def send_all_async(loop, items, send, acknowledge, clients):
+    """The coroutine for send_all(), run in the event loop."""
+
+    reader = concurrent.futures.ThreadPoolExecutor(1)
+    senders = concurrent.futures.ThreadPoolExecutor(len(clients))
+    writer = concurrent.futures.ThreadPoolExecutor(1)
+    idle = asyncio.Queue()
+    for client in clients:
+        idle.put_nowait(client)
+    iterator = iter(items)
+    done = object()
+    errors = []
+    in_flight = set()
+
+    async def send_one(client, item):
+        """Send and acknowledge item with client, then free the client."""
+        try:
+            result = await loop.run_in_executor(senders, send, client, item)
+            await loop.run_in_executor(writer, acknowledge, item, result)
+        # pylint: disable=broad-except
+        # The errors are returned to the caller.
+        except Exception as ex:
+            errors.append(ex)
+        finally:
+            idle.put_nowait(client)
+
+    try:
+        while not errors:
+            try:
+                item = await loop.run_in_executor(reader, next, iterator, done)
+            # pylint: disable=broad-except
+            except Exception as ex:
+                errors.append(ex)
+                break
+            if item is done:
+                break
+            client = await idle.get()
+            if errors:
+                break
+            task = loop.create_task(send_one(client, item))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+    finally:
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+        for executor in (reader, senders, writer):
+            executor.shutdown(wait=True)
+        if hasattr(items, "close"):
+            items.close()
+    return errors
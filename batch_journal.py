@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+A local write-ahead journal of the batches `upload.py` sends to Carto.
+
+A batch is written to Carto and then recorded in a tracking table in SQL
+Server.  If the process dies (or the tracking write fails) between the two,
+the rows are in Carto but not tracked, and the next run would send them again.
+
+To prevent this, the keys of each batch are saved in the journal before the
+batch is sent.  The batch is marked as acknowledged when Carto accepts it,
+and removed from the journal when it has been tracked.  Any batch left in the
+journal at the start of a run was interrupted; `upload.py` checks which of its
+keys are in Carto, tracks those, and drops the batch.  The rest are untracked,
+so they are sent again in the normal way.
+
+The journal also keeps the (project, animal, day) of each day with movements
+added to or removed from Carto, until `upload.py` has rebuilt the animal's
+track for that day.  The days of a batch are saved in the same commit that
+removes the batch, so a day is never forgotten.  No days are saved when the
+tracks are not kept up to date, and the days left from when they were are
+forgotten (see `forget_days()`), so the journal does not grow.
+
+The journal is a SQLite database (in the Python standard library), which
+commits each change to disk before returning.
+
+No third party requirements.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class Config(object):
+    """Namespace for configuration parameters. Edit as necessary."""
+
+    # pylint: disable=useless-object-inheritance,too-few-public-methods
+
+    # The journal file; next to this script by default.
+    path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "upload_journal.sqlite3"
+    )
+
+    # Seconds to wait for another worker thread to finish writing.
+    timeout = 30.0
+
+
+# Batch status values
+PENDING = "pending"  # saved, but not yet accepted by Carto
+ACKNOWLEDGED = "acknowledged"  # accepted by Carto, but not yet tracked
+
+ADD_DAY = "insert or ignore into days (projectid, animalid, day) values (?, ?, ?)"
+
+
+def key_text(value):
+    """Return value as JSON serializable text (dates) or a number."""
+
+    if isinstance(value, (int, float)):
+        return value
+    return "{0}".format(value)
+
+
+class BatchJournal(object):
+    """
+    A journal of the batches sent to Carto that have not been tracked yet.
+
+    Each project worker thread opens its own journal on the same file.  A
+    journal may be shared by the threads that send and track the batches of
+    one worker (see `async_engine.py`); its methods take turns.
+    """
+
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path or Config.path, timeout=Config.timeout, check_same_thread=False
+        )
+        self.connection.execute(
+            """
+            create table if not exists batches (
+              id integer primary key,
+              kind text not null,
+              status text not null,
+              keys text not null,
+              saved real not null)
+        """
+        )
+        self.connection.execute(
+            """
+            create table if not exists days (
+              projectid text not null,
+              animalid text not null,
+              day text not null,
+              primary key (projectid, animalid, day))
+        """
+        )
+        self.connection.commit()
+
+    def begin(self, kind, keys):
+        """Save a pending batch of keys (lists) for kind, and return its id."""
+
+        keys = [[key_text(value) for value in key] for key in keys]
+        with self.lock:
+            cursor = self.connection.execute(
+                "insert into batches (kind, status, keys, saved) values (?, ?, ?, ?)",
+                (kind, PENDING, json.dumps(keys), time.time()),
+            )
+            self.connection.commit()
+            return cursor.lastrowid
+
+    def acknowledge(self, batch_id):
+        """Mark the batch as accepted by Carto."""
+
+        with self.lock:
+            self.connection.execute(
+                "update batches set status = ? where id = ?", (ACKNOWLEDGED, batch_id)
+            )
+            self.connection.commit()
+
+    def finish(self, batch_id, days=()):
+        """
+        Remove the batch; it is in Carto and tracked.
+
+        The (projectid, animalid, day) tuples in days are saved (see add_days()).
+        """
+        with self.lock:
+            self.connection.execute("delete from batches where id = ?", (batch_id,))
+            self.connection.executemany(ADD_DAY, days)
+            self.connection.commit()
+
+    def add_days(self, days):
+        """Save the (projectid, animalid, day) tuples of days that have changed."""
+
+        with self.lock:
+            self.connection.executemany(ADD_DAY, days)
+            self.connection.commit()
+
+    def changed_days(self):
+        """Return a sorted list of the saved (projectid, animalid, day) tuples."""
+
+        with self.lock:
+            rows = self.connection.execute(
+                "select projectid, animalid, day from days order by 1, 2, 3"
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def clear_days(self, days):
+        """Forget the (projectid, animalid, day) tuples in days; they are done."""
+
+        with self.lock:
+            self.connection.executemany(
+                "delete from days where projectid = ? and animalid = ? and day = ?",
+                days,
+            )
+            self.connection.commit()
+
+    def forget_days(self):
+        """Forget all the saved days; the tracks are no longer kept up to date."""
+
+        with self.lock:
+            self.connection.execute("delete from days")
+            self.connection.commit()
+
+    def unfinished(self):
+        """Return a list of (id, kind, status, keys) for the batches in the journal."""
+
+        with self.lock:
+            rows = self.connection.execute(
+                "select id, kind, status, keys from batches order by id"
+            ).fetchall()
+        return [
+            (batch_id, kind, status, [tuple(key) for key in json.loads(keys)])
+            for batch_id, kind, status, keys in rows
+        ]
+
+    def close(self):
+        """Close the journal file."""
+
+        with self.lock:
+            self.connection.close()
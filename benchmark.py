@@ -0,0 +1,694 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the slow parts of `upload.py`.
+
+These benchmarks never touch the production servers.  They run against a
+local stand-in for the Animal Movement SQL Server; SQL Server Express LocalDB
+(installed with SQL Server Express or Visual Studio) works well.  The stand-in
+database is created if it does not exist, and the tables in it are dropped
+and recreated by the benchmarks, so do not point this at a real database.
+
+The sync benchmarks run `upload.main()` end to end.  The stand-in database is
+seeded with synthetic collar data (Locations, Movements, and a project
+boundary), and Carto is replaced by a local fake of the Carto SQL API
+(`fake_carto.py`, run in a separate process), so nothing is sent to a real
+Carto server.  Three scenarios are timed: the initial load of all the data,
+a steady state sync of a day of new fixes, and a mass removal after the
+project boundary shrinks.  For each, the rows per second, the number of
+requests and bytes sent to Carto, and the peak (Python) memory are reported.
+
+The geometry encoding benchmark compares the "text" and "ewkb" values of
+`upload.Config.geometry_encoding`: the time to read and format the synthetic
+rows, and the size of the payload (raw and gzipped) for COPY and INSERT.  If
+a local PostGIS database is configured (`Config.postgis`), the time for the
+server to insert each payload is reported too.
+
+Results are printed as rows per second.  Run the benchmark(s) of interest at
+the bottom of this file.
+
+Third party requirements:
+* pyodbc - https://pypi.python.org/pypi/pyodbc - for SQL Server
+* carto - https://pypi.python.org/pypi/carto  (imported by upload.py)
+* requests - https://pypi.python.org/pypi/requests (installed with carto)
+* psycopg2 - https://pypi.org/project/psycopg2/ - optional, for PostGIS
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import io
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import requests
+
+import batch_journal
+import upload
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2; peak memory is not reported
+    tracemalloc = None
+
+try:
+    import psycopg2
+except ImportError:
+    # PostGIS insert times are not reported
+    psycopg2 = None
+
+# Python 2/3 compatible xrange() cabability
+# pylint: disable=undefined-variable,redefined-builtin
+if sys.version_info[0] < 3:
+    range = xrange
+
+
+class Config(object):
+    """Namespace for configuration parameters. Edit as necessary."""
+
+    # pylint: disable=useless-object-inheritance,too-few-public-methods
+
+    # Local stand-in for the Animal Movement database
+    server = r"(localdb)\MSSQLLocalDB"
+    database = "am2cartodb_benchmark"
+
+    # Number of rows to write in the tracking table benchmarks
+    tracking_rows = 100000
+
+    # Synthetic collar data for the sync benchmarks: each animal in the
+    # project has a fix every fix_hours hours.  The initial load has
+    # fixes_per_animal fixes per animal, and the steady state sync adds
+    # new_fixes_per_animal more.
+    project = "BENCH_Project"
+    animals = 20
+    fixes_per_animal = 5000
+    new_fixes_per_animal = 6
+    fix_hours = 4
+    seed = 2015
+
+    # Seconds the fake Carto server adds to each request, to mimic the network
+    # and server time of the real Carto server.
+    carto_latency = 0.05
+
+    # Measure the peak memory with tracemalloc (Python 3.4+).  This slows
+    # down the Python code, so set to False to compare rates.
+    trace_memory = True
+
+    # A local PostGIS database for timing the server side of each geometry
+    # encoding, as a libpq connection string, e.g. "dbname=bench user=postgres".
+    # Only temporary tables are used.  None to only compare payload sizes.
+    postgis = None
+
+
+def get_benchmark_connection():
+    """Return a connection to the stand-in database; create it if needed."""
+
+    master = upload.get_connection_or_die(Config.server, "master")
+    master.autocommit = True
+    sql = "if db_id('{0}') is null create database [{0}]"
+    master.cursor().execute(sql.format(Config.database))
+    master.close()
+    return upload.get_connection_or_die(Config.server, Config.database)
+
+
+def reset_tracking_tables(connection):
+    """Drop and recreate the tracking tables on the stand-in connection."""
+
+    cursor = connection.cursor()
+    cursor.execute(
+        "if object_id('Locations_In_CartoDB') is not null drop table Locations_In_CartoDB"
+    )
+    cursor.execute(
+        "if object_id('Movements_In_CartoDB') is not null drop table Movements_In_CartoDB"
+    )
+    cursor.commit()
+    # With their RowHash columns, so Config.update_changed_rows can be timed
+    upload.make_cartodb_tracking_tables(connection)
+
+
+def synthetic_fids(count):
+    """Return a list of count location fixids."""
+
+    return list(range(1, count + 1))
+
+
+def synthetic_movement_keys(count):
+    """Return a list of count movement keys (project, animal, start, end)."""
+
+    start = datetime.datetime(2015, 5, 1)
+    step = datetime.timedelta(hours=1)
+    keys = []
+    for i in range(count):
+        animal = "{0:03d}".format(i % 100)
+        begin = start + step * (i // 100)
+        keys.append(("BENCH_Project", animal, begin, begin + step))
+    return keys
+
+
+def literal_insert_locations(connection, fids):
+    """The original location tracking insert; literal values in 900 row chunks."""
+
+    w_cursor = connection.cursor()
+    sql = "INSERT Locations_In_CartoDB (fixid) values "
+    for chunk in upload.chunks(fids, 900):
+        values = ",".join(["({0})".format(fid) for fid in chunk])
+        w_cursor.execute(sql + values)
+    w_cursor.commit()
+
+
+def literal_insert_movements(connection, rows):
+    """The original movement tracking insert; literal values in 900 row chunks."""
+
+    w_cursor = connection.cursor()
+    sql = """
+        insert into Movements_In_CartoDB
+        (projectid, animalid, startdate, enddate) values
+    """
+    for chunk in upload.chunks(rows, 900):
+        values = ",".join(["('{0}','{1}','{2}','{3}')".format(*row) for row in chunk])
+        w_cursor.execute(sql + " " + values)
+    w_cursor.commit()
+
+
+def literal_delete_movements(connection, rows):
+    """The original movement tracking delete; one statement per row."""
+
+    w_cursor = connection.cursor()
+    sql = """
+        delete from Movements_In_CartoDB where
+        projectid = '{0}' and animalid = '{1}'
+        and startdate = '{2}' and enddate = '{3}'
+    """
+    for row in rows:
+        w_cursor.execute(sql.format(*row))
+    w_cursor.commit()
+
+
+def report(label, count, func, *args):
+    """Run func(*args), and print the rate for count rows with label."""
+
+    start = time.time()
+    func(*args)
+    seconds = time.time() - start
+    print(
+        "{0:<40} {1:>8} rows {2:>8.2f} sec {3:>10.0f} rows/sec".format(
+            label, count, seconds, count / max(seconds, 0.001)
+        )
+    )
+
+
+# Boundaries for the synthetic project; the shrunken boundary excludes the
+# eastern half of the original.  (Counter-clockwise rings, as required for
+# the geography type.)
+BOUNDARY = "POLYGON ((-155 58, -154 58, -154 59, -155 59, -155 58))"
+SHRUNKEN_BOUNDARY = "POLYGON ((-155 58, -154.5 58, -154.5 59, -155 59, -155 58))"
+
+
+def make_source_tables(connection):
+    """
+    Drop and recreate the Animal Movement and tracking tables on the stand-in.
+
+    Only the columns used by upload.py are created.
+    """
+    sql = """
+        if object_id('{0}') is not null drop table {0}
+    """
+    tables = [
+        "Locations",
+        "Movements",
+        "ProjectExportBoundaries",
+        "Locations_In_CartoDB",
+        "Movements_In_CartoDB",
+        "CartoDB_Sync_State",
+        "CartoDB_Boundary_State",
+    ]
+    cursor = connection.cursor()
+    for table in tables:
+        cursor.execute(sql.format(table))
+    cursor.execute(
+        """
+        create table Locations (
+          ProjectId varchar(16) NOT NULL,
+          AnimalId varchar(16) NOT NULL,
+          FixDate datetime2(7) NOT NULL,
+          FixId int NOT NULL PRIMARY KEY,
+          Location geography NULL,
+          Status char(1) NULL)
+    """
+    )
+    cursor.execute(
+        """
+        create table Movements (
+          ProjectId varchar(16) NOT NULL,
+          AnimalId varchar(16) NOT NULL,
+          StartDate datetime2(7) NOT NULL,
+          EndDate datetime2(7) NOT NULL,
+          Duration float NOT NULL,
+          Distance float NOT NULL,
+          Speed float NOT NULL,
+          Shape geography NULL
+          CONSTRAINT PK_Movements PRIMARY KEY CLUSTERED (
+            ProjectId ASC, AnimalId ASC, StartDate ASC, EndDate ASC))
+    """
+    )
+    cursor.execute(
+        """
+        create table ProjectExportBoundaries (
+          Project varchar(16) NOT NULL PRIMARY KEY,
+          Shape geography NULL)
+    """
+    )
+    cursor.commit()
+    # With their RowHash columns, so Config.update_changed_rows can be timed
+    upload.make_cartodb_tracking_tables(connection)
+
+
+def kilometers(lat1, lon1, lat2, lon2):
+    """Return the great circle distance in km between two points (degrees)."""
+
+    lat1, lon1, lat2, lon2 = [math.radians(x) for x in (lat1, lon1, lat2, lon2)]
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
+
+
+def synthetic_track(animal, count):
+    """
+    Return a list of count (fixdate, lat, lon) fixes for the animal number.
+
+    The track is a random walk that starts near the middle of the boundary and
+    wanders in and out of it.  The same animal always has the same track, so
+    a longer track starts with the fixes of a shorter one.
+    """
+    rand = random.Random(Config.seed * 1000 + animal)
+    start = datetime.datetime(2015, 5, 1)
+    step = datetime.timedelta(hours=Config.fix_hours)
+    lat = 58.5 + rand.uniform(-0.3, 0.3)
+    lon = -154.5 + rand.uniform(-0.3, 0.3)
+    track = []
+    for i in range(count):
+        track.append((start + step * i, lat, lon))
+        # Drift back toward the middle so the animal does not wander off
+        lat += rand.gauss(0, 0.01) + (58.5 - lat) * 0.01
+        lon += rand.gauss(0, 0.02) + (-154.5 - lon) * 0.01
+    return track
+
+
+def synthetic_collar_data(first, count):
+    """
+    Return lists of location and movement rows for the synthetic animals.
+
+    The rows are for fixes first to first + count - 1 of each animal's track
+    (and the movements that end at those fixes).  The location rows are
+    (projectid, animalid, fixdate, fixid, lat, lon), and the movement rows are
+    (projectid, animalid, startdate, enddate, duration, distance, speed, wkt).
+    """
+    locations = []
+    movements = []
+    for animal in range(Config.animals):
+        animal_id = "{0:03d}".format(animal)
+        track = synthetic_track(animal, first + count)
+        for i in range(first, first + count):
+            fixdate, lat, lon = track[i]
+            fixid = animal * 1000000 + i + 1
+            locations.append((Config.project, animal_id, fixdate, fixid, lat, lon))
+            if i == 0:
+                continue
+            startdate, lat0, lon0 = track[i - 1]
+            distance = kilometers(lat0, lon0, lat, lon)
+            wkt = "LINESTRING ({0!r} {1!r}, {2!r} {3!r})".format(lon0, lat0, lon, lat)
+            movements.append(
+                (
+                    Config.project,
+                    animal_id,
+                    startdate,
+                    fixdate,
+                    Config.fix_hours,
+                    distance,
+                    distance / Config.fix_hours,
+                    wkt,
+                )
+            )
+    return locations, movements
+
+
+def seed_collar_data(connection, first, count):
+    """Add fixes first to first + count - 1 of each animal to the stand-in."""
+
+    locations, movements = synthetic_collar_data(first, count)
+    cursor = connection.cursor()
+    sql = """
+        insert into Locations (ProjectId, AnimalId, FixDate, FixId, Location)
+        values (?, ?, ?, ?, geography::Point(?, ?, 4326))
+    """
+    upload.execute_many(cursor, sql, locations)
+    sql = """
+        insert into Movements
+        (ProjectId, AnimalId, StartDate, EndDate, Duration, Distance, Speed, Shape)
+        values (?, ?, ?, ?, ?, ?, ?, geography::STLineFromText(?, 4326))
+    """
+    upload.execute_many(cursor, sql, movements)
+    cursor.commit()
+    return len(locations), len(movements)
+
+
+def set_boundary(connection, wkt):
+    """Set the boundary of the synthetic project to the polygon wkt."""
+
+    cursor = connection.cursor()
+    cursor.execute(
+        "delete from ProjectExportBoundaries where Project = ?", Config.project
+    )
+    cursor.execute(
+        """
+        insert into ProjectExportBoundaries (Project, Shape)
+        values (?, geography::STGeomFromText(?, 4326))
+    """,
+        Config.project,
+        wkt,
+    )
+    cursor.commit()
+
+
+def start_fake_carto():
+    """Start the fake Carto server in a new process; return (process, url)."""
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_carto.py")
+    process = subprocess.Popen(
+        [sys.executable, script, "--latency", str(Config.carto_latency)],
+        stdout=subprocess.PIPE,
+    )
+    port = int(process.stdout.readline())
+    return process, "http://127.0.0.1:{0}/".format(port)
+
+
+def carto_stats(url):
+    """Return the statistics dictionary from the fake Carto server at url."""
+
+    return requests.get(url + "stats").json()
+
+
+def run_sync_scenario(label, url):
+    """
+    Run upload.main() and return a dictionary of results for the label.
+
+    The results are the seconds, the rows written to and removed from Carto,
+    the requests and bytes sent to Carto, and the peak memory in bytes (None
+    if it is not measured).
+    """
+    before = carto_stats(url)
+    trace = Config.trace_memory and tracemalloc is not None
+    if trace:
+        tracemalloc.start()
+    start = time.time()
+    upload.main()
+    seconds = time.time() - start
+    peak = None
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    after = carto_stats(url)
+    delta = dict((key, after.get(key, 0) - before.get(key, 0)) for key in after)
+    return {
+        "label": label,
+        "seconds": seconds,
+        "rows": delta["rows_inserted"] + delta["rows_deleted"],
+        "requests": delta["requests"],
+        "bytes": delta["bytes_received"],
+        "peak": peak,
+    }
+
+
+def report_sync_scenarios(results):
+    """Print a table of the sync scenario results."""
+
+    print(
+        "{0:<16} {1:>9} {2:>8} {3:>10} {4:>8} {5:>10} {6:>9}".format(
+            "Scenario", "Rows", "Seconds", "Rows/sec", "Requests", "MB sent", "Peak MB"
+        )
+    )
+    for result in results:
+        peak = result["peak"]
+        print(
+            "{0:<16} {1:>9} {2:>8.2f} {3:>10.0f} {4:>8} {5:>10.2f} {6:>9}".format(
+                result["label"],
+                result["rows"],
+                result["seconds"],
+                result["rows"] / max(result["seconds"], 0.001),
+                result["requests"],
+                result["bytes"] / 1e6,
+                "-" if peak is None else "{0:.1f}".format(peak / 1e6),
+            )
+        )
+
+
+def benchmark_tracking_writes(count=None, include_literal=True):
+    """
+    Time writing count rows to (and removing them from) the tracking tables.
+
+    The current parameterized writers in upload.py are compared to the
+    original literal SQL writers if include_literal is True.  The original
+    movement delete (one statement per row) is very slow; it is run on at
+    most 10,000 rows.
+    """
+    count = count or Config.tracking_rows
+    connection = get_benchmark_connection()
+    fids = synthetic_fids(count)
+    keys = synthetic_movement_keys(count)
+
+    if include_literal:
+        reset_tracking_tables(connection)
+        report(
+            "literal insert locations",
+            count,
+            literal_insert_locations,
+            connection,
+            fids,
+        )
+        report(
+            "literal insert movements",
+            count,
+            literal_insert_movements,
+            connection,
+            keys,
+        )
+        few = keys[:10000]
+        report(
+            "literal delete movements",
+            len(few),
+            literal_delete_movements,
+            connection,
+            few,
+        )
+
+    reset_tracking_tables(connection)
+    report(
+        "add_locations_to_carto_tracking_table",
+        count,
+        upload.add_locations_to_carto_tracking_table,
+        connection,
+        fids,
+    )
+    report(
+        "add_movements_to_carto_tracking_table",
+        count,
+        upload.add_movements_to_carto_tracking_table,
+        connection,
+        keys,
+    )
+    report(
+        "remove_locations_from_carto_tracking_table",
+        count,
+        upload.remove_locations_from_carto_tracking_table,
+        connection,
+        fids,
+    )
+    report(
+        "remove_movements_from_carto_tracking_table",
+        count,
+        upload.remove_movements_from_carto_tracking_table,
+        connection,
+        keys,
+    )
+    connection.close()
+
+
+def benchmark_sync():
+    """
+    Time upload.main() for the initial load, steady state, and mass removal.
+
+    The stand-in database is reseeded with synthetic collar data, and
+    upload.py is pointed at the stand-in and at a fake Carto server.
+    """
+    connection = get_benchmark_connection()
+    upload.Config.am_server = Config.server
+    upload.Config.am_database = Config.database
+    upload.Config.projects = [Config.project]
+    journal = os.path.join(tempfile.gettempdir(), "am2cartodb_benchmark.sqlite3")
+    if os.path.exists(journal):
+        os.remove(journal)
+    batch_journal.Config.path = journal
+    # Keep the metrics and the key cache of the benchmark runs out of those of
+    # the real uploads
+    temp = tempfile.gettempdir()
+    upload.Config.metrics_log = os.path.join(temp, "am2cartodb_benchmark.jsonl")
+    upload.Config.metrics_textfile = os.path.join(temp, "am2cartodb_benchmark.prom")
+    keys = os.path.join(temp, "am2cartodb_benchmark_keys")
+    if os.path.isdir(keys):
+        shutil.rmtree(keys)
+    if upload.key_cache is not None:
+        upload.key_cache.Config.path = keys
+        upload.KEYS = upload.key_cache.KeyCache(keys)
+
+    make_source_tables(connection)
+    set_boundary(connection, BOUNDARY)
+    seed_collar_data(connection, 0, Config.fixes_per_animal)
+    upload.enable_change_tracking(connection)
+
+    process, url = start_fake_carto()
+    upload.Config.base_url = url + "user/benchmark/"
+    results = []
+    try:
+        results.append(run_sync_scenario("initial load", url))
+        seed_collar_data(
+            connection, Config.fixes_per_animal, Config.new_fixes_per_animal
+        )
+        results.append(run_sync_scenario("steady state", url))
+        set_boundary(connection, SHRUNKEN_BOUNDARY)
+        results.append(run_sync_scenario("mass removal", url))
+    finally:
+        process.terminate()
+        connection.close()
+    report_sync_scenarios(results)
+
+
+# Temporary PostGIS tables like the Carto tables, for the encoding benchmark
+POSTGIS_TABLES = {
+    "locations": """
+        create temporary table animal_locations
+        (projectid text, animalid text, fixid int, fixdate timestamp,
+        the_geom geometry(Point, 4326))
+    """,
+    "movements": """
+        create temporary table animal_movements
+        (projectid text, animalid text, startdate timestamp, enddate timestamp,
+        duration real, distance real, speed real,
+        duration_t text, distance_t text, speed_t text,
+        the_geom geometry(LineString, 4326))
+    """,
+}
+
+
+def read_payloads(project, encoding):
+    """
+    Return {(kind name, mode): texts} for the new rows of project.
+
+    The rows are read from the stand-in and formatted by upload.py with the
+    geometry encoding.  The seconds taken are printed.
+    """
+    upload.Config.geometry_encoding = encoding
+    connection = upload.get_connection_or_die(Config.server, Config.database)
+    payloads = {}
+    start = time.time()
+    for kind, batches in [
+        (upload.LOCATIONS, upload.get_locations_for_carto(connection, project)),
+        (upload.MOVEMENTS, upload.get_vectors_for_carto(connection, project)),
+    ]:
+        rows = [row for batch in batches for row in batch]
+        for mode in ["copy", "insert"]:
+            payloads[(kind["name"], mode)] = upload.serialize(rows, kind, mode)
+    connection.close()
+    print(
+        "Read and formatted {0} rows for {1} in {2:.2f} sec".format(
+            len(payloads[("locations", "copy")]) + len(payloads[("movements", "copy")]),
+            encoding,
+            time.time() - start,
+        )
+    )
+    return payloads
+
+
+def postgis_insert_seconds(name, mode, texts):
+    """Return the seconds for the PostGIS server to insert the texts of kind name."""
+
+    kind = upload.LOCATIONS if name == "locations" else upload.MOVEMENTS
+    columns = ",".join(kind["columns"])
+    connection = psycopg2.connect(Config.postgis)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(POSTGIS_TABLES[name])
+        start = time.time()
+        if mode == "copy":
+            sql = "COPY {0} ({1}) FROM stdin WITH (FORMAT csv)"
+            cursor.copy_expert(
+                sql.format(kind["table"], columns), io.StringIO("".join(texts))
+            )
+        else:
+            sql = "insert into {0} ({1}) values ".format(kind["table"], columns)
+            for chunk in upload.chunks(texts, 1000):
+                cursor.execute(sql + ",".join(chunk))
+        connection.commit()
+        return time.time() - start
+    finally:
+        connection.close()
+
+
+def benchmark_geometry_encoding():
+    """
+    Compare the text and EWKB geometry encodings of the synthetic collar data.
+
+    For each kind, ingest mode, and encoding, print the payload size (raw and
+    gzipped) and, if Config.postgis is set, the seconds for PostGIS to insert
+    it.
+    """
+    connection = get_benchmark_connection()
+    make_source_tables(connection)
+    set_boundary(connection, BOUNDARY)
+    seed_collar_data(connection, 0, Config.fixes_per_animal)
+    connection.close()
+    upload.Config.am_server = Config.server
+    upload.Config.am_database = Config.database
+    encodings = ["text", "ewkb"]
+    payloads = dict(
+        (encoding, read_payloads(Config.project, encoding)) for encoding in encodings
+    )
+    upload.Config.geometry_encoding = "text"
+    timed = Config.postgis is not None and psycopg2 is not None
+    print(
+        "{0:<10} {1:<7} {2:<5} {3:>8} {4:>10} {5:>8} {6:>12}".format(
+            "Kind", "Mode", "Geom", "Rows", "MB", "MB gzip", "PostGIS sec"
+        )
+    )
+    for name, mode in sorted(payloads["text"]):
+        for encoding in encodings:
+            texts = payloads[encoding][(name, mode)]
+            data = "".join(texts).encode("utf-8")
+            seconds = "-"
+            if timed:
+                seconds = "{0:.2f}".format(postgis_insert_seconds(name, mode, texts))
+            print(
+                "{0:<10} {1:<7} {2:<5} {3:>8} {4:>10.2f} {5:>8.2f} {6:>12}".format(
+                    name,
+                    mode,
+                    encoding,
+                    len(texts),
+                    len(data) / 1e6,
+                    len(zlib.compress(data)) / 1e6,
+                    seconds,
+                )
+            )
+
+
+if __name__ == "__main__":
+    benchmark_tracking_writes()
+    benchmark_sync()
+    benchmark_geometry_encoding()
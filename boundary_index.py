@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+Client side testing of locations and movements against a project boundary.
+
+The SQL used by `upload.py` tests every candidate location and movement with
+`ProjectExportBoundaries.Shape.STContains()` on the (shared) Animal Movement
+SQL Server.  When `upload.Config.boundary_engine` is "python", the boundary
+is instead read once per project and the tests are done here, with NumPy,
+on batches of coordinates.
+
+A BoundaryIndex is built from the well known text (WKT) of a polygon or
+multipolygon (with or without holes).  The bounding box of the boundary is
+divided into a grid of cells.  Cells that do not touch an edge of the
+boundary are completely inside or outside, and a point in one of those cells
+is decided with a table look up.  For a point in a cell that touches the
+boundary, the segment from the point to a reference point (with a known
+state) in the same cell is tested against just the edges in that cell; an
+odd number of crossings flips the state of the reference point.
+
+The edge cases follow `STContains()`: a point on the boundary (an edge or a
+vertex) is not contained.  A movement is contained if none of its vertices
+are outside, none of its segments cross an edge of the boundary, and each
+segment with both ends on the boundary has its middle inside (so a movement
+may end on the boundary, but not run along it or outside it).
+
+Differences with SQL Server: The boundary edges are treated as straight lines
+in longitude/latitude, while SQL Server geography edges are great elliptic
+arcs.  For the short edges of a park boundary this is less than a meter, so
+only a fix within a meter or so of the boundary may be decided differently.
+Edges along a meridian (or the equator) are the same in both.  A segment
+that passes exactly through a vertex of the boundary is not seen to cross it.
+
+The tests (with the `STContains()` results for known cases) are in
+`test_boundary_index.py`.
+
+Third party requirements:
+* numpy - https://pypi.org/project/numpy/
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+import struct
+import sys
+
+import numpy as np
+
+# Python 2/3 compatible xrange() cabability
+# pylint: disable=undefined-variable,redefined-builtin
+if sys.version_info[0] < 3:
+    range = xrange
+
+
+def parse_wkt_rings(wkt):
+    """
+    Return a list of (n, 2) coordinate arrays for each ring or line in wkt.
+
+    Works for POINT, LINESTRING, POLYGON and MULTI* text; Only the first two
+    ordinates (x=longitude, y=latitude) of each vertex are used.
+    """
+    rings = []
+    for group in re.findall(r"\(([^()]+)\)", wkt):
+        vertices = [vertex.split()[:2] for vertex in group.split(",")]
+        rings.append(np.array(vertices, dtype=float))
+    return rings
+
+
+def parse_wkb_line(wkb):
+    """
+    Return the (n, 2) coordinate array of the line in wkb (bytes).
+
+    wkb is a 2D LINESTRING in the OGC well known binary format, as returned by
+    STAsBinary() (x=longitude, y=latitude).
+    """
+    wkb = bytes(wkb)
+    order = "<" if wkb[0:1] == b"\x01" else ">"
+    geometry_type, count = struct.unpack(order + "II", wkb[1:9])
+    if geometry_type != 2:
+        raise ValueError("Not a 2D WKB LINESTRING (type {0})".format(geometry_type))
+    vertices = np.frombuffer(wkb, dtype=order + "f8", count=2 * count, offset=9)
+    return vertices.reshape(count, 2)
+
+
+def ring_edges(rings):
+    """Return the edges (x1, y1, x2, y2 arrays) of the closed rings."""
+
+    starts = []
+    ends = []
+    for ring in rings:
+        if len(ring) < 2:
+            continue
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        starts.append(ring[:-1])
+        ends.append(ring[1:])
+    if not starts:
+        empty = np.zeros(0)
+        return empty, empty, empty, empty
+    start = np.vstack(starts)
+    end = np.vstack(ends)
+    return start[:, 0], start[:, 1], end[:, 0], end[:, 1]
+
+
+def crossing_parity(px, py, x1, y1, x2, y2, chunk=1000000):
+    """
+    Return True for each point (px, py) that is inside the edges (even-odd).
+
+    A brute force ray casting test of every point against every edge; used
+    for the reference points of the grid cells.
+    """
+    inside = np.zeros(len(px), dtype=bool)
+    step = max(1, chunk // max(1, len(x1)))
+    for i in range(0, len(px), step):
+        x = px[i : i + step, None]
+        y = py[i : i + step, None]
+        spans = (y1 > y) != (y2 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cross_x = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        crossings = np.sum(spans & (x < cross_x), axis=1)
+        inside[i : i + step] = crossings % 2 == 1
+    return inside
+
+
+def orientation(ax, ay, bx, by, cx, cy):
+    """Return the sign of the turn a->b->c (+1 left, -1 right, 0 straight)."""
+
+    return np.sign((bx - ax) * (cy - ay) - (by - ay) * (cx - ax))
+
+
+def segments_cross(ax, ay, bx, by, cx, cy, dx, dy):
+    """Return True where segment a-b properly crosses segment c-d."""
+
+    o1 = orientation(ax, ay, bx, by, cx, cy)
+    o2 = orientation(ax, ay, bx, by, dx, dy)
+    o3 = orientation(cx, cy, dx, dy, ax, ay)
+    o4 = orientation(cx, cy, dx, dy, bx, by)
+    return (o1 * o2 < 0) & (o3 * o4 < 0)
+
+
+def on_segments(px, py, x1, y1, x2, y2):
+    """Return True where the point (px, py) is on the segment (x1, y1)-(x2, y2)."""
+
+    collinear = orientation(x1, y1, x2, y2, px, py) == 0
+    within_x = (px >= np.minimum(x1, x2)) & (px <= np.maximum(x1, x2))
+    within_y = (py >= np.minimum(y1, y2)) & (py <= np.maximum(y1, y2))
+    return collinear & within_x & within_y
+
+
+class BoundaryIndex(object):
+    """A grid index of the edges of a (multi)polygon for fast containment tests."""
+
+    # pylint: disable=useless-object-inheritance,too-many-instance-attributes
+
+    def __init__(self, wkt, cells=64):
+        self.x1, self.y1, self.x2, self.y2 = ring_edges(parse_wkt_rings(wkt))
+        if not len(self.x1):
+            raise ValueError("The boundary has no edges")
+        self.cells = cells
+        self.xmin = min(self.x1.min(), self.x2.min())
+        self.ymin = min(self.y1.min(), self.y2.min())
+        self.xmax = max(self.x1.max(), self.x2.max())
+        self.ymax = max(self.y1.max(), self.y2.max())
+        self.width = (self.xmax - self.xmin) / cells or 1.0
+        self.height = (self.ymax - self.ymin) / cells or 1.0
+        self.cell_edges = self.index_edges()
+        self.ref_x, self.ref_y, self.ref_inside = self.reference_points()
+        # A summed area table of the cells with edges, to quickly test if
+        # any cell in a rectangle of cells has an edge.
+        has_edges = np.zeros((cells, cells), dtype=int)
+        for number in self.cell_edges:
+            has_edges[number // cells, number % cells] = 1
+        self.edge_table = np.zeros((cells + 1, cells + 1), dtype=int)
+        self.edge_table[1:, 1:] = has_edges.cumsum(axis=0).cumsum(axis=1)
+
+    def cell_of(self, x, y):
+        """Return the column and row of the grid cell containing x, y."""
+
+        col = np.clip(((x - self.xmin) / self.width).astype(int), 0, self.cells - 1)
+        row = np.clip(((y - self.ymin) / self.height).astype(int), 0, self.cells - 1)
+        return col, row
+
+    def index_edges(self):
+        """Return a dictionary of the edges that may touch each cell (by number)."""
+
+        col1, row1 = self.cell_of(
+            np.minimum(self.x1, self.x2), np.minimum(self.y1, self.y2)
+        )
+        col2, row2 = self.cell_of(
+            np.maximum(self.x1, self.x2), np.maximum(self.y1, self.y2)
+        )
+        cell_edges = {}
+        for edge in range(len(self.x1)):
+            for col in range(col1[edge], col2[edge] + 1):
+                for row in range(row1[edge], row2[edge] + 1):
+                    cell_edges.setdefault(row * self.cells + col, []).append(edge)
+        return dict((cell, np.array(edges)) for cell, edges in cell_edges.items())
+
+    def reference_points(self):
+        """Return the reference point of each cell and if it is inside."""
+
+        # Slightly off center (and not on a diagonal of the cell), so it is
+        # unlikely to be on an edge or in line with a point and a vertex.
+        x_offsets = np.arange(self.cells) + 0.5012345
+        y_offsets = np.arange(self.cells) + 0.4987123
+        ref_x = self.xmin + np.tile(x_offsets, self.cells) * self.width
+        ref_y = self.ymin + np.repeat(y_offsets, self.cells) * self.height
+        inside = crossing_parity(ref_x, ref_y, self.x1, self.y1, self.x2, self.y2)
+        return ref_x, ref_y, inside
+
+    def contains_points(self, x, y):
+        """Return a boolean array; True where the point x, y is inside."""
+
+        inside, on_boundary = self.locate_points(x, y)
+        return inside & ~on_boundary
+
+    def locate_points(self, x, y):
+        """
+        Return boolean arrays (inside, on_boundary) for the points x, y.
+
+        inside is True where the point is inside (or on the boundary, where it
+        is undecided), and on_boundary where it is on an edge of the boundary.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        inside = np.zeros(len(x), dtype=bool)
+        on_boundary = np.zeros(len(x), dtype=bool)
+        in_box = (
+            (x >= self.xmin) & (x <= self.xmax) & (y >= self.ymin) & (y <= self.ymax)
+        )
+        col, row = self.cell_of(x, y)
+        cell = row * self.cells + col
+        inside[in_box] = self.ref_inside[cell[in_box]]
+        for number in np.unique(cell[in_box]):
+            edges = self.cell_edges.get(number)
+            if edges is None:
+                continue
+            points = np.nonzero(in_box & (cell == number))[0]
+            on_boundary[points] = np.any(
+                on_segments(
+                    x[points, None],
+                    y[points, None],
+                    self.x1[edges],
+                    self.y1[edges],
+                    self.x2[edges],
+                    self.y2[edges],
+                ),
+                axis=1,
+            )
+            crossings = segments_cross(
+                x[points, None],
+                y[points, None],
+                self.ref_x[number],
+                self.ref_y[number],
+                self.x1[edges],
+                self.y1[edges],
+                self.x2[edges],
+                self.y2[edges],
+            )
+            flips = np.sum(crossings, axis=1) % 2 == 1
+            inside[points] = inside[points] ^ flips
+        return inside, on_boundary
+
+    def crosses(self, ax, ay, bx, by):
+        """Return True if the segment a-b crosses an edge of the boundary."""
+
+        col1, row1 = self.cell_of(np.array([min(ax, bx)]), np.array([min(ay, by)]))
+        col2, row2 = self.cell_of(np.array([max(ax, bx)]), np.array([max(ay, by)]))
+        edges = [
+            self.cell_edges[row * self.cells + col]
+            for row in range(row1[0], row2[0] + 1)
+            for col in range(col1[0], col2[0] + 1)
+            if row * self.cells + col in self.cell_edges
+        ]
+        if not edges:
+            return False
+        edges = np.unique(np.concatenate(edges))
+        crossings = segments_cross(
+            ax,
+            ay,
+            bx,
+            by,
+            self.x1[edges],
+            self.y1[edges],
+            self.x2[edges],
+            self.y2[edges],
+        )
+        return bool(np.any(crossings))
+
+    def near_edges(self, ax, ay, bx, by):
+        """Return True where the bounding box of segment a-b has a cell with edges."""
+
+        col1, row1 = self.cell_of(np.minimum(ax, bx), np.minimum(ay, by))
+        col2, row2 = self.cell_of(np.maximum(ax, bx), np.maximum(ay, by))
+        table = self.edge_table
+        count = (
+            table[row2 + 1, col2 + 1]
+            - table[row1, col2 + 1]
+            - table[row2 + 1, col1]
+            + table[row1, col1]
+        )
+        return count > 0
+
+    def contains_lines(self, lines):
+        """
+        Return a boolean array; True where the line is inside the boundary.
+
+        lines is a list of (n, 2) vertex arrays (see parse_wkt_rings).
+        """
+        if not lines:
+            return np.zeros(0, dtype=bool)
+        counts = np.array([len(line) for line in lines])
+        vertices = np.vstack(lines)
+        owner = np.repeat(np.arange(len(lines)), counts)
+        inside, on_boundary = self.locate_points(vertices[:, 0], vertices[:, 1])
+        inside = inside | on_boundary
+        outside = np.bincount(owner, weights=~inside, minlength=len(lines)) > 0
+        result = ~outside
+        # The segments of the lines with all vertices inside, that are
+        # near enough to the boundary to cross it.
+        starts = np.nonzero(owner[:-1] == owner[1:])[0]
+        starts = starts[result[owner[starts]]]
+        a = vertices[starts]
+        b = vertices[starts + 1]
+        near = self.near_edges(a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+        for k in np.nonzero(near)[0]:
+            line = owner[starts[k]]
+            if result[line] and self.crosses(a[k, 0], a[k, 1], b[k, 0], b[k, 1]):
+                result[line] = False
+        # A segment between two points on the boundary may run along it, or
+        # outside it; its middle must be inside.
+        touching = on_boundary[starts] & on_boundary[starts + 1]
+        touching &= result[owner[starts]]
+        if np.any(touching):
+            middle = (a[touching] + b[touching]) / 2
+            result[owner[starts[touching]][~self.contains_points(*middle.T)]] = False
+        return result
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+A shared HTTP transport for all requests to the Carto SQL API.
+
+`upload.py` and `testing.py` send all of their Carto requests through a
+CartoSession (a requests.Session) which provides:
+
+* Connection pooling with keep-alive, so a run does not open a new TLS
+  connection for every SQL statement.
+* Gzip compressed request bodies for large statements (responses are already
+  gzip compressed when the server supports it).  If the server does not accept
+  a compressed body, the request is sent again uncompressed and compression
+  is turned off for the rest of the session.
+* Streamed request bodies (a COPY) are read into memory before they are sent,
+  so a retry sends the whole body again (a generator can only be read once,
+  and an empty COPY succeeds).
+* Retry with exponential backoff when the connection could not be made, or
+  the server responds with a status code that means the request was not run
+  (see Config.retry_statuses).  A POST (an SQL statement, or a COPY) is not
+  sent again after a gateway error or a lost response, since Carto may have
+  run it (and inserting the rows again would duplicate them); only an
+  idempotent request (a GET) is also retried on the gateway errors in
+  Config.idempotent_retry_statuses.
+* Respect for the Carto rate limit headers.  When the server says there are
+  no requests remaining, the next request waits until the limit resets.
+* A record of the latency of each request, and a way for other code to
+  observe each request as it completes.
+
+Carto rate limits: https://carto.com/developers/fundamentals/limits/
+
+Third party requirements:
+* carto - https://pypi.python.org/pypi/carto
+* requests - https://pypi.python.org/pypi/requests
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import threading
+import time
+import zlib
+
+from carto.auth import APIKeyAuthClient
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+
+class Config(object):
+    """Namespace for configuration parameters. Edit as necessary."""
+
+    # pylint: disable=useless-object-inheritance,too-few-public-methods
+
+    # Number of connections kept open (per host) for reuse.
+    pool_size = 4
+
+    # Number of times to retry a request that failed with a retryable status
+    # or a connection error. The wait between retries is
+    # backoff_factor * 2 ** (retry number - 1) seconds.
+    retries = 5
+    backoff_factor = 1.0
+
+    # HTTP status codes that mean the server did not run the request (the rate
+    # limit, or the service is unavailable); any request is retried.
+    # A 500 from the SQL API is usually an error in the SQL, so it is not
+    # retried.
+    retry_statuses = (429, 503)
+
+    # More HTTP status codes that are only retried for idempotent methods.
+    # A gateway error (or a timeout) may come after the SQL was run.
+    idempotent_retry_statuses = (502, 504)
+
+    # Request bodies smaller than this many bytes are not compressed.
+    compress_min_bytes = 4096
+
+    # Number of recent request timings kept by each session.
+    timings_kept = 1000
+
+
+# The methods that can be sent again without changing the result
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD"])
+
+
+class CartoRetry(Retry):
+    """
+    A urllib3 Retry policy that never repeats a request Carto may have run.
+
+    Connection errors (the request was not sent) and Config.retry_statuses
+    are retried for any method.  Config.idempotent_retry_statuses are only
+    retried for IDEMPOTENT_METHODS.  A read error (the request was sent, but
+    the response was lost) is never retried.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        """Return True if the request should be sent again."""
+
+        if status_code in Config.idempotent_retry_statuses:
+            if method.upper() not in IDEMPOTENT_METHODS:
+                return False
+        return super(CartoRetry, self).is_retry(method, status_code, has_retry_after)
+
+
+def make_retry():
+    """Return the urllib3 Retry policy for the settings in Config."""
+
+    options = {
+        "total": Config.retries,
+        "read": 0,
+        "backoff_factor": Config.backoff_factor,
+        "status_forcelist": Config.retry_statuses + Config.idempotent_retry_statuses,
+        "raise_on_status": False,
+        "respect_retry_after_header": True,
+    }
+    methods = frozenset(["GET", "POST"])
+    try:
+        return CartoRetry(allowed_methods=methods, **options)
+    except TypeError:
+        # urllib3 older than 1.26
+        return CartoRetry(method_whitelist=methods, **options)
+
+
+def gzip_bytes(data):
+    """Return data (bytes) compressed in the gzip format."""
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def buffer_body(request):
+    """
+    Replace a streamed body (a generator or file) of the prepared request
+    with its bytes, so the request can be sent again.
+    """
+    body = request.body
+    if body is None or isinstance(body, (bytes, type(""))):
+        return
+    if hasattr(body, "read"):
+        data = body.read()
+    else:
+        data = b"".join(
+            chunk if isinstance(chunk, bytes) else chunk.encode("utf-8")
+            for chunk in body
+        )
+    request.body = data
+    request.headers.pop("Transfer-Encoding", None)
+    request.headers["Content-Length"] = str(len(data))
+
+
+class CartoSession(requests.Session):
+    """
+    A requests session with pooling, compression, retries and timing.
+
+    Sessions are not thread safe; use one session per thread.
+
+    After each request, a timing dictionary is added to `timings` and passed
+    to each callable in `observers`.  The timing has the keys: method, url,
+    status, seconds, bytes_sent, and bytes_received.
+    """
+
+    def __init__(self):
+        super(CartoSession, self).__init__()
+        adapter = HTTPAdapter(
+            pool_connections=Config.pool_size,
+            pool_maxsize=Config.pool_size,
+            max_retries=make_retry(),
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.headers["Accept-Encoding"] = "gzip, deflate"
+        self.compress = True
+        self.resume_time = 0
+        self.timings = collections.deque(maxlen=Config.timings_kept)
+        self.observers = []
+
+    def send(self, request, **kwargs):
+        """Send the prepared request; compressing, pacing, and timing it."""
+
+        # pylint: disable=arguments-differ
+        self.wait_for_rate_limit()
+        buffer_body(request)
+        body = request.body
+        compressed = self.compress_body(request)
+        start = time.time()
+        response = super(CartoSession, self).send(request, **kwargs)
+        if compressed and response.status_code == 415:
+            # The server does not accept compressed bodies
+            self.compress = False
+            del request.headers["Content-Encoding"]
+            request.prepare_body(body, None)
+            response = super(CartoSession, self).send(request, **kwargs)
+        self.record_rate_limit(response)
+        self.record_timing(request, response, time.time() - start)
+        return response
+
+    def compress_body(self, request):
+        """Gzip the body of the prepared request if it is worth it."""
+
+        body = request.body
+        if not self.compress or "Content-Encoding" in request.headers:
+            return False
+        if not isinstance(body, (bytes, type(""))):
+            # A streamed body (e.g. COPY) handles its own compression
+            return False
+        if len(body) < Config.compress_min_bytes:
+            return False
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        request.body = gzip_bytes(body)
+        request.headers["Content-Encoding"] = "gzip"
+        request.headers["Content-Length"] = str(len(request.body))
+        return True
+
+    def wait_for_rate_limit(self):
+        """Sleep until the rate limit resets if there are no requests left."""
+
+        delay = self.resume_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record_rate_limit(self, response):
+        """Remember when requests may resume from the Carto rate limit headers."""
+
+        headers = response.headers
+        remaining = headers.get("Carto-Rate-Limit-Remaining")
+        wait = None
+        if response.status_code == 429:
+            wait = headers.get("Retry-After")
+        elif remaining is not None and remaining.strip() == "0":
+            wait = headers.get("Carto-Rate-Limit-Reset")
+        if wait is not None:
+            try:
+                self.resume_time = time.time() + float(wait)
+            except ValueError:
+                pass
+
+    def record_timing(self, request, response, seconds):
+        """Save the timing for this request and tell the observers."""
+
+        body = request.body
+        sent = len(body) if isinstance(body, (bytes, type(""))) else None
+        received = response.headers.get("Content-Length")
+        timing = {
+            "method": request.method,
+            "url": request.url.split("?")[0],
+            "status": response.status_code,
+            "seconds": seconds,
+            "bytes_sent": sent,
+            "bytes_received": int(received) if received else None,
+        }
+        self.timings.append(timing)
+        for observer in self.observers:
+            observer(timing)
+
+
+# One session per thread, for code that does not manage its own sessions.
+_local = threading.local()
+
+
+def get_session():
+    """Return the CartoSession for the current thread."""
+
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = CartoSession()
+        _local.session = session
+    return session
+
+
+def get_auth_client(base_url, api_key, session=None):
+    """Return a Carto API key authorization client that uses a CartoSession."""
+
+    return APIKeyAuthClient(
+        api_key=api_key,
+        base_url=base_url,
+        session=session or get_session(),
+    )
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the Carto SQL API, for benchmarking `upload.py`.
+
+The server implements just enough of `/api/v2/sql` and `/api/v2/sql/copyfrom`
+for the statements that `upload.py` sends.  Instead of a PostGIS database, it
+keeps the rows of `animal_locations` and `animal_movements` in memory (the
+text of each column by key, and the number of rows with each key):
+
+* INSERT ... VALUES and COPY ... FROM stdin add rows.  The geometry
+  functions used by the INSERT statements are written as EWKT, the same as
+  the COPY text, so the rows from both can be compared (see
+  `test_fake_carto.py`).
+* INSERT ... ON CONFLICT (key) DO UPDATE replaces the rows with the same
+  key (DO NOTHING keeps them).
+* The DELETE statements for locations (by fixid) and movements (joined to a
+  list of keys) remove rows.
+* The SELECT statements used to recover interrupted batches return the keys
+  that are present.
+* Any other statement succeeds and returns no rows.
+
+Compressed (gzip) and chunked request bodies are accepted, as from
+`carto_transport.py` and the carto COPY client.  An optional delay is added to
+each request to mimic the network and server time of the real Carto server.
+
+Two extra endpoints support the benchmarks: `GET /stats` returns the request
+count, bytes received, and rows inserted, deleted, and stored; `POST /reset`
+empties the tables and zeros the counts.
+
+Usage: `python fake_carto.py [--port PORT] [--latency SECONDS]`.  The port
+(a free port by default) is printed on the first line of output.
+
+Never use this with real data; nothing is saved.
+
+No third party requirements.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import collections
+import csv
+import json
+import re
+import sys
+import threading
+import time
+import zlib
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+
+MOVEMENT_KEY = ["projectid", "animalid", "startdate", "enddate"]
+
+
+def split_groups(text):
+    """
+    Return the top level parenthesized groups in text (without the parentheses).
+
+    Parentheses inside quoted strings and nested groups (function calls) are
+    ignored.
+    """
+    groups = []
+    depth = 0
+    start = None
+    quoted = False
+    for i, char in enumerate(text):
+        if char == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == "(":
+            if depth == 0:
+                start = i + 1
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                groups.append(text[start:i])
+    return groups
+
+
+def split_fields(group):
+    """Return the top level comma separated fields in group, unquoted."""
+
+    fields = []
+    depth = 0
+    quoted = False
+    field = []
+    for char in group:
+        if char == "'":
+            quoted = not quoted
+        elif not quoted and char == "(":
+            depth += 1
+        elif not quoted and char == ")":
+            depth -= 1
+        elif not quoted and depth == 0 and char == ",":
+            fields.append("".join(field).strip())
+            field = []
+            continue
+        field.append(char)
+    fields.append("".join(field).strip())
+    return [field.strip("'") for field in fields]
+
+
+def geometry_text(field):
+    """Return the INSERT geometry function in field as EWKT; other fields as is."""
+
+    match = re.match(
+        r"ST_SetSRID\(ST_Point\(([^,]+),([^)]+)\),\s*(\d+)\)$", field, re.I
+    )
+    if match:
+        x, y, srid = [value.strip() for value in match.groups()]
+        return "SRID={0};POINT({1} {2})".format(srid, x, y)
+    match = re.match(r"ST_Geom(?:etry)?FromText\('(.*)',\s*(\d+)\)$", field, re.I)
+    if match:
+        return "SRID={1};{0}".format(*match.groups())
+    return field
+
+
+def row_of(columns, fields):
+    """Return the dictionary of column text for the fields (in columns order)."""
+
+    return dict(zip(columns, [geometry_text(field) for field in fields]))
+
+
+def key_of(table, row):
+    """Return the key of a table row (a dictionary of column text)."""
+
+    if table == "animal_locations":
+        return int(row["fixid"])
+    return tuple(row[column] for column in MOVEMENT_KEY)
+
+
+class CartoStore(object):
+    """The rows in the Carto tables, and the request statistics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Empty the tables and zero the statistics."""
+
+        self.tables = {
+            "animal_locations": collections.Counter(),
+            "animal_movements": collections.Counter(),
+        }
+        self.rows = {"animal_locations": {}, "animal_movements": {}}
+        self.stats = collections.Counter()
+
+    def snapshot(self):
+        """Return a dictionary of the statistics and table sizes."""
+
+        with self.lock:
+            stats = dict(self.stats)
+            stats["locations"] = sum(self.tables["animal_locations"].values())
+            stats["movements"] = sum(self.tables["animal_movements"].values())
+        return stats
+
+    def count_request(self, size):
+        """Count a request of size bytes."""
+
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes_received"] += size
+
+    def add(self, table, rows):
+        """Add the rows (dictionaries of column text) to table."""
+
+        with self.lock:
+            for row in rows:
+                key = key_of(table, row)
+                self.tables[table][key] += 1
+                self.rows[table][key] = row
+            self.stats["rows_inserted"] += len(rows)
+
+    def upsert(self, table, rows, update):
+        """
+        Add the rows to table, replacing (if update) or keeping the rows with
+        the same key; return the number of rows added or replaced.
+        """
+        count = 0
+        with self.lock:
+            for row in rows:
+                key = key_of(table, row)
+                if key in self.tables[table]:
+                    if not update:
+                        continue
+                    self.stats["rows_updated"] += 1
+                else:
+                    self.tables[table][key] = 1
+                    self.stats["rows_inserted"] += 1
+                self.rows[table][key] = row
+                count += 1
+        return count
+
+    def delete(self, table, keys):
+        """Remove all rows with the keys from table; return the number removed."""
+
+        count = 0
+        with self.lock:
+            rows = self.tables[table]
+            for key in keys:
+                count += rows.pop(key, 0)
+                self.rows[table].pop(key, None)
+            self.stats["rows_deleted"] += count
+        return count
+
+    def table_rows(self, table):
+        """Return a dictionary of the rows (dictionaries of column text) by key."""
+
+        with self.lock:
+            return dict(self.rows[table])
+
+    def present(self, table, keys):
+        """Return the keys that are in table."""
+
+        with self.lock:
+            return [key for key in keys if key in self.tables[table]]
+
+    def execute(self, sql):
+        """Run the SQL statement and return the response dictionary."""
+
+        text = " ".join(sql.split())
+        lower = text.lower()
+        match = re.match(
+            r"insert into (\w+) \(([^)]*)\) values (.*?)"
+            r"(?: on conflict \([^)]*\) do (update|nothing)\b.*)?$",
+            text,
+            re.I,
+        )
+        if match:
+            table = match.group(1).lower()
+            columns = [column.strip() for column in match.group(2).split(",")]
+            rows = [
+                row_of(columns, split_fields(group))
+                for group in split_groups(match.group(3))
+            ]
+            if match.group(4) is None:
+                self.add(table, rows)
+                return {"rows": [], "total_rows": len(rows)}
+            count = self.upsert(table, rows, match.group(4).lower() == "update")
+            return {"rows": [], "total_rows": count}
+        match = re.match(
+            r"delete from animal_locations where fixid in \((.*)\)$", lower
+        )
+        if match:
+            fids = [int(fid) for fid in match.group(1).split(",")]
+            count = self.delete("animal_locations", fids)
+            return {"rows": [], "total_rows": count}
+        if lower.startswith("select distinct fixid from animal_locations"):
+            fids = [int(fid) for fid in split_fields(split_groups(text)[0])]
+            rows = self.present("animal_locations", fids)
+            return {"rows": [{"fixid": fid} for fid in rows], "total_rows": len(rows)}
+        match = re.search(r"\(values (.*)\) as d \(", text, re.I)
+        if match and "animal_movements" in lower:
+            keys = [
+                tuple(split_fields(group)) for group in split_groups(match.group(1))
+            ]
+            if lower.startswith("delete from animal_movements"):
+                count = self.delete("animal_movements", keys)
+                return {"rows": [], "total_rows": count}
+            if lower.startswith("select d.projectid"):
+                rows = self.present("animal_movements", keys)
+                rows = [dict(zip(MOVEMENT_KEY, key)) for key in rows]
+                return {"rows": rows, "total_rows": len(rows)}
+        return {"rows": [], "total_rows": 0}
+
+    def copy(self, query, data):
+        """Run the COPY query with the CSV data; return the response dictionary."""
+
+        match = re.match(r"copy (\w+) \(([^)]*)\)", query.strip(), re.I)
+        table = match.group(1).lower()
+        columns = [column.strip() for column in match.group(2).split(",")]
+        lines = data.decode("utf-8").splitlines()
+        rows = [row_of(columns, fields) for fields in csv.reader(lines)]
+        self.add(table, rows)
+        return {"total_rows": len(rows)}
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    """An HTTP server that handles each connection in a thread."""
+
+    daemon_threads = True
+
+
+class CartoHandler(BaseHTTPRequestHandler):
+    """Handle requests to the Carto SQL API with the server's store."""
+
+    # Keep connections open, like the real server
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        # pylint: disable=arguments-differ
+        pass
+
+    def read_body(self):
+        """Return the request body as bytes; de-chunked and decompressed."""
+
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b"".join(parts)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.store.count_request(len(body))
+        if self.headers.get("Content-Encoding", "").lower() == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def respond(self, data, status=200):
+        """Send the data as a JSON response."""
+
+        time.sleep(self.server.latency)
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Handle a SQL API query, or a request for the statistics."""
+
+        # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            self.respond(self.server.store.snapshot())
+            return
+        self.server.store.count_request(0)
+        query = parse_qs(url.query).get("q", [""])[0]
+        self.respond(self.server.store.execute(query))
+
+    def do_POST(self):
+        """Handle a SQL API query or COPY, or a reset."""
+
+        # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        body = self.read_body()
+        if url.path == "/reset":
+            self.server.store.reset()
+            self.respond({})
+        elif url.path.endswith("/copyfrom"):
+            query = parse_qs(url.query).get("q", [""])[0]
+            self.respond(self.server.store.copy(query, body))
+        else:
+            form = parse_qs(body.decode("utf-8"))
+            query = form.get("q", [""])[0]
+            self.respond(self.server.store.execute(query))
+
+
+def make_server(port=0, latency=0.0):
+    """Return a fake Carto server on localhost:port (a free port if 0)."""
+
+    server = ThreadingServer(("127.0.0.1", port), CartoHandler)
+    server.store = CartoStore()
+    server.latency = latency
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A fake Carto SQL API server.")
+    parser.add_argument("--port", type=int, default=0, help="port to listen on")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds to add to each request"
+    )
+    args = parser.parse_args()
+    fake = make_server(args.port, args.latency)
+    print(fake.server_address[1])
+    sys.stdout.flush()
+    fake.serve_forever()
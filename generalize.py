@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Reduce the precision of the locations and movements published to Carto.
+
+The Animal Movement database keeps coordinates at full (double) precision,
+which is far more than the public map needs; 5 decimal places of a degree is
+about a meter.  A Generalizer rounds the coordinates of points and lines to
+a number of decimal places, and can simplify lines with more than two
+vertices with the Douglas-Peucker algorithm.  Simplification always keeps
+the first and last vertex (so a movement still ends at its locations, which
+are rounded the same way), and a simplified line that crosses itself when
+the original did not is replaced by the original line, so the shape of a
+movement does not change its topology.
+
+Lines are given and returned in the form read from SQL Server: well known
+text (from ToString()) or well known binary (from STAsBinary()).  Only the
+first two ordinates (x=longitude, y=latitude) are kept.
+
+The Generalizer keeps the size of the geometries before and after, and the
+maximum distance (in meters, approximately) that a vertex was moved from the
+original shape, so the savings and the cost can be reported.
+
+No third party requirements.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import math
+import re
+import struct
+
+# Approximate length of a degree of latitude (and longitude at the equator)
+METERS_PER_DEGREE = 111320.0
+
+NUMBER = re.compile(r"[-+0-9.eE]+")
+
+
+def parse_line(geometry):
+    """Return the list of (x, y) vertices of a WKT (text) or WKB (bytes) line."""
+
+    # WKT is text (unicode in Python 2); WKB is bytes (or a bytearray)
+    if not isinstance(geometry, type("")):
+        wkb = bytes(geometry)
+        order = "<" if wkb[0:1] == b"\x01" else ">"
+        geometry_type, count = struct.unpack(order + "II", wkb[1:9])
+        if geometry_type != 2:
+            raise ValueError("Not a 2D WKB LINESTRING (type {0})".format(geometry_type))
+        values = struct.unpack("{0}{1}d".format(order, 2 * count), wkb[9:])
+        return list(zip(values[0::2], values[1::2]))
+    vertices = []
+    for vertex in geometry[geometry.index("(") + 1 : geometry.rindex(")")].split(","):
+        x, y = NUMBER.findall(vertex)[:2]
+        vertices.append((float(x), float(y)))
+    return vertices
+
+
+def number_text(value):
+    """Return the shortest text for the float value (no trailing ".0")."""
+
+    text = "{0!r}".format(value)
+    if text.endswith(".0"):
+        return text[:-2]
+    return text
+
+
+def format_line(vertices, binary):
+    """Return the vertices as a WKB (bytes) line if binary, else as WKT."""
+
+    if binary:
+        values = [value for vertex in vertices for value in vertex]
+        return struct.pack("<BII{0}d".format(len(values)), 1, 2, len(vertices), *values)
+    text = ", ".join(number_text(x) + " " + number_text(y) for x, y in vertices)
+    return "LINESTRING ({0})".format(text)
+
+
+def meters(x1, y1, x2, y2):
+    """Return the approximate distance in meters between two lon/lat points."""
+
+    scale = math.cos(math.radians((y1 + y2) / 2))
+    return METERS_PER_DEGREE * math.hypot((x2 - x1) * scale, y2 - y1)
+
+
+def nearest_on_segment(point, start, end):
+    """Return the (x, y) point on the segment start-end nearest to point."""
+
+    ax, ay = start
+    dx, dy = end[0] - ax, end[1] - ay
+    length = dx * dx + dy * dy
+    t = 0.0
+    if length > 0:
+        t = ((point[0] - ax) * dx + (point[1] - ay) * dy) / length
+        t = max(0.0, min(1.0, t))
+    return ax + t * dx, ay + t * dy
+
+
+def segment_offset(point, start, end):
+    """Return the distance (in degrees) from point to the segment start-end."""
+
+    x, y = nearest_on_segment(point, start, end)
+    return math.hypot(point[0] - x, point[1] - y)
+
+
+def line_offset_meters(point, vertices):
+    """Return the distance in meters from point to the nearest part of the line."""
+
+    segments = zip(vertices[:-1], vertices[1:])
+    start, end = min(segments, key=lambda ends: segment_offset(point, *ends))
+    x, y = nearest_on_segment(point, start, end)
+    return meters(point[0], point[1], x, y)
+
+
+def douglas_peucker(vertices, tolerance):
+    """Return the vertices of the line simplified to within tolerance (degrees)."""
+
+    keep = [False] * len(vertices)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(vertices) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, index = 0.0, None
+        for i in range(first + 1, last):
+            offset = segment_offset(vertices[i], vertices[first], vertices[last])
+            if offset > farthest:
+                farthest, index = offset, i
+        if index is not None and farthest > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [vertex for vertex, kept in zip(vertices, keep) if kept]
+
+
+def orientation(a, b, c):
+    """Return 1, -1, or 0 as a, b, c turn left, right, or are collinear."""
+
+    cross = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    return (cross > 0) - (cross < 0)
+
+
+def self_intersects(vertices):
+    """Return True if two non-adjacent segments of the line touch or cross."""
+
+    segments = list(zip(vertices[:-1], vertices[1:]))
+    for i, (a, b) in enumerate(segments):
+        for j in range(i + 2, len(segments)):
+            c, d = segments[j]
+            if i == 0 and j == len(segments) - 1 and a == d:
+                # A closed line touches itself at the ends
+                continue
+            if (
+                orientation(a, b, c) * orientation(a, b, d) <= 0
+                and orientation(c, d, a) * orientation(c, d, b) <= 0
+                and min(a[0], b[0]) <= max(c[0], d[0])
+                and min(c[0], d[0]) <= max(a[0], b[0])
+                and min(a[1], b[1]) <= max(c[1], d[1])
+                and min(c[1], d[1]) <= max(a[1], b[1])
+            ):
+                return True
+    return False
+
+
+class Generalizer(object):
+    """
+    Round and simplify geometries, and total the size and error.
+
+    digits is the number of decimal places (of a degree) to keep, or None to
+    keep full precision.  tolerance (in degrees) is the distance a vertex may
+    be from a simplified line, or None to not simplify.  binary is True if
+    the geometries are sent as WKB, and is used to size the geometries.
+    """
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self, digits=None, tolerance=None, binary=False):
+        self.digits = digits
+        self.tolerance = tolerance
+        self.binary = binary
+        self.count = 0
+        self.size_before = 0
+        self.size_after = 0
+        self.max_error = 0.0
+
+    def round(self, vertices):
+        """Return the vertices rounded to self.digits."""
+
+        if self.digits is None:
+            return vertices
+        return [(round(x, self.digits), round(y, self.digits)) for x, y in vertices]
+
+    def point_size(self, x, y):
+        """Return the size of the point (x, y) as it is sent to Carto."""
+
+        if self.binary:
+            # Two doubles as hex
+            return 32
+        return len(number_text(x) + number_text(y))
+
+    def line_size(self, geometry):
+        """Return the size of the line geometry as it is sent to Carto."""
+
+        if self.binary:
+            # hex
+            return 2 * len(geometry)
+        return len(geometry)
+
+    def point(self, x, y):
+        """Return the point (x, y) rounded."""
+
+        new_x, new_y = self.round([(x, y)])[0]
+        self.count += 1
+        self.size_before += self.point_size(x, y)
+        self.size_after += self.point_size(new_x, new_y)
+        self.max_error = max(self.max_error, meters(x, y, new_x, new_y))
+        return new_x, new_y
+
+    def line(self, geometry):
+        """Return the line geometry (WKT or WKB) simplified and rounded."""
+
+        vertices = parse_line(geometry)
+        result = vertices
+        if self.tolerance and len(vertices) > 2:
+            result = douglas_peucker(vertices, self.tolerance)
+            if len(result) < len(vertices) and self_intersects(result):
+                if not self_intersects(vertices):
+                    result = vertices
+        result = self.round(result)
+        error = max(
+            meters(vertices[0][0], vertices[0][1], result[0][0], result[0][1]),
+            meters(vertices[-1][0], vertices[-1][1], result[-1][0], result[-1][1]),
+        )
+        for vertex in vertices[1:-1]:
+            error = max(error, line_offset_meters(vertex, result))
+        new_geometry = format_line(result, self.binary)
+        self.count += 1
+        self.size_before += self.line_size(geometry)
+        self.size_after += self.line_size(new_geometry)
+        self.max_error = max(self.max_error, error)
+        return new_geometry
+
+    def summary(self):
+        """Return a one line summary of the size reduction and maximum error."""
+
+        saved = self.size_before - self.size_after
+        return "{0} bytes smaller ({1:.1f}%), max error {2:.2f} m".format(
+            saved, 100.0 * saved / max(self.size_before, 1), self.max_error
+        )
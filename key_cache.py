@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+A local cache of the keys of the rows published to Carto.
+
+The tracking tables in SQL Server (`Locations_In_CartoDB` and
+`Movements_In_CartoDB`) record what is in Carto, and `upload.py` normally
+finds the new rows with an anti-join against them on the (shared) Animal
+Movement server.  With the cache, `upload.py` instead reads just the keys of
+the candidate rows (a cheap key-only scan), removes the published keys here,
+and only asks the server for the rows of the keys that are left.
+
+Each set of keys is a sorted NumPy array of 64 bit integers: the fixid of a
+location, or a hash of the (project, animal, start, end) key of a movement
+(a collision in 64 bits is very unlikely, and is fixed by the periodic
+validation).  A million keys take 8 MB and load in a few milliseconds.
+Added and removed keys are buffered and merged when the set is next used.
+
+The sets are saved in a directory (with a small state file) at the end of a
+sync, and the state file is removed while a sync is changing the tracking
+tables.  If the state file is missing (the last run did not finish, or
+something else changed the tracking tables; see invalidate()), or it is
+older than the validation period, the sets are read again from the tracking
+tables (key only scans), and any difference is reported.
+
+Run this file to time the load and difference of a million keys.
+
+Third party requirements:
+* numpy - https://pypi.org/project/numpy/
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+
+class Config(object):
+    """Namespace for configuration parameters. Edit as necessary."""
+
+    # pylint: disable=useless-object-inheritance,too-few-public-methods
+
+    # The directory for the key sets; next to this script by default.
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "published_keys")
+
+    # Hours between checks of the cache against the tracking tables.
+    validate_hours = 24
+
+
+# The kinds of keys, and the SQL to read them from the tracking tables
+TRACKING_SQL = {
+    "locations": "select fixid from Locations_In_CartoDB",
+    "movements": """
+        select ProjectId, AnimalId, StartDate, EndDate from Movements_In_CartoDB
+    """,
+}
+
+
+def key_hash(key):
+    """Return the 64 bit integer for a key tuple; the fixid of a location."""
+
+    if len(key) == 1:
+        return int(key[0])
+    text = "|".join("{0}".format(value) for value in key)
+    return struct.unpack("<q", hashlib.md5(text.encode("utf-8")).digest()[:8])[0]
+
+
+def key_hashes(keys):
+    """Return a NumPy array of the hashes of the key tuples."""
+
+    return np.fromiter((key_hash(key) for key in keys), dtype=np.int64, count=len(keys))
+
+
+class KeySet(object):
+    """
+    A set of 64 bit key hashes.
+
+    hashes is an array of hashes; if is_sorted is True, it is already sorted
+    and unique (e.g. saved from a KeySet), so it is used as is.
+    """
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self, hashes=None, is_sorted=False):
+        if hashes is None:
+            hashes = np.zeros(0, dtype=np.int64)
+        self.hashes = hashes if is_sorted else np.unique(hashes)
+        self.added = []
+        self.removed = []
+
+    def merge(self):
+        """Merge the buffered changes; return the sorted array of hashes."""
+
+        if self.added:
+            self.hashes = np.union1d(self.hashes, np.concatenate(self.added))
+            self.added = []
+        if self.removed:
+            self.hashes = np.setdiff1d(
+                self.hashes, np.concatenate(self.removed), assume_unique=True
+            )
+            self.removed = []
+        return self.hashes
+
+    def add(self, hashes):
+        """Add the hashes (a NumPy array) to the set."""
+
+        if self.removed:
+            self.merge()
+        self.added.append(hashes)
+
+    def remove(self, hashes):
+        """Remove the hashes (a NumPy array) from the set."""
+
+        if self.added:
+            self.merge()
+        self.removed.append(hashes)
+
+    def contains(self, hashes):
+        """Return a boolean array; True where the hash is in the set."""
+
+        sorted_hashes = self.merge()
+        if not len(sorted_hashes):
+            return np.zeros(len(hashes), dtype=bool)
+        index = np.searchsorted(sorted_hashes, hashes)
+        index[index == len(sorted_hashes)] = 0
+        return sorted_hashes[index] == hashes
+
+
+class KeyCache(object):
+    """
+    The locations and movements KeySets, saved in a directory.
+
+    The cache is safe to use from several threads.  It is only used after it
+    is opened; until then the changes are ignored.
+    """
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self, path=None):
+        self.path = path or Config.path
+        self.lock = threading.Lock()
+        self.sets = None
+        self.validated = 0
+
+    def file(self, name):
+        """Return the path of the file name in the cache directory."""
+
+        return os.path.join(self.path, name)
+
+    def read_state(self):
+        """Return the saved state dictionary; None if it is missing."""
+
+        try:
+            with io.open(self.file("state.json"), encoding="utf-8") as in_file:
+                return json.load(in_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def load(self):
+        """Return the saved sets (a dictionary); None if they are not valid."""
+
+        state = self.read_state()
+        if state is None:
+            return None
+        try:
+            sets = {}
+            for kind in TRACKING_SQL:
+                sets[kind] = KeySet(np.load(self.file(kind + ".npy")), is_sorted=True)
+        except (IOError, OSError, ValueError):
+            return None
+        self.validated = state["validated"]
+        return sets
+
+    def read_tracking(self, fetch_batches):
+        """
+        Return the sets read from the tracking tables.
+
+        fetch_batches(sql) yields lists of rows for the SQL.
+        """
+        sets = {}
+        for kind, sql in TRACKING_SQL.items():
+            parts = [
+                key_hashes([tuple(row) for row in rows]) for rows in fetch_batches(sql)
+            ]
+            sets[kind] = KeySet(np.concatenate(parts) if parts else None)
+        return sets
+
+    def open(self, fetch_batches):
+        """
+        Load (or read again) the sets, and mark the saved cache as in use.
+
+        The sets are read from the tracking tables with fetch_batches(sql) (see
+        read_tracking()) if there is no valid saved cache, or it has not been
+        validated for Config.validate_hours.  Differences are printed.
+        A pyodbc.Error from fetch_batches is raised.
+        """
+        with self.lock:
+            sets = self.sets if self.sets is not None else self.load()
+            due = time.time() - self.validated > Config.validate_hours * 3600
+            if sets is None or due:
+                tracked = self.read_tracking(fetch_batches)
+                if sets is not None:
+                    for kind, key_set in tracked.items():
+                        differ = np.setxor1d(sets[kind].merge(), key_set.hashes)
+                        if len(differ):
+                            print(
+                                "The key cache differed from the tracking table"
+                                " by {0} {1}; reloaded.".format(len(differ), kind)
+                            )
+                sets = tracked
+                self.validated = time.time()
+            self.sets = sets
+            self.remove_state()
+
+    def is_open(self):
+        """Return True if the sets are loaded (see open())."""
+
+        return self.sets is not None
+
+    def unpublished(self, kind, keys):
+        """Return the list of the key tuples of kind that are not in the set."""
+
+        if not keys:
+            return []
+        with self.lock:
+            published = self.sets[kind].contains(key_hashes(keys))
+        return [keys[i] for i in np.nonzero(~published)[0]]
+
+    def add(self, kind, keys):
+        """Add the key tuples of kind (now tracked) to the cache, if it is open."""
+
+        if self.is_open() and keys:
+            hashes = key_hashes(keys)
+            with self.lock:
+                self.sets[kind].add(hashes)
+
+    def remove(self, kind, keys):
+        """Remove the key tuples of kind (no longer tracked), if it is open."""
+
+        if self.is_open() and keys:
+            hashes = key_hashes(keys)
+            with self.lock:
+                self.sets[kind].remove(hashes)
+
+    def remove_state(self):
+        """Remove the state file; the saved sets are not valid until saved."""
+
+        try:
+            os.remove(self.file("state.json"))
+        except OSError:
+            pass
+
+    def invalidate(self):
+        """Forget the sets; they are read from the tracking tables when opened."""
+
+        with self.lock:
+            self.sets = None
+            self.remove_state()
+
+    def save(self):
+        """Save the sets and the state file (atomically, if possible)."""
+
+        with self.lock:
+            if not self.is_open():
+                return
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            for kind, key_set in self.sets.items():
+                temp = self.file(kind + ".tmp.npy")
+                np.save(temp, key_set.merge())
+                replace(temp, self.file(kind + ".npy"))
+            state = {"saved": time.time(), "validated": self.validated}
+            temp = self.file("state.tmp")
+            with io.open(temp, "w", encoding="utf-8") as out_file:
+                out_file.write(json.dumps(state))
+            replace(temp, self.file("state.json"))
+
+
+def replace(source, destination):
+    """Rename source to destination, replacing it."""
+
+    try:
+        os.replace(source, destination)
+    except AttributeError:
+        # Python 2
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def check_speed(count=1000000, new=10000):
+    """Time saving, loading, and finding new keys in a set of count keys."""
+
+    rand = np.random.RandomState(1)
+    hashes = rand.randint(-(2**62), 2**62, size=count, dtype=np.int64)
+    path = tempfile.mkdtemp()
+    cache = KeyCache(path)
+    cache.sets = {"locations": KeySet(hashes), "movements": KeySet()}
+    start = time.time()
+    cache.save()
+    print("Saved {0} keys in {1:.3f} sec".format(count, time.time() - start))
+    cache = KeyCache(path)
+    start = time.time()
+    cache.sets = cache.load()
+    print("Loaded {0} keys in {1:.3f} sec".format(count, time.time() - start))
+    keys = [(int(value),) for value in hashes[:new]] + [
+        (-(2**63) + i,) for i in range(new)
+    ]
+    start = time.time()
+    unpublished = cache.unpublished("locations", keys)
+    print(
+        "Found {0} unpublished of {1} keys in {2:.3f} sec".format(
+            len(unpublished), len(keys), time.time() - start
+        )
+    )
+    for name in os.listdir(path):
+        os.remove(os.path.join(path, name))
+    os.rmdir(path)
+
+
+if __name__ == "__main__":
+    check_speed()
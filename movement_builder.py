@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+Build the movements of animals from their locations with NumPy.
+
+A movement in Animal Movement is the line between two consecutive (by fix
+date) locations of an animal that are not hidden, with its Duration,
+Distance and Speed.  They are kept in the Movements table by the database;
+for a project whose movements are missing or lag behind its locations,
+`upload.py` can build them from the locations instead (see
+`Config.derive_movements` in `upload.py`).
+
+A MovementBuilder takes batches of location rows ordered by animal and fix
+date (as read from SQL Server) and returns the keys and values of the
+movements for each batch, with the durations, distances and speeds of the
+whole batch computed at once.  The last location of a batch is kept for the
+first movement of the next batch.  movement_rows() makes rows in the form
+read from the Movements table (with WKT or WKB shapes) for the movements
+that are needed.  Distances are geodesic (Vincenty's inverse formula on the
+WGS 84 ellipsoid, iterated for all the segments at once), like the length of
+a geography in SQL Server.
+Movements with no distance or no duration are not returned; the Movements
+table does not publish them either.
+
+The units of the Animal Movement values are in Config; check them (and the
+values) against the Movements table with `python movement_builder.py
+--compare`.  Run it without arguments to time the build of a million fixes.
+
+Third party requirements:
+* numpy - https://pypi.org/project/numpy/
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import datetime
+import hashlib
+import time
+
+import numpy as np
+
+
+class Config(object):
+    """Namespace for configuration parameters. Edit as necessary."""
+
+    # pylint: disable=useless-object-inheritance,too-few-public-methods
+
+    # The units of the Duration (hours) and Distance (meters) of a movement
+    # in Animal Movement; Speed is Distance per Duration.
+    seconds_per_duration = 3600.0
+    meters_per_distance = 1.0
+
+    # The largest differences (in the units above) accepted by --compare
+    duration_tolerance = 1e-6
+    distance_tolerance = 0.01
+
+
+# The WGS 84 ellipsoid
+SEMI_MAJOR_AXIS = 6378137.0
+FLATTENING = 1 / 298.257223563
+SEMI_MINOR_AXIS = SEMI_MAJOR_AXIS * (1 - FLATTENING)
+
+# The WKB (little endian) of a 2 vertex LINESTRING
+WKB_LINE = np.dtype(
+    [("order", "u1"), ("type", "<u4"), ("count", "<u4"), ("coords", "<f8", (4,))]
+)
+
+
+def geodesic_meters(lat1, lon1, lat2, lon2, iterations=200):
+    """
+    Return the geodesic distances in meters between the points (arrays, degrees).
+
+    Uses Vincenty's inverse formula on the WGS 84 ellipsoid.  The points that
+    converge are left alone while the rest are iterated again; nearly
+    antipodal points (which may not converge) do not occur in a movement.
+    """
+    a, b, f = SEMI_MAJOR_AXIS, SEMI_MINOR_AXIS, FLATTENING
+    lat1, lon1, lat2, lon2 = [
+        np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2)
+    ]
+    u1 = np.arctan((1 - f) * np.tan(lat1))
+    u2 = np.arctan((1 - f) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+    delta = lon2 - lon1
+    lam = delta.copy()
+    active = np.ones(lam.shape, dtype=bool)
+    sin_sigma = cos_sigma = sigma = cos2_alpha = cos_2sm = np.zeros(lam.shape)
+    for _ in range(iterations):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(
+            cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam
+        )
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sin_alpha = np.where(
+                sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma
+            )
+            cos2_alpha = 1 - sin_alpha**2
+            # On the equator (cos2_alpha = 0), cos_2sm is 0
+            cos_2sm = np.where(
+                cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha
+            )
+        c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+        new_lam = delta + (1 - c) * f * sin_alpha * (
+            sigma + c * sin_sigma * (cos_2sm + c * cos_sigma * (2 * cos_2sm**2 - 1))
+        )
+        active = np.abs(new_lam - lam) > 1e-12
+        lam = np.where(active, new_lam, lam)
+        if not active.any():
+            break
+    u_squared = cos2_alpha * (a**2 - b**2) / b**2
+    big_a = 1 + u_squared / 16384 * (
+        4096 + u_squared * (-768 + u_squared * (320 - 175 * u_squared))
+    )
+    big_b = (
+        u_squared
+        / 1024
+        * (256 + u_squared * (-128 + u_squared * (74 - 47 * u_squared)))
+    )
+    delta_sigma = (
+        big_b
+        * sin_sigma
+        * (
+            cos_2sm
+            + big_b
+            / 4
+            * (
+                cos_sigma * (2 * cos_2sm**2 - 1)
+                - big_b / 6 * cos_2sm * (4 * sin_sigma**2 - 3) * (4 * cos_2sm**2 - 3)
+            )
+        )
+    )
+    return b * big_a * (sigma - delta_sigma)
+
+
+def line_texts(coords):
+    """Return the WKT of the lines in the (n, 4) array of lon1, lat1, lon2, lat2."""
+
+    template = "LINESTRING ({0!r} {1!r}, {2!r} {3!r})"
+    return [template.format(*values) for values in coords.tolist()]
+
+
+def line_wkbs(coords):
+    """Return the WKB of the lines in the (n, 4) array of lon1, lat1, lon2, lat2."""
+
+    lines = np.zeros(len(coords), dtype=WKB_LINE)
+    lines["order"] = 1
+    lines["type"] = 2
+    lines["count"] = 2
+    lines["coords"] = coords
+    data = lines.tobytes()
+    size = WKB_LINE.itemsize
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+# Seconds are counted from here, so the dates are exact in a float
+EPOCH = datetime.datetime(2000, 1, 1)
+
+
+class MovementBuilder(object):
+    """
+    Build movements from batches of location rows.
+
+    The location rows are (projectid, animalid, fixid, fixdate, lat, lon),
+    ordered by project, animal and fix date across all the batches.
+    """
+
+    # pylint: disable=useless-object-inheritance,too-few-public-methods
+
+    def __init__(self):
+        self.last = None
+
+    def add(self, rows):
+        """
+        Return the movements that end at the location rows.
+
+        Return a list of the movement keys (projectid, animalid, startdate,
+        enddate), and an (n, 7) array of the duration, distance, speed, and
+        the start and end vertices (lon1, lat1, lon2, lat2) of each movement.
+        The shapes (which take much longer to make) are made by rows() for
+        just the movements that are needed.
+        """
+        if self.last is not None:
+            rows = [self.last] + list(rows)
+        if not rows:
+            return [], np.zeros((0, 7))
+        self.last = rows[-1]
+        count = len(rows)
+        codes = {}
+        animals = np.fromiter(
+            (codes.setdefault((row[0], row[1]), len(codes)) for row in rows),
+            dtype=np.int64,
+            count=count,
+        )
+        start = np.nonzero(animals[:-1] == animals[1:])[0]
+        end = start + 1
+        lat = np.fromiter((row[4] for row in rows), dtype=float, count=count)
+        lon = np.fromiter((row[5] for row in rows), dtype=float, count=count)
+        seconds = np.fromiter(
+            ((row[3] - EPOCH).total_seconds() for row in rows), dtype=float, count=count
+        )
+        seconds = seconds[end] - seconds[start]
+        meters = geodesic_meters(lat[start], lon[start], lat[end], lon[end])
+        keep = (seconds > 0) & (meters > 0)
+        start, end = start[keep], end[keep]
+        duration = seconds[keep] / Config.seconds_per_duration
+        distance = meters[keep] / Config.meters_per_distance
+        values = np.column_stack(
+            [
+                duration,
+                distance,
+                distance / duration,
+                lon[start],
+                lat[start],
+                lon[end],
+                lat[end],
+            ]
+        )
+        keys = [
+            (rows[i][0], rows[i][1], rows[i][3], rows[j][3])
+            for i, j in zip(start.tolist(), end.tolist())
+        ]
+        return keys, values
+
+
+def movement_rows(keys, values, binary=False):
+    """
+    Return the movement rows for the keys and values from MovementBuilder.add().
+
+    The rows are (projectid, animalid, startdate, enddate, duration,
+    distance, speed, shape), as read from the Movements table.  The shapes
+    are WKB (bytes) if binary, otherwise WKT.
+    """
+    coords = values[:, 3:7]
+    shapes = line_wkbs(coords) if binary else line_texts(coords)
+    return [
+        tuple(key) + tuple(numbers) + (shape,)
+        for key, numbers, shape in zip(keys, values[:, 0:3].tolist(), shapes)
+    ]
+
+
+def lines(values):
+    """Return the (n, 2, 2) vertices (lon, lat) of the values from add()."""
+
+    return values[:, 3:7].reshape(-1, 2, 2)
+
+
+def content_hashes(values):
+    """Return the MD5 hash (bytes) of each row of values from add()."""
+
+    if not len(values):
+        return []
+    data = np.ascontiguousarray(values, dtype="<f8").tobytes()
+    size = 8 * values.shape[1]
+    return [hashlib.md5(data[i : i + size]).digest() for i in range(0, len(data), size)]
+
+
+def compare(derived, server):
+    """
+    Print the differences between the derived and server movement rows.
+
+    Both are lists of (projectid, animalid, startdate, enddate, duration,
+    distance, speed, ...) rows.  Return the number of movements that are
+    missing on either side or differ by more than the tolerances in Config.
+    """
+    derived = dict((tuple(row[:4]), row) for row in derived)
+    server = dict((tuple(row[:4]), row) for row in server)
+    keys = sorted(set(derived) & set(server))
+    only_derived = len(derived) - len(keys)
+    only_server = len(server) - len(keys)
+    problems = only_derived + only_server
+    print(
+        "{0} movements match keys; {1} only derived; {2} only in Movements".format(
+            len(keys), only_derived, only_server
+        )
+    )
+    if not keys:
+        return problems
+    ours = np.array([derived[key][4:7] for key in keys], dtype=float)
+    theirs = np.array([server[key][4:7] for key in keys], dtype=float)
+    error = np.abs(ours - theirs)
+    names = ["Duration", "Distance", "Speed"]
+    for column, name in enumerate(names):
+        print(
+            "{0}: max difference {1:.6g} (max relative {2:.3g})".format(
+                name,
+                error[:, column].max(),
+                (error[:, column] / np.maximum(np.abs(theirs[:, column]), 1e-12)).max(),
+            )
+        )
+    # Speed follows from the other two
+    bad = (error[:, 0] > Config.duration_tolerance) | (
+        error[:, 1] > Config.distance_tolerance
+    )
+    return problems + int(bad.sum())
+
+
+def synthetic_locations(animals, fixes, seed=1):
+    """Return a list of location rows for animals, each with fixes random walk fixes."""
+
+    rand = np.random.RandomState(seed)
+    start = datetime.datetime(2015, 5, 1)
+    rows = []
+    for animal in range(animals):
+        lat = 58.5 + np.cumsum(rand.normal(0, 0.01, fixes))
+        lon = -154.5 + np.cumsum(rand.normal(0, 0.02, fixes))
+        for i, (y, x) in enumerate(zip(lat.tolist(), lon.tolist())):
+            date = start + datetime.timedelta(hours=2 * i)
+            rows.append(("TEST", "{0:03d}".format(animal), i, date, y, x))
+    return rows
+
+
+def check_speed(fixes=1000000, animals=100, batch_size=10000):
+    """Time building the movements for fixes synthetic fixes in batches."""
+
+    rows = synthetic_locations(animals, fixes // animals)
+    builder = MovementBuilder()
+    batches = []
+    start = time.time()
+    for i in range(0, len(rows), batch_size):
+        batches.append(builder.add(rows[i : i + batch_size]))
+    count = sum(len(keys) for keys, _ in batches)
+    print(
+        "Built {0} movements from {1} fixes in {2:.2f} sec".format(
+            count, len(rows), time.time() - start
+        )
+    )
+    start = time.time()
+    for _, values in batches:
+        content_hashes(values)
+    print("Hashed {0} movements in {1:.2f} sec".format(count, time.time() - start))
+    for binary in (True, False):
+        start = time.time()
+        for keys, values in batches:
+            movement_rows(keys, values, binary)
+        print(
+            "Made {0} movement rows ({1}) in {2:.2f} sec".format(
+                count, "WKB" if binary else "WKT", time.time() - start
+            )
+        )
+
+
+def main(project=None):
+    """Compare the movements built from the locations of project with the server."""
+
+    # upload imports this module, so it is only imported when run as a script
+    # pylint: disable=import-outside-toplevel
+    import upload
+
+    connection = upload.get_connection_or_die(
+        upload.Config.am_server, upload.Config.am_database
+    )
+    projects = [project] if project else upload.Config.projects
+    problems = 0
+    try:
+        for name in projects:
+            print("Project", name)
+            sql = """
+                select l.ProjectId, l.AnimalId, l.FixId, l.FixDate,
+                l.Location.Lat, l.Location.Long from Locations as l
+                where l.ProjectId = '{0}' and l.[status] IS NULL
+                order by l.ProjectId, l.AnimalId, l.FixDate
+            """
+            builder = MovementBuilder()
+            derived = []
+            for rows in upload.fetch_batches(connection, sql.format(name), 10000):
+                keys, values = builder.add(rows)
+                derived += [key + tuple(row) for key, row in zip(keys, values.tolist())]
+            sql = """
+                select ProjectId, AnimalId, StartDate, EndDate, Duration, Distance, Speed
+                from Movements where ProjectId = '{0}' and Distance > 0
+            """
+            server = upload.fetch_rows(connection, sql.format(name))
+            if server is None:
+                return
+            problems += compare(derived, server)
+    finally:
+        connection.close()
+    if problems:
+        print("{0} movements are missing or differ.".format(problems))
+    else:
+        print("The derived movements match the Movements table.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time (or check) building movements from locations."
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="compare with the Movements table of the upload.py projects",
+    )
+    parser.add_argument("--project", help="the project to compare (with --compare)")
+    args = parser.parse_args()
+    if args.compare:
+        main(args.project)
+    else:
+        check_speed()
@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+"""
+Find and repair drift between the Carto tables and the tracking tables.
+
+`upload.py` trusts the tracking tables (`Locations_In_CartoDB` and
+`Movements_In_CartoDB`) to know what is in Carto.  If they disagree (a row
+was edited in Carto by hand, a run failed in an unexpected way, ...), rows
+can be missing from Carto, or be in Carto twice.
+
+Comparing millions of keys one by one is slow, so the keys are compared in
+buckets.  Each side counts and hashes its keys with one grouped query; first
+by (project, animal), then by (project, animal, day) for the animals that
+differ, and then key by key for the days that differ.  The hash of a bucket
+is the sum of the hashes of its keys, so it does not depend on the order of
+the rows, and it changes when a key is missing or duplicated.
+
+The keys that differ are repaired by deleting them from Carto and from the
+tracking table; then just the rows with those keys that should be published
+are read (as `upload.py` reads new rows) and sent once.  Only the default
+target (`Config.base_url` in `upload.py`) is checked.
+
+Tracked locations that are no longer in the `Locations` table have no
+project, animal, or date in SQL Server, so they are found as extra rows in
+Carto (and removed).  Movement dates are compared in whole milliseconds
+(truncated the same way on both sides), and untracked by the range of their
+millisecond.
+
+Usage: `python reconcile.py [--check]`
+
+Third party requirements:
+* pyodbc - https://pypi.python.org/pypi/pyodbc - for SQL Server
+* carto - https://pypi.python.org/pypi/carto  (imported by upload.py)
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import collections
+import datetime
+
+from carto.sql import CartoException
+import pyodbc
+
+import batch_journal
+import upload
+
+# Key hashes are integers in [0, MODULUS), computed the same way in SQL Server
+# and Postgres with bigint arithmetic that can not overflow (MINSTD constants).
+MODULUS = 2147483647
+MULTIPLIER = 48271
+
+# Number of buckets in each drill down query.
+BUCKETS_PER_QUERY = 500
+
+BUCKET_COLUMNS = ["projectid", "animalid", "day"]
+
+
+def key_hash(columns):
+    """Return a SQL expression for the hash of the bigint column expressions."""
+
+    expression = "({0} % {1})".format(columns[0], MODULUS)
+    for column in columns[1:]:
+        expression = "(({0} * {1} + {2} % {3}) % {3})".format(
+            expression, MULTIPLIER, column, MODULUS
+        )
+    return expression
+
+
+def sqlserver_milliseconds(column):
+    """Return a SQL Server expression for the milliseconds since 1970 of column."""
+
+    return (
+        "(cast(datediff(day, '19700101', {0}) as bigint) * 86400000"
+        " + datediff(millisecond, cast({0} as date), {0}))"
+    ).format(column)
+
+
+def carto_milliseconds(column):
+    """
+    Return a Postgres expression for the milliseconds since 1970 of column.
+
+    Like datediff() in sqlserver_milliseconds(), a fraction of a millisecond
+    is truncated.  The seconds and the microseconds are extracted separately,
+    as the epoch (in floating point seconds) times 1000 is not always exact.
+    """
+    return (
+        "(cast(extract(epoch from date_trunc('second', {0})) as bigint) * 1000"
+        " + cast(floor(extract(microseconds from {0}) / 1000) as bigint) % 1000)"
+    ).format(column)
+
+
+# How to find the buckets and keys of each kind of row on each side.
+LOCATIONS = {
+    "name": "locations",
+    "keys": ["fixid"],
+    "sqlserver": {
+        "source": "Locations_In_CartoDB as c join Locations as t on t.FixId = c.fixid",
+        "projectid": "t.ProjectId",
+        "animalid": "t.AnimalId",
+        "day": "convert(char(10), t.FixDate, 126)",
+        "fixid": "c.fixid",
+        "hash": key_hash(["cast(c.fixid as bigint)"]),
+    },
+    "carto": {
+        "source": "animal_locations as t",
+        "projectid": "t.projectid",
+        "animalid": "t.animalid",
+        "day": "to_char(t.fixdate, 'YYYY-MM-DD')",
+        "fixid": "t.fixid",
+        "hash": key_hash(["cast(t.fixid as bigint)"]),
+    },
+}
+MOVEMENTS = {
+    "name": "movements",
+    "keys": ["start_ms", "end_ms"],
+    "sqlserver": {
+        "source": "Movements_In_CartoDB as t",
+        "projectid": "t.ProjectId",
+        "animalid": "t.AnimalId",
+        "day": "convert(char(10), t.StartDate, 126)",
+        "start_ms": sqlserver_milliseconds("t.StartDate"),
+        "end_ms": sqlserver_milliseconds("t.EndDate"),
+        "hash": key_hash(
+            [sqlserver_milliseconds("t.StartDate"), sqlserver_milliseconds("t.EndDate")]
+        ),
+    },
+    "carto": {
+        "source": "animal_movements as t",
+        "projectid": "t.projectid",
+        "animalid": "t.animalid",
+        "day": "to_char(t.startdate, 'YYYY-MM-DD')",
+        "start_ms": carto_milliseconds("t.startdate"),
+        "end_ms": carto_milliseconds("t.enddate"),
+        "hash": key_hash(
+            [carto_milliseconds("t.startdate"), carto_milliseconds("t.enddate")]
+        ),
+    },
+}
+
+
+def grouped_sql(side, names, buckets=None):
+    """
+    Return SQL to count and hash the keys on side grouped by the column names.
+
+    side is the "sqlserver" or "carto" dictionary of a kind.  If buckets is not
+    None, only the rows in those buckets (tuples of values for the first
+    columns in names) are included.
+    """
+    columns = ", ".join("{0} as {1}".format(side[name], name) for name in names)
+    sql = "select {0}, count(*) as n, sum({1}) as h from {2}".format(
+        columns, side["hash"], side["source"]
+    )
+    if buckets is not None:
+        width = len(buckets[0])
+        values = ",".join(
+            "(" + ",".join("'{0}'".format(value) for value in bucket) + ")"
+            for bucket in buckets
+        )
+        join = " and ".join(
+            "d.{0} = {1}".format(name, side[name]) for name in names[:width]
+        )
+        sql += " join (values {0}) as d ({1}) on {2}".format(
+            values, ", ".join(names[:width]), join
+        )
+    return sql + " group by " + ", ".join(side[name] for name in names)
+
+
+def fetch_groups(connection, carto, kind, names, buckets=None):
+    """
+    Return the SQL Server and Carto {group: (count, hash)} dictionaries.
+
+    The groups are tuples of values for the column names.  With buckets, the
+    queries are sent in chunks.
+    """
+    here, there = {}, {}
+    parts = [None] if buckets is None else upload.chunks(buckets, BUCKETS_PER_QUERY)
+    for part in parts:
+        rows = upload.fetch_rows(
+            connection, grouped_sql(kind["sqlserver"], names, part)
+        )
+        if rows is None:
+            raise pyodbc.Error("Unable to read the {0} buckets".format(kind["name"]))
+        for row in rows:
+            here[tuple(row[: len(names)])] = (row[-2], int(row[-1]))
+        response = carto.send(grouped_sql(kind["carto"], names, part))
+        for row in response["rows"]:
+            group = tuple(row[name] for name in names)
+            there[group] = (row["n"], int(row["h"]))
+    return here, there
+
+
+def differing(here, there):
+    """Return a sorted list of the groups that are not the same in both."""
+
+    groups = set(here) | set(there)
+    return sorted(group for group in groups if here.get(group) != there.get(group))
+
+
+def find_drift(connection, carto, kind):
+    """
+    Return a list of the keys of kind that differ between SQL Server and carto.
+
+    Each key is a tuple of (projectid, animalid, day) and the key columns of
+    kind.  Drill down from animals to days to keys, only into the buckets that
+    differ.
+    """
+    buckets = None
+    for width, label in [(2, "animals"), (3, "days")]:
+        here, there = fetch_groups(
+            connection, carto, kind, BUCKET_COLUMNS[:width], buckets
+        )
+        buckets = differing(here, there)
+        print(
+            "{0}: {1} of {2} {3} differ.".format(
+                kind["name"], len(buckets), len(set(here) | set(there)), label
+            )
+        )
+        if not buckets:
+            return []
+    here, there = fetch_groups(
+        connection, carto, kind, BUCKET_COLUMNS + kind["keys"], buckets
+    )
+    keys = differing(here, there)
+    missing = sum(1 for key in keys if here.get(key, (0,))[0] > there.get(key, (0,))[0])
+    print(
+        "{0}: {1} keys differ ({2} missing from Carto, {3} extra in Carto).".format(
+            kind["name"], len(keys), missing, len(keys) - missing
+        )
+    )
+    return keys
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def milliseconds_to_datetime(milliseconds):
+    """Return the datetime for the milliseconds since 1970."""
+
+    return EPOCH + datetime.timedelta(milliseconds=milliseconds)
+
+
+def datetime_to_milliseconds(value):
+    """Return the whole milliseconds since 1970 of the datetime value."""
+
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+
+def repair_locations(connection, carto, keys):
+    """Delete the location keys from carto and the tracking table."""
+
+    fids = [key[3] for key in keys]
+    sql = "delete from animal_locations where fixid in ({0})"
+    upload.RequestSizer().send(carto, sql, ["{0}".format(fid) for fid in fids])
+    upload.remove_locations_from_carto_tracking_table(connection, fids)
+
+
+def repair_movements(connection, carto, keys):
+    """
+    Delete the movement keys from carto and the tracking table.
+
+    The days of the keys are saved in the batch journal, so their animal
+    tracks are rebuilt after the rows are sent again (see resend()).
+    """
+    journal = batch_journal.BatchJournal()
+    try:
+        journal.add_days(upload.track_days(upload.MOVEMENTS, keys))
+    finally:
+        journal.close()
+
+    sql = """
+        delete from animal_movements as t using (values {0})
+        as d (projectid, animalid, start_ms, end_ms)
+        where t.projectid = d.projectid and t.animalid = d.animalid
+        and {1} = d.start_ms and {2} = d.end_ms
+    """.format(
+        "{0}",
+        carto_milliseconds("t.startdate"),
+        carto_milliseconds("t.enddate"),
+    )
+    values = ["('{0}','{1}',{3},{4})".format(*key) for key in keys]
+    upload.RequestSizer().send(carto, sql, values)
+    untrack_movements(connection, keys)
+
+
+def untrack_movements(connection, keys):
+    """
+    Execute SQL to delete the movement keys from the tracking table.
+
+    The keys have dates in whole milliseconds (see sqlserver_milliseconds()),
+    so a tracked date with a fraction of a millisecond is not equal to the
+    date of its key; each date is matched with the range of the millisecond
+    it was truncated to instead.
+    """
+    if not keys:
+        return
+    table = upload.tracking_table("Movements")
+    w_cursor = connection.cursor()
+    w_cursor.execute(
+        """
+        if object_id('tempdb..#Movements_To_Untrack') is not null
+          drop table #Movements_To_Untrack
+        create table #Movements_To_Untrack (
+          ProjectId varchar(16) NOT NULL,
+          AnimalId varchar(16) NOT NULL,
+          StartDate datetime2(7) NOT NULL,
+          EndDate datetime2(7) NOT NULL)
+    """
+    )
+    sql = """
+        insert into #Movements_To_Untrack
+        (projectid, animalid, startdate, enddate) values (?, ?, ?, ?)
+    """
+    rows = [
+        (
+            key[0],
+            key[1],
+            milliseconds_to_datetime(key[3]),
+            milliseconds_to_datetime(key[4]),
+        )
+        for key in keys
+    ]
+    upload.execute_many(w_cursor, sql, rows)
+    sql = """
+        delete c from {0} as c
+        join #Movements_To_Untrack as r
+        on r.ProjectId = c.ProjectId and r.AnimalId = c.AnimalId
+        and c.StartDate >= r.StartDate
+        and c.StartDate < dateadd(millisecond, 1, r.StartDate)
+        and c.EndDate >= r.EndDate
+        and c.EndDate < dateadd(millisecond, 1, r.EndDate)
+        drop table #Movements_To_Untrack
+    """
+    w_cursor.execute(sql.format(table))
+    w_cursor.commit()
+
+
+class RepairKeys(object):
+    """
+    A stand-in for the key cache (`upload.KEYS`) with all but the drift keys.
+
+    While it is the key cache, `upload.py` reads just the rows with the keys
+    that differ as unpublished, instead of every untracked row.
+    """
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self, drift):
+        self.keys = {
+            "locations": set(key[3] for key in drift["locations"]),
+            "movements": set(
+                (key[0], key[1], key[3], key[4]) for key in drift["movements"]
+            ),
+        }
+
+    def is_open(self):
+        """Return True; the keys are always available."""
+
+        return True
+
+    def unpublished(self, kind, keys):
+        """Return the keys (from SQL Server) of kind that are being repaired."""
+
+        if kind == "locations":
+            return [key for key in keys if key[0] in self.keys[kind]]
+        return [
+            key
+            for key in keys
+            if (
+                key[0],
+                key[1],
+                datetime_to_milliseconds(key[2]),
+                datetime_to_milliseconds(key[3]),
+            )
+            in self.keys[kind]
+        ]
+
+    def add(self, kind, keys):
+        """Ignore the keys sent; the key cache is read again after a repair."""
+
+        # pylint: disable=unused-argument
+
+
+def resend(reader, writer, carto, drift):
+    """
+    Send the rows with the drift keys that should be published to carto.
+
+    The rows are read on the SQL Server reader connection as new rows are by
+    `upload.py` (only for the projects in Config.projects), and tracked on
+    the writer connection.  The derived movements of a project (see
+    Config.derive_movements) are built for the whole project, and the
+    untracked ones are sent.  The animal tracks of the changed days are
+    rebuilt if Config.update_tracks is True.
+    Return the number of errors.
+    """
+    projects = set(key[0] for keys in drift.values() for key in keys)
+    projects = [project for project in upload.Config.projects if project in projects]
+    journal = upload.Target().journal()
+    key_cache = upload.KEYS
+    upload.KEYS = RepairKeys(drift)
+    errors = 0
+    try:
+        for project in projects:
+            index = None
+            if upload.use_python_boundaries():
+                index = upload.get_boundary_indexes(reader, project).get(project)
+            locations = upload.get_locations_for_carto(reader, project, None, index)
+            if upload.derive_movements(project):
+                vectors = upload.derive_vectors_for_carto(reader, project, None, index)
+            else:
+                vectors = upload.get_vectors_for_carto(reader, project, None, index)
+            for kind, batches in [
+                (upload.LOCATIONS, locations),
+                (upload.MOVEMENTS, vectors),
+            ]:
+                errors += upload.send_batches(writer, carto, kind, batches, journal)[1]
+        if upload.Config.update_tracks:
+            errors += upload.update_tracks(carto, journal)
+    finally:
+        upload.KEYS = key_cache
+        journal.close()
+    return errors
+
+
+def reconcile(check_only=False):
+    """
+    Compare the Carto tables with the tracking tables and repair any drift.
+
+    If check_only is True, only report the drift.
+    Return the number of keys that differ.
+    """
+    carto_conn = upload.get_auth_carto_sql_connection()
+    am_conn = upload.get_connection_or_die(
+        upload.Config.am_server, upload.Config.am_database
+    )
+    drift = collections.OrderedDict()
+    try:
+        drift["locations"] = find_drift(am_conn, carto_conn, LOCATIONS)
+        drift["movements"] = find_drift(am_conn, carto_conn, MOVEMENTS)
+        if check_only or not any(drift.values()):
+            return sum(len(keys) for keys in drift.values())
+        repair_movements(am_conn, carto_conn, drift["movements"])
+        repair_locations(am_conn, carto_conn, drift["locations"])
+        # The tracking tables were changed, so the key cache must be read again
+        if upload.KEYS is not None:
+            upload.KEYS.invalidate()
+        print("Removed the differing keys; sending them again.")
+        writer = upload.get_connection_or_die(
+            upload.Config.am_server, upload.Config.am_database
+        )
+        try:
+            if resend(am_conn, writer, carto_conn, drift):
+                print("Not all of the differing keys were sent; run a sync.")
+        finally:
+            writer.close()
+    except CartoException as ex:
+        print("Carto error ocurred", ex)
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+    finally:
+        am_conn.close()
+    return sum(len(keys) for keys in drift.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find and repair differences between Carto and the tracking tables."
+    )
+    parser.add_argument(
+        "--check", action="store_true", help="only report the differences"
+    )
+    reconcile(check_only=parser.parse_args().check)
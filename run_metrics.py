@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and counters for the stages of an `upload.py` run.
+
+Each stage of a run (a SQL Server query, formatting rows, a request to Carto,
+a write to the tracking tables, ...) adds its duration, number of calls,
+rows, bytes, and errors to a RunMetrics object.  Stages may have labels
+(e.g. the kind of row and the project), and the totals are kept for each
+stage and set of labels.
+
+At the end of a run the metrics are saved in two forms:
+
+* A JSON record of the run, appended as one line to a log file, so the history
+  of runs can be compared.
+* A text file in the Prometheus exposition format, for the node_exporter
+  textfile collector, so a dashboard can track trends.  The file is replaced
+  atomically so that a partial file is never collected.
+
+No third party requirements.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import contextlib
+import io
+import json
+import os
+import threading
+import time
+
+# The prefix of all Prometheus metric names
+PREFIX = "am2cartodb"
+
+# UTC date and time format for the run record
+ISO_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# The totals kept for each stage, and their Prometheus help text
+FIELDS = collections.OrderedDict(
+    [
+        ("seconds", "Seconds spent in the stage during the last run."),
+        ("calls", "Number of times the stage ran during the last run."),
+        ("rows", "Rows handled by the stage during the last run."),
+        ("bytes", "Bytes handled by the stage during the last run."),
+        ("errors", "Errors in the stage during the last run."),
+    ]
+)
+
+# The items in the summary of a run, and their Prometheus help text
+RUN_FIELDS = collections.OrderedDict(
+    [
+        ("seconds", "Seconds taken by the last run."),
+        ("errors", "Errors in the last run."),
+        ("locations", "Locations sent to Carto in the last run."),
+        ("movements", "Movements sent to Carto in the last run."),
+        ("updated", "Changed rows updated in Carto in the last run."),
+        ("removed", "Rows removed from Carto in the last run."),
+        ("end_timestamp_seconds", "When the last run ended (Unix time)."),
+    ]
+)
+
+
+def label_text(labels):
+    """Return the (name, value) label pairs in the Prometheus format: {a="x"}."""
+
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = "{0}".format(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append('{0}="{1}"'.format(name, value.replace("\n", "\\n")))
+    return "{" + ",".join(pairs) + "}"
+
+
+def replace_file(text, path):
+    """Write text to the file at path by replacing it (atomically, if possible)."""
+
+    temp = path + ".tmp"
+    with io.open(temp, "w", encoding="utf-8", newline="\n") as out_file:
+        out_file.write(text)
+    try:
+        os.replace(temp, path)
+    except AttributeError:
+        # Python 2
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+
+
+class RunMetrics(object):
+    """Totals for each stage of a run.  Safe to use from several threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.stages = collections.OrderedDict()
+
+    def reset(self):
+        """Forget all the stages, and start timing a new run."""
+
+        with self.lock:
+            self.start = time.time()
+            self.stages = collections.OrderedDict()
+
+    def add(self, stage, seconds=0.0, rows=0, size=0, errors=0, calls=1, **labels):
+        """Add to the totals for stage and labels."""
+
+        key = (stage, tuple(sorted(labels.items())))
+        with self.lock:
+            totals = self.stages.get(key)
+            if totals is None:
+                totals = dict((field, 0) for field in FIELDS)
+                self.stages[key] = totals
+            totals["seconds"] += seconds
+            totals["calls"] += calls
+            totals["rows"] += rows
+            totals["bytes"] += size
+            totals["errors"] += errors
+
+    @contextlib.contextmanager
+    def timer(self, stage, **labels):
+        """
+        Time the with block as a call to stage.
+
+        The block can set "rows", "size" and "errors" in the yielded dictionary.
+        An exception in the block is counted as an error (and raised again).
+        """
+        counts = {"rows": 0, "size": 0, "errors": 0}
+        start = time.time()
+        try:
+            yield counts
+        except Exception:
+            counts["errors"] += 1
+            raise
+        finally:
+            self.add(
+                stage,
+                time.time() - start,
+                counts["rows"],
+                counts["size"],
+                counts["errors"],
+                **labels
+            )
+
+    def timed(self, batches, stage, **labels):
+        """
+        Yield the lists in batches, timing how long each takes to produce.
+
+        Each list is a call to stage, and its length is the number of rows.
+        """
+        iterator = iter(batches)
+        while True:
+            start = time.time()
+            try:
+                rows = next(iterator)
+            except StopIteration:
+                # Finding there are no more rows can take time too
+                self.add(stage, time.time() - start, calls=0, **labels)
+                return
+            except Exception:
+                self.add(stage, time.time() - start, errors=1, **labels)
+                raise
+            self.add(stage, time.time() - start, rows=len(rows), **labels)
+            yield rows
+
+    def observe_request(self, timing):
+        """Add a carto_transport request timing to the "carto_request" stage."""
+
+        self.add(
+            "carto_request",
+            timing["seconds"],
+            size=(timing["bytes_sent"] or 0) + (timing["bytes_received"] or 0),
+            errors=int(timing["status"] >= 400),
+            method=timing["method"],
+        )
+
+    def record(self, **summary):
+        """Return a JSON serializable record of the run with the summary items."""
+
+        with self.lock:
+            stages = [
+                dict(stage=stage, labels=dict(labels), **totals)
+                for (stage, labels), totals in self.stages.items()
+            ]
+        end = time.time()
+        record = collections.OrderedDict()
+        record["start"] = time.strftime(ISO_FORMAT, time.gmtime(self.start))
+        record["end"] = time.strftime(ISO_FORMAT, time.gmtime(end))
+        record["seconds"] = end - self.start
+        record.update(summary)
+        record["stages"] = stages
+        return record
+
+    def write_json(self, record, path):
+        """Append the run record as one line of JSON to the file at path."""
+
+        with io.open(path, "a", encoding="utf-8") as out_file:
+            out_file.write("{0}\n".format(json.dumps(record, default=str)))
+
+    def write_prometheus(self, record, path):
+        """Replace the file at path with the run record in the Prometheus format."""
+
+        lines = []
+        values = dict(record)
+        values["end_timestamp_seconds"] = time.time()
+        for field, text in RUN_FIELDS.items():
+            name = "{0}_run_{1}".format(PREFIX, field)
+            lines.append("# HELP {0} {1}".format(name, text))
+            lines.append("# TYPE {0} gauge".format(name))
+            lines.append("{0} {1!r}".format(name, float(values.get(field, 0))))
+        for field, text in FIELDS.items():
+            name = "{0}_stage_{1}".format(PREFIX, field)
+            lines.append("# HELP {0} {1}".format(name, text))
+            lines.append("# TYPE {0} gauge".format(name))
+            for stage in record["stages"]:
+                labels = [("stage", stage["stage"])] + sorted(stage["labels"].items())
+                lines.append(
+                    "{0}{1} {2!r}".format(name, label_text(labels), float(stage[field]))
+                )
+        replace_file("\n".join(lines) + "\n", path)
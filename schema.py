@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned schema of the Carto tables and the SQL Server tracking tables.
+
+`upload.py` creates the tables (see `make_carto_tables()` and
+`make_sqlserver_tables()`), but the sync also depends on indexes:
+
+* Carto: unique indexes on the keys used to remove and recover rows
+  (`fixid` for locations and (projectid, animalid, startdate, enddate) for
+  movements) and on the key of the animal tracks, which also prevent
+  duplicate rows; and indexes on the dates used by the map and the queries
+  in `testing.py`.
+* SQL Server: primary keys on the tracking tables, and the content hash
+  (`RowHash`) of each tracked row, used to find rows that were corrected
+  after they were published (see `Config.update_changed_rows`).
+
+Changes to the schema are numbered migrations.  Each side has a table with
+the migrations that have been applied (`am2cartodb_schema` in Carto and
+`CartoDB_Schema_Version` in SQL Server), and migrating applies the missing
+ones in order, each in one transaction.  A unique index can not be created
+if there are already duplicate keys; run `reconcile.py` to remove them first.
+
+The date indexes are not needed to sync, and slow down a big load, so they
+can be dropped before a bulk load and built again after it (see
+`upload.py --full --defer-indexes`).
+
+Usage: `python schema.py [--check]`.  Without `--check`, the missing
+migrations are applied; with it, the version and any drift (missing
+indexes or keys) is reported.  Every target in `upload.py` is migrated
+(and checked).
+
+Third party requirements:
+* pyodbc - https://pypi.python.org/pypi/pyodbc - for SQL Server
+* carto - https://pypi.python.org/pypi/carto
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+
+from carto.sql import CartoException
+import pyodbc
+
+# The Carto indexes: (name, table, columns, unique, deferrable)
+# A deferrable index is not used by the sync (see drop_deferred_indexes())
+CARTO_INDEXES = [
+    ("animal_locations_fixid_key", "animal_locations", "fixid", True, False),
+    (
+        "animal_movements_key",
+        "animal_movements",
+        "projectid, animalid, startdate, enddate",
+        True,
+        False,
+    ),
+    ("animal_tracks_key", "animal_tracks", "projectid, animalid, day", True, False),
+    ("animal_locations_fixdate_idx", "animal_locations", "fixdate", False, True),
+    ("animal_movements_startdate_idx", "animal_movements", "startdate", False, True),
+]
+
+# The SQL Server tables of each target that must have a primary key; the
+# names for the targets other than the default end with "_" and the target
+# name (see upload.Target)
+TARGET_KEYED_TABLES = [
+    "Locations_In_CartoDB",
+    "Movements_In_CartoDB",
+    "CartoDB_Boundary_State",
+]
+
+# The SQL Server tables that must have a primary key
+SQLSERVER_KEYED_TABLES = TARGET_KEYED_TABLES + ["CartoDB_Sync_State"]
+
+# The SQL Server columns added by a migration: (table, column, definition)
+SQLSERVER_COLUMNS = [
+    ("Locations_In_CartoDB", "RowHash", "binary(16) NULL"),
+    ("Movements_In_CartoDB", "RowHash", "binary(16) NULL"),
+]
+
+
+# The SQL to create the table of animal tracks (see update_tracks() in
+# `upload.py`) if it does not exist.  cdb_cartodbfytable() adds the columns
+# Carto needs (cartodb_id and the_geom); it does nothing to a table that has
+# them.  The user's schema is first in the search path.
+TRACK_TABLE_SQL = [
+    """
+        create table if not exists animal_tracks
+        (projectid text NOT NULL, animalid text NOT NULL, day date NOT NULL,
+        startdate timestamp NOT NULL, enddate timestamp NOT NULL,
+        movements int NOT NULL, distance real NOT NULL)
+    """,
+    "select cdb_cartodbfytable(current_schema()::text, 'animal_tracks')",
+]
+
+
+def index_sql(index):
+    """Return the SQL to create a CARTO_INDEXES index if it does not exist."""
+
+    name, table, columns, unique, _ = index
+    return "create {0}index if not exists {1} on {2} ({3})".format(
+        "unique " if unique else "", name, table, columns
+    )
+
+
+def carto_index_sql(tables):
+    """Return the SQL to create the CARTO_INDEXES on the tables."""
+
+    return [index_sql(index) for index in CARTO_INDEXES if index[1] in tables]
+
+
+def primary_key_sql(table, columns):
+    """Return SQL Server SQL to add a primary key to table if it has none."""
+
+    sql = """
+        if objectproperty(object_id('{0}'), 'TableHasPrimaryKey') = 0
+          alter table {0} add constraint PK_{0} primary key clustered ({1})
+    """
+    return sql.format(table, columns)
+
+
+def add_column_sql(column):
+    """Return SQL Server SQL to add a SQLSERVER_COLUMNS column if it is missing."""
+
+    sql = """
+        if col_length('{0}', '{1}') is null
+          alter table {0} add {1} {2}
+    """
+    return sql.format(*column)
+
+
+# The migrations for each side: (version, description, list of SQL statements)
+CARTO_MIGRATIONS = [
+    (
+        1,
+        "Index the keys and dates of the locations and movements",
+        carto_index_sql(["animal_locations", "animal_movements"]),
+    ),
+    (
+        2,
+        "Create the animal tracks table, and index its key",
+        TRACK_TABLE_SQL + carto_index_sql(["animal_tracks"]),
+    ),
+]
+SQLSERVER_MIGRATIONS = [
+    (
+        1,
+        "Add any missing primary keys to the tracking tables",
+        [
+            primary_key_sql("Locations_In_CartoDB", "fixid"),
+            primary_key_sql(
+                "Movements_In_CartoDB", "ProjectId, AnimalId, StartDate, EndDate"
+            ),
+        ],
+    ),
+    (
+        2,
+        "Add the content hash of each row to the tracking tables",
+        [add_column_sql(column) for column in SQLSERVER_COLUMNS],
+    ),
+]
+
+
+def get_carto_version(carto):
+    """Return the last migration applied to carto; 0 if none."""
+
+    sql = "select to_regclass('am2cartodb_schema') is not null as present"
+    if not carto.send(sql)["rows"][0]["present"]:
+        return 0
+    sql = "select coalesce(max(version), 0) as version from am2cartodb_schema"
+    return carto.send(sql)["rows"][0]["version"]
+
+
+def migrate_carto(carto):
+    """
+    Apply the missing CARTO_MIGRATIONS to carto, in order.
+
+    Return the number of errors (0 or 1); stop at the first error.
+    """
+    try:
+        carto.send(
+            """
+            create table if not exists am2cartodb_schema
+            (version int primary key, description text not null,
+            applied timestamp not null default now())
+        """
+        )
+        version = get_carto_version(carto)
+        for number, description, statements in CARTO_MIGRATIONS:
+            if number <= version:
+                continue
+            record = "insert into am2cartodb_schema values ({0}, '{1}')"
+            statements = statements + [record.format(number, description)]
+            # The statements in a request are run in one transaction.
+            carto.send(";\n".join(statements))
+            print("Applied Carto migration {0}: {1}".format(number, description))
+    except CartoException as ex:
+        print("Carto error ocurred", ex)
+        print("Unable to migrate the Carto schema (duplicate keys? see reconcile.py)")
+        return 1
+    return 0
+
+
+def get_sqlserver_version(connection):
+    """Return the last migration applied to the SQL Server connection; 0 if none."""
+
+    sql = """
+        if object_id('CartoDB_Schema_Version') is null select 0
+        else select coalesce(max(Version), 0) from CartoDB_Schema_Version
+    """
+    r_cursor = connection.cursor()
+    try:
+        return r_cursor.execute(sql).fetchone()[0]
+    finally:
+        r_cursor.close()
+
+
+def migrate_sqlserver(connection):
+    """
+    Apply the missing SQLSERVER_MIGRATIONS on the SQL Server connection.
+
+    Return the number of errors (0 or 1); stop at the first error.
+    """
+    w_cursor = connection.cursor()
+    try:
+        w_cursor.execute(
+            """
+            if object_id('CartoDB_Schema_Version') is null
+              create table CartoDB_Schema_Version (
+                Version int NOT NULL PRIMARY KEY,
+                Description varchar(200) NOT NULL,
+                AppliedDate datetime2(7) NOT NULL)
+        """
+        )
+        w_cursor.commit()
+        version = get_sqlserver_version(connection)
+        for number, description, statements in SQLSERVER_MIGRATIONS:
+            if number <= version:
+                continue
+            for sql in statements:
+                w_cursor.execute(sql)
+            w_cursor.execute(
+                """
+                insert into CartoDB_Schema_Version (Version, Description, AppliedDate)
+                values (?, ?, sysdatetime())
+            """,
+                number,
+                description,
+            )
+            w_cursor.commit()
+            print("Applied SQL Server migration {0}: {1}".format(number, description))
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        print("Unable to migrate the SQL Server schema.")
+        w_cursor.rollback()
+        return 1
+    finally:
+        w_cursor.close()
+    return 0
+
+
+def check_carto(carto):
+    """Return a list of the differences between carto and the expected schema."""
+
+    drift = []
+    version = get_carto_version(carto)
+    if version < CARTO_MIGRATIONS[-1][0]:
+        drift.append(
+            "Carto schema is at version {0} of {1}".format(
+                version, CARTO_MIGRATIONS[-1][0]
+            )
+        )
+    tables = ",".join(
+        "'{0}'".format(table) for table in set(index[1] for index in CARTO_INDEXES)
+    )
+    sql = "select indexname from pg_indexes where tablename in ({0})".format(tables)
+    present = set(row["indexname"] for row in carto.send(sql)["rows"])
+    for name, table, _, _, deferrable in CARTO_INDEXES:
+        if name not in present:
+            note = " (deferred for a bulk load?)" if deferrable else ""
+            drift.append(
+                "Carto index {0} on {1} is missing{2}".format(name, table, note)
+            )
+    return drift
+
+
+def check_sqlserver(connection, suffix=""):
+    """
+    Return a list of the differences between SQL Server and the expected schema.
+
+    With a suffix (see upload.Target), only the tables of that target are
+    checked; they are made with their keys and columns, not migrated.
+    """
+    drift = []
+    tables = [table + suffix for table in TARGET_KEYED_TABLES]
+    if not suffix:
+        tables = SQLSERVER_KEYED_TABLES
+        version = get_sqlserver_version(connection)
+        if version < SQLSERVER_MIGRATIONS[-1][0]:
+            drift.append(
+                "SQL Server schema is at version {0} of {1}".format(
+                    version, SQLSERVER_MIGRATIONS[-1][0]
+                )
+            )
+    sql = "select objectproperty(object_id(?), 'TableHasPrimaryKey')"
+    r_cursor = connection.cursor()
+    try:
+        for table in tables:
+            keyed = r_cursor.execute(sql, table).fetchone()[0]
+            if keyed is None:
+                drift.append("SQL Server table {0} is missing".format(table))
+            elif not keyed:
+                drift.append("SQL Server table {0} has no primary key".format(table))
+        sql = "select col_length(?, ?)"
+        for table, column, _ in SQLSERVER_COLUMNS:
+            table += suffix
+            if r_cursor.execute(sql, table, column).fetchone()[0] is None:
+                drift.append(
+                    "SQL Server column {0}.{1} is missing".format(table, column)
+                )
+    finally:
+        r_cursor.close()
+    return drift
+
+
+def drop_deferred_indexes(carto):
+    """Drop the deferrable indexes in carto, before a bulk load."""
+
+    names = [index[0] for index in CARTO_INDEXES if index[4]]
+    carto.send(";\n".join("drop index if exists {0}".format(name) for name in names))
+
+
+def create_deferred_indexes(carto):
+    """Build the deferrable indexes in carto, after a bulk load."""
+
+    statements = [index_sql(index) for index in CARTO_INDEXES if index[4]]
+    carto.send(";\n".join(statements))
+
+
+def main(check_only=False):
+    """
+    Migrate (or with check_only, check) the Carto and SQL Server schemas.
+
+    The Carto schema of every target (see upload.Config.more_targets) is
+    migrated.  The SQL Server tables of the targets other than the default
+    are made if they are missing.
+    """
+
+    # upload imports this module, so it is only imported when run as a script
+    # pylint: disable=import-outside-toplevel
+    import upload
+
+    am_conn = upload.get_connection_or_die(
+        upload.Config.am_server, upload.Config.am_database
+    )
+    drift = []
+    try:
+        if not check_only:
+            migrate_sqlserver(am_conn)
+        for target in upload.get_targets():
+            label = upload.target_label(target)
+            carto_conn = upload.get_auth_carto_sql_connection(target=target)
+            if not check_only:
+                if not target.is_default:
+                    print("Migrating the schema{0}".format(label))
+                    upload.make_cartodb_tracking_tables(am_conn, target)
+                migrate_carto(carto_conn)
+            differences = check_carto(carto_conn)
+            differences += check_sqlserver(am_conn, target.suffix)
+            drift += [difference + label for difference in differences]
+    except CartoException as ex:
+        print("Carto error ocurred", ex)
+        return
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        return
+    finally:
+        am_conn.close()
+    for difference in drift:
+        print(difference)
+    if not drift:
+        print("The Carto and SQL Server schemas are up to date.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Migrate the Carto and SQL Server schemas for upload.py."
+    )
+    parser.add_argument(
+        "--check", action="store_true", help="only report the version and drift"
+    )
+    main(check_only=parser.parse_args().check)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the grid index in `boundary_index.py`.
+
+The known cases are small polygons with edges along meridians (and the
+equator), which are the same as a straight line in longitude/latitude and a
+SQL Server geography edge, so the expected results are those of
+`ProjectExportBoundaries.Shape.STContains()`: a point on the boundary is not
+contained, and a line may touch the boundary, but not run along it.  The
+random cases check the grid against a brute force test of every edge.
+
+Run with `python -m pytest test_boundary_index.py` (or `python
+test_boundary_index.py`).
+
+Third party requirements:
+* numpy - https://pypi.org/project/numpy/
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import unittest
+
+import numpy as np
+
+import boundary_index
+
+# A square with a square hole
+SQUARE = "POLYGON ((0 0, 0 10, 10 10, 10 0, 0 0), (4 4, 4 6, 6 6, 6 4, 4 4))"
+
+# Two squares, the second with a hole
+MULTIPOLYGON = (
+    "MULTIPOLYGON (((0 0, 0 2, 2 2, 2 0, 0 0)),"
+    " ((4 0, 4 4, 8 4, 8 0, 4 0), (5 1, 5 3, 7 3, 7 1, 5 1)))"
+)
+
+# A U shape; the notch is open to the north
+NOTCH = "POLYGON ((0 0, 0 10, 3 10, 3 2, 7 2, 7 10, 10 10, 10 0, 0 0))"
+
+# (x, y, STContains) for points in SQUARE
+SQUARE_POINTS = [
+    (1, 1, True),
+    (9.5, 0.5, True),
+    (5, 5, False),  # in the hole
+    (11, 5, False),  # outside
+    (-1, -1, False),  # outside
+    (0, 5, False),  # on the outer edge
+    (10, 7.25, False),  # on the outer edge
+    (4, 5, False),  # on the edge of the hole
+    (0, 0, False),  # on a vertex
+    (10, 10, False),  # on a vertex
+    (6, 6, False),  # on a vertex of the hole
+    (3.999, 5, True),  # just outside the hole
+    (4.001, 5, False),  # just inside the hole
+]
+
+# (WKT vertices, STContains) for lines in SQUARE
+SQUARE_LINES = [
+    ([(1, 1), (3, 3)], True),
+    ([(1, 1), (3, 3), (1, 8)], True),
+    ([(1, 1), (0, 5)], True),  # ends on the boundary
+    ([(0, 2), (10, 2)], True),  # from edge to edge, through the inside
+    ([(3, 3), (4, 4)], True),  # ends on a vertex of the hole
+    ([(3, 5), (5, 5)], False),  # ends in the hole
+    ([(3, 5), (7, 5)], False),  # crosses the hole
+    ([(1, 1), (11, 1)], False),  # crosses the outer edge
+    ([(1, 1), (3, 3), (11, 3)], False),  # the last segment goes outside
+    ([(0, 1), (0, 9)], False),  # along the outer edge
+    ([(4, 4), (4, 6)], False),  # along the edge of the hole
+    ([(11, 0), (12, 1)], False),  # outside
+]
+
+# (WKT vertices, STContains) for lines in MULTIPOLYGON and NOTCH
+MULTIPOLYGON_LINES = [
+    ([(0.5, 0.5), (1.5, 1.5)], True),
+    ([(4.5, 0.5), (4.5, 3.5)], True),
+    ([(1, 1), (4.5, 1)], False),  # from one polygon to the other
+    ([(4.5, 2), (6, 2)], False),  # into the hole
+]
+NOTCH_LINES = [
+    ([(1, 5), (1, 9)], True),
+    ([(1, 1), (9, 1)], True),  # below the notch
+    ([(1, 5), (9, 5)], False),  # across the notch
+    ([(3, 10), (7, 10)], False),  # from vertex to vertex, across the notch
+    ([(3, 5), (7, 5)], False),  # from edge to edge, across the notch
+    ([(0, 1), (10, 1)], True),  # from edge to edge, below the notch
+]
+
+
+def lines_of(cases):
+    """Return the list of (n, 2) vertex arrays of the line cases."""
+
+    return [np.array(vertices, dtype=float) for vertices, _ in cases]
+
+
+class BoundaryIndexTest(unittest.TestCase):
+    """Test BoundaryIndex.contains_points() and contains_lines()."""
+
+    # Few cells, so most cells have edges, and many cells, so most do not
+    cell_counts = (1, 3, 64)
+
+    def test_points(self):
+        """Points in, out, and on the boundary of a polygon with a hole."""
+
+        x = [case[0] for case in SQUARE_POINTS]
+        y = [case[1] for case in SQUARE_POINTS]
+        expected = [case[2] for case in SQUARE_POINTS]
+        for cells in self.cell_counts:
+            index = boundary_index.BoundaryIndex(SQUARE, cells=cells)
+            actual = index.contains_points(x, y)
+            for case, result in zip(SQUARE_POINTS, actual):
+                self.assertEqual(result, case[2], "{0} cells={1}".format(case, cells))
+            self.assertEqual(list(actual), expected)
+
+    def check_lines(self, wkt, cases):
+        """Assert the results of contains_lines() for the line cases in wkt."""
+
+        for cells in self.cell_counts:
+            index = boundary_index.BoundaryIndex(wkt, cells=cells)
+            actual = index.contains_lines(lines_of(cases))
+            for case, result in zip(cases, actual):
+                self.assertEqual(result, case[1], "{0} cells={1}".format(case, cells))
+
+    def test_lines(self):
+        """Lines in, out, across, along, and ending on the boundary."""
+
+        self.check_lines(SQUARE, SQUARE_LINES)
+
+    def test_multipolygon_lines(self):
+        """Lines between the polygons of a multipolygon, and into a hole."""
+
+        self.check_lines(MULTIPOLYGON, MULTIPOLYGON_LINES)
+
+    def test_concave_lines(self):
+        """Lines across the notch of a concave polygon."""
+
+        self.check_lines(NOTCH, NOTCH_LINES)
+
+    def test_no_lines(self):
+        """An empty list of lines."""
+
+        index = boundary_index.BoundaryIndex(SQUARE)
+        self.assertEqual(len(index.contains_lines([])), 0)
+
+    def test_wkb_line(self):
+        """A WKB line string is read as its vertices."""
+
+        wkb = bytes(bytearray([1, 2, 0, 0, 0, 2, 0, 0, 0]))
+        wkb += np.array([1.0, 2.0, 3.0, 4.0], dtype="<f8").tobytes()
+        line = boundary_index.parse_wkb_line(wkb)
+        self.assertEqual(line.tolist(), [[1.0, 2.0], [3.0, 4.0]])
+
+    def test_random_against_brute_force(self):
+        """The grid agrees with a brute force test on random points and lines."""
+
+        rng = np.random.RandomState(1)
+        angles = np.linspace(0, 2 * np.pi, 200, endpoint=False)
+        radii = 1 + 0.3 * np.sin(angles * 7) + 0.05 * rng.rand(len(angles))
+        shell = np.column_stack([radii * np.cos(angles), radii * np.sin(angles)])
+        ring = np.vstack([shell, shell[:1]])
+        wkt = "POLYGON (({0}), (0.1 0, 0.1 0.4, 0.5 0.4, 0.5 0, 0.1 0))".format(
+            ", ".join("{0!r} {1!r}".format(float(x), float(y)) for x, y in ring)
+        )
+        index = boundary_index.BoundaryIndex(wkt, cells=32)
+        edges = (index.x1, index.y1, index.x2, index.y2)
+        x = rng.uniform(-1.5, 1.5, 20000)
+        y = rng.uniform(-1.5, 1.5, 20000)
+        expected = boundary_index.crossing_parity(x, y, *edges)
+        self.assertTrue(np.array_equal(index.contains_points(x, y), expected))
+
+        starts = rng.uniform(-1.5, 1.5, (2000, 2))
+        ends = starts + rng.normal(0, 0.3, (2000, 2))
+        segments = [np.vstack([a, b]) for a, b in zip(starts, ends)]
+        expected = []
+        for segment in segments:
+            ends_inside = boundary_index.crossing_parity(
+                segment[:, 0], segment[:, 1], *edges
+            ).all()
+            crossing = boundary_index.segments_cross(
+                segment[0, 0], segment[0, 1], segment[1, 0], segment[1, 1], *edges
+            )
+            expected.append(ends_inside and not crossing.any())
+        actual = index.contains_lines(segments)
+        self.assertTrue(np.array_equal(actual, np.array(expected)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the retries of `carto_transport.py`.
+
+A local HTTP server answers the first request with a status code, and the
+rest with success, and saves the body of each request.  A COPY body is a
+generator, so a retry must send the whole body again (an empty COPY
+succeeds, and the batch would be tracked without its rows in Carto).
+
+Run with `python -m pytest test_carto_transport.py` (or `python
+test_carto_transport.py`).  Nothing is sent to a real Carto server.
+
+Third party requirements:
+* carto - https://pypi.python.org/pypi/carto
+* requests - https://pypi.python.org/pypi/requests
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import threading
+import unittest
+import zlib
+
+from carto.sql import CopySQLClient, SQLClient, CartoException
+
+import carto_transport
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    """An HTTP server that handles each connection in a thread."""
+
+    daemon_threads = True
+
+
+class FailingHandler(BaseHTTPRequestHandler):
+    """Answer the first server.failures requests with server.status."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        # pylint: disable=arguments-differ
+        pass
+
+    def read_body(self):
+        """Return the request body as bytes; de-chunked and decompressed."""
+
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b"".join(parts)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if body and self.headers.get("Content-Encoding", "").lower() == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def do_POST(self):
+        """Save the body, and fail or succeed."""
+
+        # pylint: disable=invalid-name
+        self.server.bodies.append(self.read_body())
+        status = 200
+        if self.server.failures:
+            self.server.failures -= 1
+            status = self.server.status
+        body = json.dumps({"rows": [], "total_rows": 0}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RetryTest(unittest.TestCase):
+    """Send requests to a server that fails the first one."""
+
+    def setUp(self):
+        self.backoff = carto_transport.Config.backoff_factor
+        carto_transport.Config.backoff_factor = 0
+        self.server = ThreadingServer(("127.0.0.1", 0), FailingHandler)
+        self.server.bodies = []
+        self.server.failures = 1
+        self.server.status = 503
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = "http://127.0.0.1:{0}/user/test/".format(self.server.server_address[1])
+        session = carto_transport.CartoSession()
+        self.auth = carto_transport.get_auth_client(url, "fake", session)
+
+    def tearDown(self):
+        carto_transport.Config.backoff_factor = self.backoff
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_copy_retry_sends_the_whole_body(self):
+        """A COPY that gets a 503 is sent again with all of its rows."""
+
+        lines = ["{0},row {0}\n".format(i).encode("utf-8") for i in range(1000)]
+        copy_client = CopySQLClient(self.auth)
+        copy_client.copyfrom("COPY t (a, b) FROM stdin WITH (FORMAT csv)", iter(lines))
+        self.assertEqual(len(self.server.bodies), 2)
+        self.assertEqual(self.server.bodies[0], b"".join(lines))
+        self.assertEqual(self.server.bodies[1], b"".join(lines))
+
+    def test_statement_retry(self):
+        """An SQL statement that gets a 503 is sent again."""
+
+        SQLClient(self.auth).send("select 1")
+        self.assertEqual(len(self.server.bodies), 2)
+        self.assertEqual(self.server.bodies[0], self.server.bodies[1])
+
+    def test_no_post_retry_after_gateway_error(self):
+        """An SQL statement that gets a 502 (it may have run) is not sent again."""
+
+        self.server.status = 502
+        with self.assertRaises(CartoException):
+            SQLClient(self.auth).send("select 1")
+        self.assertEqual(len(self.server.bodies), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
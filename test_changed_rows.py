@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of how `upload.py` finds new and changed rows with the key cache.
+
+With `Config.update_changed_rows` and `Config.use_key_cache`, the new rows
+are found with a key-only scan and the key cache, but the changed rows are
+still found by hashing rows and joining them to the tracking tables on SQL
+Server (the key cache does not have the hashes).  With change tracking,
+only the rows changed since the last sync are hashed; without it, every
+published row is.  These tests check the SQL sent for both cases, and the
+rows that come back from a scripted database: the new rows are the ones
+whose keys are not in the cache, and the rows outside the boundary are left
+out, but (as they are never cached) are staged again by the next sync.
+
+Run with `python -m pytest test_changed_rows.py` (or `python
+test_changed_rows.py`).  No database is used.
+
+Third party requirements:
+* pyodbc - https://pypi.python.org/pypi/pyodbc (imported by upload.py)
+* carto - https://pypi.python.org/pypi/carto (imported by upload.py)
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import unittest
+
+import boundary_index
+import upload
+
+# The boundary of the scripted project; the last location is outside of it
+BOUNDARY = "POLYGON ((-155 58, -155 59, -154 59, -154 58, -155 58))"
+DATE = datetime.datetime(2015, 5, 1, 6, 30)
+LOCATIONS = [
+    ("TEST", "001", 1, DATE, 58.1, -154.9, b"hash1"),
+    ("TEST", "001", 2, DATE, 58.2, -154.8, b"hash2"),
+    ("TEST", "001", 3, DATE, 58.3, -154.7, b"hash3"),
+    ("TEST", "001", 4, DATE, 60.0, -150.0, b"hash4"),
+]
+
+
+class RecordingCursor(object):
+    """A database cursor that saves the SQL it is sent and returns no rows."""
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self, statements):
+        self.statements = statements
+
+    def execute(self, sql, *args):
+        """Save sql."""
+
+        # pylint: disable=unused-argument
+        self.statements.append(" ".join(sql.split()))
+
+    def fetchmany(self, size):
+        """Return no rows."""
+
+        # pylint: disable=unused-argument,no-self-use
+        return []
+
+    def close(self):
+        """Do nothing."""
+
+
+class RecordingConnection(object):
+    """A SQL Server connection that saves the SQL sent by its cursors."""
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self):
+        """Return a new RecordingCursor."""
+
+        return RecordingCursor(self.statements)
+
+
+class ScriptedCursor(object):
+    """
+    A database cursor that returns the rows of the SQL it is sent.
+
+    The key scan returns the fixids of the locations, the join to the staged
+    keys returns the locations with the staged fixids, and any other query
+    returns all of the locations.
+    """
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self, locations, staged):
+        self.locations = locations
+        self.staged = staged
+        self.rows = []
+
+    def execute(self, sql, *args):
+        """Script the rows of sql."""
+
+        # pylint: disable=unused-argument
+        sql = " ".join(sql.split())
+        if sql.startswith("select l.FixId from"):
+            self.rows = [(row[2],) for row in self.locations]
+        elif "#Unpublished_Locations as n" in sql:
+            fids = set(key[0] for key in self.staged)
+            self.rows = [row for row in self.locations if row[2] in fids]
+        elif sql.startswith("select"):
+            self.rows = list(self.locations)
+
+    def executemany(self, sql, params):
+        """Save the staged keys."""
+
+        # pylint: disable=unused-argument
+        self.staged.extend(params)
+
+    def fetchmany(self, size):
+        """Return the next size rows."""
+
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def commit(self):
+        """Do nothing."""
+
+    def close(self):
+        """Do nothing."""
+
+
+class ScriptedConnection(object):
+    """A SQL Server connection with the scripted locations of one project."""
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self, locations):
+        self.locations = locations
+        self.staged = []
+
+    def cursor(self):
+        """Return a new ScriptedCursor."""
+
+        return ScriptedCursor(self.locations, self.staged)
+
+
+class PublishedKeyCache(object):
+    """A stand-in for an open key cache (upload.KEYS) with published fixids."""
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self, published):
+        self.published = set(published)
+
+    def is_open(self):
+        """Return True."""
+
+        # pylint: disable=no-self-use
+        return True
+
+    def unpublished(self, kind, keys):
+        """Return the location keys that are not published."""
+
+        # pylint: disable=unused-argument
+        return [key for key in keys if key[0] not in self.published]
+
+
+class OpenKeyCache(object):
+    """A stand-in for an open key cache (upload.KEYS) with no published keys."""
+
+    # pylint: disable=useless-object-inheritance,no-self-use
+
+    def is_open(self):
+        """Return True."""
+
+        return True
+
+    def unpublished(self, kind, keys):
+        """Return all of the keys."""
+
+        # pylint: disable=unused-argument
+        return keys
+
+
+class ChangedRowsTest(unittest.TestCase):
+    """Check the SQL for new and changed rows with the key cache open."""
+
+    def setUp(self):
+        self.saved = (upload.KEYS, upload.Config.update_changed_rows)
+        upload.KEYS = OpenKeyCache()
+        upload.Config.update_changed_rows = True
+
+    def tearDown(self):
+        upload.KEYS, upload.Config.update_changed_rows = self.saved
+
+    def statements(self, fetch, since):
+        """Return the SQL sent by fetching all the batches of fetch(since)."""
+
+        connection = RecordingConnection()
+        for _ in fetch(connection, "TEST", since):
+            pass
+        return connection.statements
+
+    def test_new_rows_use_the_key_cache(self):
+        """New rows are found with a key-only scan; no tracking join or hash."""
+
+        for fetch in (upload.get_locations_for_carto, upload.get_vectors_for_carto):
+            for since in (None, 7):
+                sql = self.statements(fetch, since)[0]
+                self.assertNotIn("_In_CartoDB", sql)
+                self.assertNotIn("hashbytes", sql)
+
+    def test_changed_rows_with_change_tracking(self):
+        """With change tracking, only the changed rows are hashed and joined."""
+
+        for fetch in (upload.get_changed_locations, upload.get_changed_vectors):
+            sql = self.statements(fetch, 7)[0]
+            self.assertIn("CHANGETABLE(CHANGES", sql)
+            self.assertIn("_In_CartoDB", sql)
+            self.assertIn("hashbytes", sql)
+
+    def test_changed_rows_without_change_tracking(self):
+        """Without change tracking, every published row is hashed and joined."""
+
+        for fetch in (upload.get_changed_locations, upload.get_changed_vectors):
+            sql = self.statements(fetch, None)[0]
+            self.assertNotIn("CHANGETABLE", sql)
+            self.assertIn("_In_CartoDB", sql)
+            self.assertIn("hashbytes", sql)
+
+
+class ScriptedRowsTest(unittest.TestCase):
+    """Check the rows found with the key cache in a scripted database."""
+
+    def setUp(self):
+        self.saved = (upload.KEYS, upload.Config.update_changed_rows)
+        upload.KEYS = PublishedKeyCache([1])
+        upload.Config.update_changed_rows = True
+        self.index = boundary_index.BoundaryIndex(BOUNDARY)
+
+    def tearDown(self):
+        upload.KEYS, upload.Config.update_changed_rows = self.saved
+
+    def fetch(self, fetch, connection, since=None):
+        """Return all the rows of fetch() with the boundary index."""
+
+        rows = []
+        for batch in fetch(connection, "TEST", since, self.index):
+            rows.extend(batch)
+        return rows
+
+    def test_new_rows(self):
+        """The unpublished rows inside the boundary are new."""
+
+        connection = ScriptedConnection(LOCATIONS)
+        rows = self.fetch(upload.get_locations_for_carto, connection)
+        self.assertEqual(rows, LOCATIONS[1:3])
+        self.assertEqual(connection.staged, [(2,), (3,), (4,)])
+
+    def test_rows_outside_are_staged_again(self):
+        """A row outside the boundary is not cached, so it is staged every sync."""
+
+        connection = ScriptedConnection(LOCATIONS)
+        self.fetch(upload.get_locations_for_carto, connection)
+        upload.KEYS.published.update([2, 3])  # tracked by the first sync
+        connection.staged[:] = []
+        self.assertEqual(self.fetch(upload.get_locations_for_carto, connection), [])
+        self.assertEqual(connection.staged, [(4,)])
+
+    def test_changed_rows(self):
+        """The changed rows inside the boundary come back with their hashes."""
+
+        for since in (None, 7):
+            connection = ScriptedConnection(LOCATIONS[:2] + LOCATIONS[3:])
+            rows = self.fetch(upload.get_changed_locations, connection, since)
+            self.assertEqual(rows, LOCATIONS[:2])
+            self.assertEqual(connection.staged, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
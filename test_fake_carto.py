@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the ingest modes of `upload.py` against the fake Carto server.
+
+The same synthetic locations and movements are sent to `fake_carto.py` with
+COPY and with INSERT statements (for each geometry encoding), and the rows
+in the fake tables must be the same.  The rows per second of each mode are
+printed.  Changed rows are sent as INSERT ... ON CONFLICT DO UPDATE
+statements, which must replace the rows with the same key.
+
+Run with `python -m pytest -s test_fake_carto.py` (or `python
+test_fake_carto.py`).  Nothing is sent to a real Carto server.
+
+Third party requirements:
+* pyodbc - https://pypi.python.org/pypi/pyodbc (imported by upload.py)
+* carto - https://pypi.python.org/pypi/carto
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import struct
+import threading
+import time
+import unittest
+
+import fake_carto
+import upload
+
+
+def synthetic_locations(count):
+    """Return count location rows, as read from SQL Server."""
+
+    start = datetime.datetime(2020, 6, 1)
+    return [
+        (
+            "TEST_Bear",
+            "B{0}".format(i % 7),
+            i + 1,
+            start + datetime.timedelta(hours=i),
+            58.5 + i * 0.0001,
+            -155.1 - i * 0.0001,
+        )
+        for i in range(count)
+    ]
+
+
+def line_wkb(points):
+    """Return the OGC WKB (bytes) of a line string of (x, y) points."""
+
+    wkb = struct.pack("<BII", 1, 2, len(points))
+    for x, y in points:
+        wkb += struct.pack("<dd", x, y)
+    return wkb
+
+
+def synthetic_movements(count, encoding):
+    """Return count movement rows, as read from SQL Server with the encoding."""
+
+    start = datetime.datetime(2020, 6, 1)
+    rows = []
+    for i in range(count):
+        points = [(-155.1 - i * 0.0001, 58.5), (-155.1 - i * 0.0001, 58.6)]
+        if encoding == "ewkb":
+            shape = line_wkb(points)
+        else:
+            shape = "LINESTRING ({0} {1}, {2} {3})".format(*(points[0] + points[1]))
+        rows.append(
+            (
+                "TEST_Bear",
+                "B{0}".format(i % 7),
+                start + datetime.timedelta(hours=i),
+                start + datetime.timedelta(hours=i + 1),
+                1.0,
+                11.1 + i * 0.01,
+                11.1 + i * 0.01,
+                shape,
+            )
+        )
+    return rows
+
+
+class IngestParityTest(unittest.TestCase):
+    """Send rows to the fake Carto server with each ingest mode."""
+
+    count = 2000
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = fake_carto.make_server()
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        url = "http://127.0.0.1:{0}/user/test/".format(cls.server.server_address[1])
+        cls.carto = upload.get_carto_sql_client(url, "fake")
+        cls.encoding = upload.Config.geometry_encoding
+
+    @classmethod
+    def tearDownClass(cls):
+        upload.Config.geometry_encoding = cls.encoding
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def send(self, kind, rows, mode):
+        """Send the rows of kind with the ingest mode; return the rows per second."""
+
+        state = upload.ingest_state(mode)
+        texts = upload.serialize(rows, kind, mode)
+        start = time.time()
+        upload.send_batch(
+            self.carto, upload.RequestSizer(), kind, state, rows, mode, texts
+        )
+        self.assertEqual(state["mode"], mode, "the COPY fell back to INSERT")
+        return len(rows) / max(time.time() - start, 0.000001)
+
+    def published(self, kind, rows, mode):
+        """Return the rows in the fake table after sending rows with mode."""
+
+        store = self.server.store
+        store.reset()
+        rate = self.send(kind, rows, mode)
+        print(
+            "{0} {1} {2}: {3:.0f} rows/sec".format(
+                upload.Config.geometry_encoding, kind["name"], mode, rate
+            )
+        )
+        self.assertEqual(store.snapshot()[kind["name"]], len(rows))
+        return store.table_rows(kind["table"])
+
+    def check_parity(self, encoding):
+        """Assert COPY and INSERT publish the same rows with the encoding."""
+
+        upload.Config.geometry_encoding = encoding
+        for kind, rows in [
+            (upload.LOCATIONS, synthetic_locations(self.count)),
+            (upload.MOVEMENTS, synthetic_movements(self.count, encoding)),
+        ]:
+            copied = self.published(kind, rows, "copy")
+            inserted = self.published(kind, rows, "insert")
+            self.assertEqual(len(copied), len(rows))
+            self.assertEqual(copied, inserted)
+
+    def test_text_parity(self):
+        """COPY and INSERT publish the same rows with the well known text."""
+
+        self.check_parity("text")
+
+    def test_ewkb_parity(self):
+        """COPY and INSERT publish the same rows with hex EWKB."""
+
+        self.check_parity("ewkb")
+
+    def test_upsert(self):
+        """Changed rows replace the published rows with the same key."""
+
+        upload.Config.geometry_encoding = "text"
+        store = self.server.store
+        store.reset()
+        rows = synthetic_locations(10)
+        self.send(upload.LOCATIONS, rows, "copy")
+        changed = [row[:4] + (row[4] + 1, row[5]) for row in rows[:4]]
+        texts = upload.serialize(changed, upload.LOCATIONS, "insert")
+        sql = upload.upsert_sql(upload.LOCATIONS)
+        upload.RequestSizer().send(self.carto, sql, texts)
+        stats = store.snapshot()
+        self.assertEqual(stats["locations"], 10)
+        self.assertEqual(stats["rows_updated"], 4)
+        published = store.table_rows("animal_locations")
+        expected = "SRID=4326;POINT({0} {1})".format(changed[0][5], changed[0][4])
+        self.assertEqual(published[1]["the_geom"], expected)
+        self.assertEqual(
+            published[5]["the_geom"],
+            "SRID=4326;POINT({0} {1})".format(rows[4][5], rows[4][4]),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
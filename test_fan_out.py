@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of sending batches to several targets with `upload.fan_out()`.
+
+The COPY requests to the first target fail, so its batches are sent with
+INSERT statements instead.  The fallback state is shared by the targets, so
+the second target must switch to INSERT statements too (after the COPY that
+it is already sending), and each row formatted for COPY must only be
+formatted again (for INSERT) once, however many targets need it.
+
+Run with `python -m pytest test_fan_out.py` (or `python test_fan_out.py`).
+Nothing is sent to Carto, and no database is used.
+
+Third party requirements:
+* pyodbc - https://pypi.python.org/pypi/pyodbc (imported by upload.py)
+* carto - https://pypi.python.org/pypi/carto
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import datetime
+import threading
+import time
+import unittest
+
+from carto.sql import CartoException
+
+import upload
+
+
+class FakeCarto(object):
+    """A stand-in for the Carto client of a target."""
+
+    # pylint: disable=useless-object-inheritance,too-few-public-methods
+
+    def __init__(self, name):
+        self.name = name
+
+
+def masked_locations(count):
+    """Return count location rows, each ending with a mask of 1, 2, or 3."""
+
+    start = datetime.datetime(2020, 6, 1)
+    return [
+        (
+            "TEST_Bear",
+            "B{0}".format(i % 7),
+            i + 1,
+            start + datetime.timedelta(hours=i),
+            58.5 + i * 0.0001,
+            -155.1 - i * 0.0001,
+            i % 3 + 1,
+        )
+        for i in range(count)
+    ]
+
+
+class FanOutFallbackTest(unittest.TestCase):
+    """Send batches to two targets when the COPY requests to one of them fail."""
+
+    def setUp(self):
+        self.saved = (
+            upload.copy_lines_to_carto,
+            upload.insert_values_to_carto,
+            upload.serialize,
+        )
+        self.lock = threading.Lock()
+        self.copied = collections.Counter()
+        self.inserted = collections.Counter()
+        self.formatted = collections.Counter()
+        self.failed = threading.Event()
+        serialize = upload.serialize
+
+        def copy_lines_to_carto(carto, table, columns, lines):
+            """Fail for target a; for b, finish after a has failed."""
+            # pylint: disable=unused-argument
+            if carto.name == "a":
+                self.failed.set()
+                raise CartoException("COPY failed")
+            self.failed.wait(5)
+            time.sleep(0.05)
+            with self.lock:
+                self.copied[carto.name] += len(list(lines))
+
+        def insert_values_to_carto(carto, sizer, table, columns, values):
+            """Count the rows inserted to each target."""
+            # pylint: disable=unused-argument
+            with self.lock:
+                self.inserted[carto.name] += len(values)
+
+        def count_serialize(rows, kind, mode):
+            """Count the rows formatted for INSERT, by key."""
+            if mode == "insert":
+                with self.lock:
+                    self.formatted.update(kind["key"](row) for row in rows)
+            return serialize(rows, kind, mode)
+
+        upload.copy_lines_to_carto = copy_lines_to_carto
+        upload.insert_values_to_carto = insert_values_to_carto
+        upload.serialize = count_serialize
+
+    def tearDown(self):
+        (
+            upload.copy_lines_to_carto,
+            upload.insert_values_to_carto,
+            upload.serialize,
+        ) = self.saved
+
+    def test_copy_failure_is_shared(self):
+        """Both targets fall back to INSERT, and rows are formatted once."""
+
+        rows = masked_locations(60)
+        batches = [rows[i : i + 5] for i in range(0, len(rows), 5)]
+        kind = dict(upload.LOCATIONS, track=lambda *args: True)
+        outlets = [
+            {
+                "target": upload.Target(name, "http://{0}/".format(name)),
+                "database": None,
+                "carto": FakeCarto(name),
+                "journal": None,
+            }
+            for name in ("a", "b")
+        ]
+        state = upload.ingest_state("copy")
+        items = upload.serialize_batches(iter(batches), kind, state)
+        results = upload.fan_out(upload.send_items, kind, items, outlets, state)
+
+        self.assertEqual(state["mode"], "insert")
+        self.assertEqual(results, [(40, 0), (40, 0)])
+        # b only sent the COPY it started before a failed (its rows of the
+        # first batch), if any
+        self.assertIn(self.copied["b"], (0, 3))
+        self.assertEqual(self.inserted["a"], 40)
+        self.assertEqual(self.inserted["b"] + self.copied["b"], 40)
+        self.assertTrue(self.formatted)
+        self.assertEqual(max(self.formatted.values()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
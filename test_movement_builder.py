@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the movements built by `movement_builder.py`.
+
+The known fix pairs have published geodesic distances on the WGS 84
+ellipsoid: the example of Vincenty's paper (Flinders Peak to Buninyong,
+54972.271 m), one degree along the equator (pi * a / 180 m), and one degree
+of meridian from the equator (110574.389 m).  The Distance (meters) of each
+movement must be within 1 mm of the reference, the Duration (hours) within
+1e-9 hours of the difference of the fix dates, and the Speed (meters per
+hour) within 1 mm per Duration of the reference distance / hours.
+
+Run with `python -m pytest test_movement_builder.py` (or `python
+test_movement_builder.py`).
+
+Third party requirements:
+* numpy - https://pypi.org/project/numpy/
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import unittest
+
+import movement_builder
+
+# Tolerances of the comparisons with the reference values
+METERS = 0.001
+HOURS = 1e-9
+
+START = datetime.datetime(2015, 5, 1, 6, 30)
+
+
+def degrees(d, m, s):
+    """Return the decimal degrees of degrees, minutes, and seconds."""
+
+    return d + m / 60 + s / 3600
+
+
+# (lat1, lon1, lat2, lon2, meters, hours) for known fix pairs
+FIX_PAIRS = [
+    (
+        -degrees(37, 57, 3.72030),
+        degrees(144, 25, 29.52440),
+        -degrees(37, 39, 10.15610),
+        degrees(143, 55, 35.38390),
+        54972.271,
+        2.5,
+    ),
+    (0.0, 0.0, 0.0, 1.0, 111319.49079327358, 0.25),
+    (0.0, -150.0, 1.0, -150.0, 110574.389, 26.0 + 1 / 3600),
+]
+
+
+def location_rows(pairs):
+    """Return location rows with a different animal for each fix pair."""
+
+    rows = []
+    for i, (lat1, lon1, lat2, lon2, _, hours) in enumerate(pairs):
+        animal = "{0:03d}".format(i)
+        end = START + datetime.timedelta(hours=hours)
+        rows.append(("TEST", animal, 2 * i, START, lat1, lon1))
+        rows.append(("TEST", animal, 2 * i + 1, end, lat2, lon2))
+    return rows
+
+
+class MovementBuilderTest(unittest.TestCase):
+    """Check the movement rows built from known fix pairs."""
+
+    def check_rows(self, rows, pairs):
+        """Assert that the movement rows match the reference values of pairs."""
+
+        self.assertEqual(len(rows), len(pairs))
+        for row, pair in zip(rows, pairs):
+            lat1, lon1, lat2, lon2, meters, hours = pair
+            _, _, startdate, enddate, duration, distance, speed, shape = row
+            self.assertEqual(enddate - startdate, datetime.timedelta(hours=hours))
+            self.assertAlmostEqual(duration, hours, delta=HOURS)
+            self.assertAlmostEqual(distance, meters, delta=METERS)
+            self.assertAlmostEqual(speed, meters / hours, delta=METERS / hours)
+            self.assertEqual(
+                shape,
+                "LINESTRING ({0!r} {1!r}, {2!r} {3!r})".format(lon1, lat1, lon2, lat2),
+            )
+
+    def test_known_fix_pairs(self):
+        """Distance, Duration, and Speed of known fix pairs."""
+
+        builder = movement_builder.MovementBuilder()
+        keys, values = builder.add(location_rows(FIX_PAIRS))
+        self.check_rows(movement_builder.movement_rows(keys, values), FIX_PAIRS)
+
+    def test_fix_pairs_across_batches(self):
+        """A movement from the last fix of a batch to the first of the next."""
+
+        builder = movement_builder.MovementBuilder()
+        rows = []
+        for location in location_rows(FIX_PAIRS):
+            keys, values = builder.add([location])
+            rows += movement_builder.movement_rows(keys, values)
+        self.check_rows(rows, FIX_PAIRS)
+
+    def test_no_distance_or_duration(self):
+        """Movements with no distance or no duration are not built."""
+
+        end = START + datetime.timedelta(hours=1)
+        rows = [
+            ("TEST", "001", 1, START, 58.5, -154.5),
+            ("TEST", "001", 2, end, 58.5, -154.5),
+            ("TEST", "002", 3, START, 58.5, -154.5),
+            ("TEST", "002", 4, START, 58.6, -154.5),
+        ]
+        keys, values = movement_builder.MovementBuilder().add(rows)
+        self.assertEqual(keys, [])
+        self.assertEqual(movement_builder.movement_rows(keys, values), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
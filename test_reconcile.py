@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of how `reconcile.py` untracks the movement keys that differ.
+
+The movement keys have dates in whole milliseconds, but the tracking table
+has the dates of the Movements table, which may have a fraction of a
+millisecond.  These tests send the keys of tracked movements to a scripted
+cursor, and check that the staged dates and the range predicate of the
+delete match the tracked dates (the way SQL Server would), so that
+resend() does not find the old rows still tracked.
+
+Run with `python -m pytest test_reconcile.py` (or `python
+test_reconcile.py`).  No database is used.
+
+Third party requirements:
+* pyodbc - https://pypi.python.org/pypi/pyodbc
+* carto - https://pypi.python.org/pypi/carto (imported by upload.py)
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import unittest
+
+import reconcile
+
+MILLISECOND = datetime.timedelta(milliseconds=1)
+
+
+class ScriptedCursor(object):
+    """A database cursor that saves the SQL and the parameters it is sent."""
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self):
+        self.statements = []
+        self.staged = []
+        self.committed = False
+
+    def execute(self, sql, *args):
+        """Save sql."""
+
+        # pylint: disable=unused-argument
+        self.statements.append(" ".join(sql.split()))
+
+    def executemany(self, sql, params):
+        """Save sql, and the parameters as the staged rows."""
+
+        self.statements.append(" ".join(sql.split()))
+        self.staged.extend(params)
+
+    def commit(self):
+        """Save that the changes were committed."""
+
+        self.committed = True
+
+
+class ScriptedConnection(object):
+    """A SQL Server connection with one ScriptedCursor."""
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self):
+        self.scripted = ScriptedCursor()
+
+    def cursor(self):
+        """Return the ScriptedCursor."""
+
+        return self.scripted
+
+
+def matches(staged, tracked):
+    """
+    Return True if the delete would untrack the tracked (project, animal,
+    startdate, enddate) row with the staged row.
+    """
+    return (
+        staged[:2] == tracked[:2]
+        and staged[2] <= tracked[2] < staged[2] + MILLISECOND
+        and staged[3] <= tracked[3] < staged[3] + MILLISECOND
+    )
+
+
+def drift_key(row):
+    """Return the drift key (as from find_drift()) of a tracked movement row."""
+
+    return (
+        row[0],
+        row[1],
+        row[2].strftime("%Y-%m-%d"),
+        reconcile.datetime_to_milliseconds(row[2]),
+        reconcile.datetime_to_milliseconds(row[3]),
+    )
+
+
+class UntrackMovementsTest(unittest.TestCase):
+    """Untrack movement keys with dates in whole and partial milliseconds."""
+
+    tracked = [
+        (
+            "TEST",
+            "001",
+            datetime.datetime(2015, 5, 1, 6, 30, 0, 123456),
+            datetime.datetime(2015, 5, 1, 8, 30, 0, 999999),
+        ),
+        (
+            "TEST",
+            "002",
+            datetime.datetime(2015, 5, 1, 6, 30),
+            datetime.datetime(2015, 5, 1, 8, 30, 1, 1000),
+        ),
+    ]
+
+    def untrack(self, rows):
+        """Return the ScriptedCursor used to untrack the keys of rows."""
+
+        connection = ScriptedConnection()
+        reconcile.untrack_movements(connection, [drift_key(row) for row in rows])
+        return connection.scripted
+
+    def test_sub_millisecond_dates(self):
+        """Each tracked row (even with a fraction of a millisecond) is untracked."""
+
+        cursor = self.untrack(self.tracked)
+        self.assertTrue(cursor.committed)
+        self.assertEqual(len(cursor.staged), len(self.tracked))
+        for staged, tracked in zip(cursor.staged, self.tracked):
+            self.assertTrue(matches(staged, tracked), (staged, tracked))
+        # An equality join would miss the first row
+        self.assertNotEqual(cursor.staged[0][2], self.tracked[0][2])
+        delete = cursor.statements[-1]
+        self.assertIn("c.StartDate >= r.StartDate", delete)
+        self.assertIn("c.StartDate < dateadd(millisecond, 1, r.StartDate)", delete)
+        self.assertIn("c.EndDate >= r.EndDate", delete)
+        self.assertIn("c.EndDate < dateadd(millisecond, 1, r.EndDate)", delete)
+
+    def test_next_millisecond_is_kept(self):
+        """A movement a millisecond later is not untracked with the key."""
+
+        cursor = self.untrack(self.tracked[:1])
+        row = self.tracked[0]
+        later = (row[0], row[1], row[2] + MILLISECOND, row[3])
+        self.assertFalse(matches(cursor.staged[0], later))
+
+    def test_no_keys(self):
+        """No SQL is sent without keys."""
+
+        self.assertEqual(self.untrack([]).statements, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -23,11 +23,14 @@ https://github.com/CartoDB/carto-python
 https://carto.com/developers/python-sdk/
 https://carto-python.readthedocs.io/en/latest/carto.html#module-carto.sql
 
+All requests (authenticated or public) go through the shared HTTP session in
+`carto_transport.py` (connection pooling, compression, and retries).
+
 If the on-premises carto server is using a self signed certificate, or if
 the Python `certifi` module does not have all of the necessary certificates
 to verify the server (happed with the nps server in 2021), then you will
-need to use the carto.auth.NonVerifiedAPIKeyAuthClient authorization,
-and/or the request with `verify=False` (see the commented lines in the code).
+need to set `verify = False` on the session (see the commented lines in the
+code).
 I was able to add the necessary certificates by checking with the browser.
 In Chrome visit the server and click on the lock icon, and find information
 on the certificate. Click the download certificate chain as PEM, and add it to
@@ -45,14 +48,14 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import sys
 
-from carto.auth import APIKeyAuthClient
-
-# To disable SSL certificate verification (unsafe)
-# from carto.auth import NonVerifiedAPIKeyAuthClient
 from carto.sql import SQLClient, CartoException
 import requests
 
 import carto_secrets
+import carto_transport
+
+# To disable SSL certificate verification (unsafe)
+# carto_transport.get_session().verify = False
 
 # Python 2/3 compatible xrange() cabability
 # pylint: disable=undefined-variable,redefined-builtin
@@ -194,12 +197,7 @@ class Config(object):
 def get_auth_carto_sql_connection():
     """Return a authorized SQL connection to the carto database, using the secrets."""
 
-    # To disable SSL certificate verification (unsafe)
-    # auth_client = NonVerifiedAPIKeyAuthClient(
-    auth_client = APIKeyAuthClient(
-        api_key=carto_secrets.apikey,
-        base_url=Config.base_url,
-    )
+    auth_client = carto_transport.get_auth_client(Config.base_url, carto_secrets.apikey)
     return SQLClient(auth_client)
 
 
@@ -229,10 +227,10 @@ def public_query(query):
     url = "{0}?q={1}".format(Config.sql_url, query)
     print(url)
     try:
-        # To disable SSL certificate verification (unsafe)
-        # result = requests.get(url, verify=False)
-        result = requests.get(url)
+        result = carto_transport.get_session().get(Config.sql_url, params={"q": query})
         print(result.json())
+        timing = carto_transport.get_session().timings[-1]
+        print("{0:.3f} seconds".format(timing["seconds"]))
     except requests.exceptions.RequestException as ex:
         print("Some error ocurred {0}".format(ex))
 
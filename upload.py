@@ -24,18 +24,58 @@ errors.
 
 Third party requirements:
 * carto - https://pypi.python.org/pypi/carto  (formerly cartodb)
+  version 1.3 or later for the COPY (bulk load) API
+* requests - https://pypi.python.org/pypi/requests (see `carto_transport.py`)
 * pyodbc - https://pypi.python.org/pypi/pyodbc - for SQL Server
+  version 4.0.19 or later for fast_executemany
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import argparse
+import binascii
+import decimal
+import hashlib
+import os
+import signal
+import struct
 import sys
+import threading
+import time
 
-from carto.auth import APIKeyAuthClient
-from carto.sql import SQLClient, CartoException
+from carto.sql import CopySQLClient, SQLClient, CartoException
 import pyodbc
 
+import batch_journal
 import carto_secrets
+import carto_transport
+import generalize
+import run_metrics
+import schema
+
+try:
+    import boundary_index
+except ImportError:
+    # numpy is not installed; only the "sql" boundary engine is available
+    boundary_index = None
+
+try:
+    import movement_builder
+except ImportError:
+    # numpy is not installed; movements are only read from the Movements table
+    movement_builder = None
+
+try:
+    import key_cache
+except ImportError:
+    # numpy is not installed; new rows are found with the tracking tables
+    key_cache = None
+
+try:
+    import async_engine
+except (ImportError, SyntaxError):
+    # Python 2; only the "sequential" carto engine is available
+    async_engine = None
 
 
 # Python 2/3 compatible xrange() cabability
@@ -43,6 +83,12 @@ import carto_secrets
 if sys.version_info[0] < 3:
     range = xrange
 
+# Python 2/3 compatible queue module
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 
 class Config(object):
     """Namespace for configuration parameters. Edit as necessary."""
@@ -52,15 +98,258 @@ class Config(object):
     # On premises Carto server
     base_url = "https://carto.nps.gov/user/{user}/".format(user=carto_secrets.user)
 
+    # Other Carto servers to publish the same data to (e.g. while migrating to
+    # a new server, or for a staging server), keyed by a short name.  The
+    # server at base_url is the "default" target.  Each target has its own
+    # tracking tables in SQL Server (named with the target name at the end,
+    # e.g. Locations_In_CartoDB_staging; see make_sqlserver_tables()), sync
+    # state and batch journal, so a slow or failing server does not hold
+    # back the others.  New and changed rows are read from SQL Server and
+    # formatted once, and then sent to every target that needs them at the
+    # same time.  The API key for a target is carto_secrets.apikeys[name] if
+    # it is there, otherwise carto_secrets.apikey.
+    # e.g. more_targets = {"staging": "https://carto-test.nps.gov/user/nps-akro-gis/"}
+    more_targets = {}
+
+    # Each target is sent its rows from its own queue of at most
+    # target_queue_batches batches, and the rows are read as fast as the
+    # fastest target takes them.  A target with a full queue that has taken
+    # target_lag_batches fewer batches than the fastest target is left
+    # behind until the next sync, instead of slowing down the others.
+    target_queue_batches = 8
+    target_lag_batches = 8
+
+    # Animal Movement database (SQL Server)
+    am_server = "inpakrovmais"
+    am_database = "animal_movement"
+
+    # The projects in Animal Movement that have elected to publish to Carto.
+    # Add the project id here after the project's boundary has been added to
+    # the ProjectExportBoundaries table.
+    projects = ["KATM_BrownBear"]
+
+    # The maximum number of projects to sync at the same time.  Each worker
+    # opens its own SQL Server connection and Carto client, so keep this small
+    # enough to be polite to the shared database server.
+    max_workers = 4
+
+    # How new rows are sent to Carto.  "copy" streams CSV rows through the
+    # Carto SQL API COPY endpoint (much faster for big loads); "insert" sends
+    # multi-row INSERT statements.  If a COPY request fails, that batch (and
+    # the rest of the run) falls back to INSERT.
+    ingest_mode = "copy"
+
+    # Number of new rows read from SQL Server, sent to Carto, and recorded in
+    # the tracking tables at a time.  Reading, formatting, and sending are
+    # overlapped, so at most a few batches are in memory at once.  A COPY
+    # request is all or nothing, so this also limits the work redone after
+    # a failure.
+    batch_size = 10000
+
+    # Requests to the Carto SQL API are sized by the length of the SQL text
+    # (in UTF-8 bytes), not the number of rows, since a movement is much
+    # bigger than a location.  The size starts at the maximum and adapts to
+    # the server: it shrinks when a request fails or is slower than the target
+    # time, and grows back when requests are fast.  A request that was too big
+    # (or hit the statement timeout) is split and retried; any other error is
+    # raised.  After a failure, the size does not grow back to the size that
+    # failed for a while; that ceiling rises by ceiling_recovery (a fraction)
+    # after each request that succeeds.
+    max_request_bytes = 512 * 1024
+    min_request_bytes = 8 * 1024
+    target_request_seconds = 5.0
+    ceiling_recovery = 0.02
+
+    # How requests are sent to Carto.  "sequential" waits for each request to
+    # finish before sending the next.  "asyncio" (Python 3 only) keeps up to
+    # max_in_flight requests in flight (see `async_engine.py`), which hides
+    # the network latency to the Carto server.  Each request in flight uses
+    # its own HTTP connection, and each project worker (max_workers) has its
+    # own requests in flight.  A batch is only tracked after Carto accepts it.
+    carto_engine = "sequential"
+    max_in_flight = 4
+
+    # Number of rows sent to the pyodbc driver in each executemany() call
+    # when writing to the tracking tables in SQL Server.
+    tracking_batch_size = 10000
+
+    # Where locations and movements are tested against the project boundary.
+    # "sql" uses STContains() on the SQL Server.  "python" reads each boundary
+    # once and tests batches of coordinates locally with NumPy (see
+    # `boundary_index.py`), which moves the spatial work off the shared
+    # database server.
+    boundary_engine = "sql"
+
+    # How new rows are found.  By default SQL Server anti-joins the candidate
+    # rows with the tracking tables.  With use_key_cache (needs NumPy), the
+    # published keys are kept in a local cache (see `key_cache.py`); SQL
+    # Server only reads the keys of the candidate rows, and the rows whose
+    # keys are not in the cache.  The cache is checked against the tracking
+    # tables every key_cache.Config.validate_hours.  The cache is for the
+    # default target; it is not used when syncing other targets.  Only the
+    # published keys are cached, so the rows outside their project boundary
+    # are never in the cache: each sync that scans them (every sync without
+    # change tracking, or with --full) stages their keys again and tests
+    # them against the boundary again.  For a project with many rows outside
+    # its boundary, that is a cost of every sync.
+    use_key_cache = False
+
+    # Update published rows that were corrected in Animal Movement.  A hash
+    # of the content of each row (see LOCATION_HASH and MOVEMENT_HASH) is
+    # saved with its key in the tracking tables, and the rows whose hash has
+    # changed are sent to Carto with batched INSERT ... ON CONFLICT DO UPDATE
+    # statements.  Requires the RowHash columns (run `schema.py`); the sync
+    # will not run without them.  Rows published before have no hash, so the
+    # first sync after turning this on updates every published row once.
+    # Each sync hashes the changed rows of each project, and joins them to
+    # the tracking tables on SQL Server, even with use_key_cache (the key
+    # cache only has the published keys, not their hashes).  With change
+    # tracking, those are just the rows changed since the last sync, so the
+    # key cache still saves the anti-join of every row for the new rows; but
+    # without change tracking (or with --full), every published row is hashed
+    # and joined, which is the work that use_key_cache saves.
+    update_changed_rows = False
+
+    # The projects whose movements are built from their locations (with
+    # NumPy, see `movement_builder.py`) instead of read from the Movements
+    # table, e.g. because their movements are missing or lag behind.  The
+    # movements of an animal are rebuilt when any of its locations change,
+    # and the published movements that no longer exist are removed.
+    # Removing a location is only noticed by a full sync (`--full`).
+    # e.g. derive_movements = ["KATM_BrownBear"]
+    derive_movements = []
+
+    # How geometries are sent to Carto.  "text" sends the well known text from
+    # SQL Server (and builds points with ST_Point()), which PostGIS must parse.
+    # "ewkb" reads movement shapes with STAsBinary() and sends all geometries
+    # as hex encoded extended WKB (with the SRID), which PostGIS decodes
+    # without parsing numbers.  Compare them with `benchmark.py`.
+    geometry_encoding = "text"
+
+    # The public map does not need full precision coordinates.  For the
+    # projects listed, coordinates are rounded to coordinate_digits decimal
+    # places (5 is about 1 m), and movements with more than two vertices are
+    # simplified to within simplify_tolerance degrees (see `generalize.py`).
+    # The bytes saved and the largest error are printed.  Projects not listed
+    # are published at full precision.
+    # e.g. coordinate_digits = {"KATM_BrownBear": 5}
+    coordinate_digits = {}
+    simplify_tolerance = {}
+
+    # Keep the animal_tracks table in Carto up to date.  It has one line for
+    # each animal and day, merged from the movements, so the map can draw
+    # tracks quickly at small scales.  Only the days with movements added or
+    # removed are rebuilt, tracks_per_request days at a time.  The days are
+    # saved in the batch journal until they are rebuilt.  When this is False,
+    # no days are saved (and the saved days are forgotten), so turning it
+    # back on does not rebuild the tracks of the days changed while it was off.
+    update_tracks = True
+    tracks_per_request = 200
+
+    # Where the metrics of each run are saved (see `run_metrics.py`).  A JSON
+    # record of each run is appended to metrics_log, and the metrics of the
+    # last run are written to metrics_textfile in the Prometheus text format
+    # (point it at the node_exporter textfile directory).  None to skip.
+    metrics_log = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "upload_runs.jsonl"
+    )
+    metrics_textfile = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "am2cartodb.prom"
+    )
 
-def get_connection_or_die(server, database):
+    # Service mode (`upload.py --serve`) keeps its connections open and checks
+    # for changes every poll_seconds.  A check is a single cheap query, so this
+    # can be short.  It needs change tracking (see enable_change_tracking());
+    # without it a check can not tell that nothing changed, so the service
+    # refuses to start rather than do a full sync every poll.  After losing the
+    # database connection, it waits reconnect_seconds before reconnecting,
+    # doubling the wait after each failure up to reconnect_max_seconds.
+    poll_seconds = 60
+    reconnect_seconds = 5
+    reconnect_max_seconds = 300
+
+
+# The name of the target at Config.base_url
+DEFAULT_TARGET = "default"
+
+
+class Target(object):
+    """
+    A Carto server to publish to, and the names of its tracking state.
+
+    The default target (Config.base_url) uses the original tracking tables,
+    sync state, and batch journal; the names of these for the other targets
+    (Config.more_targets) end with "_" and the target name.
+    """
+
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self, name=DEFAULT_TARGET, base_url=None):
+        self.name = name
+        self.is_default = name == DEFAULT_TARGET
+        self.suffix = "" if self.is_default else "_" + name
+        if base_url is None:
+            base_url = Config.base_url if self.is_default else Config.more_targets[name]
+        self.base_url = base_url
+
+    def table(self, name):
+        """Return the name of this target's SQL Server table name."""
+
+        return name + self.suffix
+
+    def apikey(self):
+        """Return the Carto API key for this target."""
+
+        return getattr(carto_secrets, "apikeys", {}).get(
+            self.name, carto_secrets.apikey
+        )
+
+    def journal(self):
+        """Return a new BatchJournal for this target."""
+
+        root, ext = os.path.splitext(batch_journal.Config.path)
+        return batch_journal.BatchJournal(root + self.suffix + ext)
+
+
+def get_targets(names=None):
+    """
+    Return a list of the Target for each name in names (all targets if None).
+
+    Exit with an error message if a name is not a target.
+    """
+    known = [DEFAULT_TARGET] + sorted(Config.more_targets)
+    if names is None:
+        names = known
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        print("Unknown target(s):", ", ".join(unknown))
+        print("The targets are:", ", ".join(known))
+        sys.exit()
+    return [Target(name) for name in names]
+
+
+def tracking_table(table, target=None):
+    """Return the name of the tracking table for table (e.g. "Locations") of target."""
+
+    name = table + "_In_CartoDB"
+    return name if target is None else target.table(name)
+
+
+# The timing and counters for each stage of the current run.
+METRICS = run_metrics.RunMetrics()
+
+# The published keys; only used once opened (see open_key_cache()).
+KEYS = key_cache.KeyCache() if key_cache is not None else None
+
+
+def get_connection(server, database):
     """
     Get a Trusted pyodbc connection to the SQL Server database on server.
 
     Try several connection strings.
     See https://github.com/mkleehammer/pyodbc/wiki/Connecting-to-SQL-Server-from-Windows
 
-    Exit with an error message if there is no successful connection.
+    Return None if there is no successful connection.
     """
     drivers = [
         "{ODBC Driver 17 for SQL Server}",  # supports SQL Server 2008 through 2017
@@ -78,6 +367,18 @@ def get_connection_or_die(server, database):
             return connection
         except pyodbc.Error:
             pass
+    return None
+
+
+def get_connection_or_die(server, database):
+    """
+    Get a Trusted pyodbc connection to the SQL Server database on server.
+
+    Exit with an error message if there is no successful connection.
+    """
+    connection = get_connection(server, database)
+    if connection is not None:
+        return connection
     print("Rats!! Unable to connect to the database.")
     print("Make sure you have an ODBC driver installed for SQL Server")
     print("and your AD account has the proper DB permissions.")
@@ -113,6 +414,17 @@ def make_movement_table_in_cartodb(carto):
     execute_sql_in_cartodb(carto, sql)
 
 
+def make_track_table_in_cartodb(carto):
+    """
+    Execute SQL on the carto server to create the Animal_Tracks table.
+
+    The table is also created by a migration (see `schema.py`).
+    """
+
+    for sql in schema.TRACK_TABLE_SQL:
+        execute_sql_in_cartodb(carto, sql)
+
+
 def execute_sql_in_cartodb(carto, sql):
     """Execute SQL statement sql on carto server connection."""
 
@@ -122,6 +434,25 @@ def execute_sql_in_cartodb(carto, sql):
         print("Carto error ocurred", ex)
 
 
+def utf8_length(text):
+    """Return the length of text in UTF-8 bytes."""
+
+    return len(text.encode("utf-8"))
+
+
+# Text in the error message of a Carto request that was too big (413 Request
+# Entity Too Large) or ran too long (cancelled by the statement timeout, so
+# nothing was written); a smaller request may succeed.
+RESIZE_ERRORS = ("413", "too large", "statement timeout", "query timeout")
+
+
+def is_resize_error(ex):
+    """Return True if the CartoException ex may not happen with a smaller request."""
+
+    message = "{0}".format(ex).lower()
+    return any(text in message for text in RESIZE_ERRORS)
+
+
 def chunks(items, count):
     """Yield successive count-sized chunks from list items."""
 
@@ -129,383 +460,3404 @@ def chunks(items, count):
         yield items[i : i + count]
 
 
-def make_cartodb_tracking_tables(connection):
-    """Execute SQL to create tracking tables on the SQL Server connection."""
+class RequestSizer(object):
+    """
+    Send lists of SQL text to carto in requests sized by bytes.
+
+    The size budget for each request adapts to the observed latency and
+    errors.  Use one sizer for similar requests, since the best size
+    depends on the kind of rows being sent.
+    """
 
-    sql = """
-        if not exists (select * from sys.tables where name='Locations_In_CartoDB')
-        create table Locations_In_CartoDB (fixid int NOT NULL PRIMARY KEY)
+    # pylint: disable=useless-object-inheritance
+
+    def __init__(self, max_bytes=None, min_bytes=None, target_seconds=None):
+        self.max_bytes = max_bytes or Config.max_request_bytes
+        self.min_bytes = min_bytes or Config.min_request_bytes
+        self.target_seconds = target_seconds or Config.target_request_seconds
+        self.budget = self.max_bytes
+        self.ceiling = self.max_bytes
+
+    def record(self, seconds, success):
+        """Adjust the size budget after a request that took seconds."""
+
+        if not success:
+            # Do not grow back to a size that has failed (for a while).
+            self.ceiling = max(self.min_bytes, self.budget * 3 // 4)
+            self.budget = max(self.min_bytes, self.budget // 2)
+            return
+        recovered = int(self.ceiling * (1 + Config.ceiling_recovery)) + 1
+        self.ceiling = min(self.max_bytes, recovered)
+        if seconds > self.target_seconds:
+            scale = self.target_seconds / seconds
+            self.budget = max(self.min_bytes, int(self.budget * scale))
+        elif seconds < self.target_seconds / 2:
+            self.budget = min(self.ceiling, int(self.budget * 1.25))
+
+    def take(self, texts, start, overhead):
+        """
+        Return the list of texts from start that fits in the budget.
+
+        overhead is the size (in UTF-8 bytes) of the rest of the request.
+        """
+        size = overhead
+        end = start
+        while end < len(texts):
+            length = utf8_length(texts[end])
+            if end > start and size + length >= self.budget:
+                break
+            size += length + 1
+            end += 1
+        return texts[start:end]
+
+    def send(self, carto, template, texts):
+        """
+        Send template.format(",".join(chunk)) for successive chunks of texts.
+
+        Each statement must be all or nothing, so a request that was too big or
+        too slow (see is_resize_error()) can be split into smaller requests and
+        tried again.  A CartoException is raised for any other error, or when
+        a single text fails or the budget can not get any smaller.
+        """
+        start = 0
+        overhead = utf8_length(template)
+        while start < len(texts):
+            chunk = self.take(texts, start, overhead)
+            budget = self.budget
+            begin = time.time()
+            try:
+                carto.send(template.format(",".join(chunk)))
+            except CartoException as ex:
+                self.record(time.time() - begin, False)
+                if not is_resize_error(ex) or len(chunk) == 1 or self.budget == budget:
+                    raise
+                continue
+            self.record(time.time() - begin, True)
+            start += len(chunk)
+
+
+def make_cartodb_tracking_tables(connection, target=None):
+    """
+    Execute SQL to create tracking tables on the SQL Server connection.
+
+    The tables are for target (a Target), or the default target if None.
+    The tables are made with their content hash (RowHash) columns; older
+    tables of the default target get them from a migration (see `schema.py`).
     """
+
+    locations = tracking_table("Locations", target)
+    movements = tracking_table("Movements", target)
+    sql = """
+        if not exists (select * from sys.tables where name='{0}')
+        create table {0} (fixid int NOT NULL PRIMARY KEY)
+    """.format(locations)
     sql2 = """
-        if not exists (select * from sys.tables where name='Movements_In_CartoDB')
-          create table Movements_In_CartoDB (
+        if not exists (select * from sys.tables where name='{0}')
+          create table {0} (
             ProjectId varchar(16) NOT NULL,
             AnimalId varchar(16) NOT NULL,
             StartDate datetime2(7) NOT NULL,
             EndDate datetime2(7) NOT NULL
-            CONSTRAINT PK_Movements_In_CartoDB PRIMARY KEY CLUSTERED (
+            CONSTRAINT PK_{0} PRIMARY KEY CLUSTERED (
               ProjectId ASC, AnimalId ASC, StartDate ASC, EndDate ASC))
+    """.format(movements)
+    sql3 = """
+        if not exists (select * from sys.tables where name='CartoDB_Sync_State')
+          create table CartoDB_Sync_State (
+            Name varchar(50) NOT NULL PRIMARY KEY,
+            Version bigint NULL,
+            SyncDate datetime2(7) NOT NULL)
     """
+    sql4 = """
+        if not exists (select * from sys.tables where name='{0}')
+          create table {0} (
+            Project varchar(16) NOT NULL PRIMARY KEY,
+            Fingerprint varbinary(32) NULL,
+            SaveDate datetime2(7) NOT NULL)
+    """.format(boundary_state_table(target))
     w_cursor = connection.cursor()
     w_cursor.execute(sql)
     w_cursor.execute(sql2)
+    w_cursor.execute(sql3)
+    w_cursor.execute(sql4)
+    for table in (locations, movements):
+        w_cursor.execute(schema.add_column_sql((table, "RowHash", "binary(16) NULL")))
     try:
         w_cursor.commit()
     except pyodbc.Error as ex:
         print("Database error ocurred", ex)
-        print("Unable to add create the 'Locations_In_CartoDB' table.")
+        print("Unable to add create the '{0}' table.".format(locations))
 
 
-def add_locations_to_carto_tracking_table(connection, fids):
-    """Execute SQL to track location fids on the SQL Server connection."""
+def get_missing_row_hashes(connection, targets=None):
+    """
+    Return a list of the tracking tables of targets without a RowHash column.
 
-    # SQL Server is limited to 1000 rows in an insert
-    w_cursor = connection.cursor()
-    sql = "INSERT Locations_In_CartoDB (fixid) values "
-    for chunk in chunks(fids, 900):
-        values = ",".join(["({0})".format(fid) for fid in chunk])
-        # print(sql + values)
-        w_cursor.execute(sql + values)
+    targets is a list of Target (the default target if None).
+    """
+    missing = []
+    sql = "select col_length(?, 'RowHash')"
+    r_cursor = connection.cursor()
     try:
-        w_cursor.commit()
-    except pyodbc.Error as ex:
-        print("Database error ocurred", ex)
-        print("Unable to add these ids to the 'Locations_In_CartoDB' table.")
-        print(fids)
+        for target in targets or [Target()]:
+            for table in ("Locations", "Movements"):
+                table = tracking_table(table, target)
+                if r_cursor.execute(sql, table).fetchone()[0] is None:
+                    missing.append(table)
+    finally:
+        r_cursor.close()
+    return missing
 
 
-def add_movements_to_carto_tracking_table(connection, rows):
-    """Execute SQL to track movement rows on the SQL Server connection."""
-
-    # SQL Server is limited to 1000 rows in an insert
-    w_cursor = connection.cursor()
-    sql = """
-        insert into Movements_In_CartoDB
-        (projectid, animalid, startdate, enddate) values
+def report_missing_row_hashes(connection, targets=None):
     """
-    for chunk in chunks(rows, 900):
-        values = ",".join(["('{0}','{1}','{2}','{3}')".format(*row) for row in chunk])
-        # print(sql + values)
-        w_cursor.execute(sql + " " + values)
-    try:
-        w_cursor.commit()
-    except pyodbc.Error as ex:
-        print("Database error ocurred", ex)
-        print("Unable to add these rows to the 'Movements_In_CartoDB' table.")
-        print(rows)
-
+    Return True, after printing an error message, if Config.update_changed_rows
+    is True, and the tracking tables of targets do not have their RowHash
+    columns.
+    """
+    if not Config.update_changed_rows:
+        return False
+    missing = get_missing_row_hashes(connection, targets)
+    if not missing:
+        return False
+    print("Config.update_changed_rows needs a RowHash column in:", ", ".join(missing))
+    print("Run `python schema.py` (or make_sqlserver_tables()) first.")
+    return True
 
-def remove_locations_from_carto_tracking_table(connection, fids):
-    """Execute SQL to un-track location fids on the SQL Server connection."""
 
-    w_cursor = connection.cursor()
-    sql = "delete from Locations_In_CartoDB where fixid in "
-    # Protection from really long lists, by executing multiple queries.
-    for chunk in chunks(fids, 900):
-        ids = "(" + ",".join(["{0}".format(fid) for fid in chunk]) + ")"
-        w_cursor.execute(sql + ids)
-    try:
-        w_cursor.commit()
-    except pyodbc.Error as ex:
-        print("Database error ocurred", ex)
-        print("Unable to delete these ids from the 'Locations_In_CartoDB' table.")
-        print(fids)
+def check_row_hashes_or_die(connection, targets=None):
+    """
+    Exit with an error status if the tracking tables of targets do not have
+    the RowHash columns needed by Config.update_changed_rows.
+    """
+    if report_missing_row_hashes(connection, targets):
+        sys.exit(1)
 
 
-def remove_movements_from_carto_tracking_table(connection, rows):
-    """Execute SQL to un-track movement rows on the SQL Server connection."""
+def enable_change_tracking(connection):
+    """
+    Execute SQL to turn on change tracking for the source tables.
 
-    w_cursor = connection.cursor()
+    Change tracking lets a sync read only the locations and movements that
+    have changed since the last successful sync.  It requires ALTER permission
+    on the database; it only needs to be done once.
+    """
+    database = Config.am_database
     sql = """
-        delete from Movements_In_CartoDB where
-        projectid = '{0}' and animalid = '{1}'
-        and startdate = '{2}' and enddate = '{3}'
+        if not exists (select * from sys.change_tracking_databases
+                       where database_id = db_id('{0}'))
+          alter database [{0}] set change_tracking = on
+          (change_retention = 14 days, auto_cleanup = on)
+    """.format(database)
+    sql2 = """
+        if not exists (select * from sys.change_tracking_tables
+                       where object_id = object_id('{0}'))
+          alter table {0} enable change_tracking
     """
-    for row in rows:
-        sql1 = sql.format(row[0], row[1], row[2], row[3])
-        w_cursor.execute(sql1)
+    connection.autocommit = True
+    w_cursor = connection.cursor()
     try:
-        w_cursor.commit()
+        w_cursor.execute(sql)
+        w_cursor.execute(sql2.format("Locations"))
+        w_cursor.execute(sql2.format("Movements"))
     except pyodbc.Error as ex:
         print("Database error ocurred", ex)
-        print("Unable to delete these rows from the 'Movements_In_CartoDB' table.")
-        print(rows)
+        print("Unable to enable change tracking on the source tables.")
+    finally:
+        connection.autocommit = False
 
 
-def fetch_rows(connection, sql):
-    """Execute SQL statement sql on the SQL Server connection and return rows."""
+def sync_state_name(target=None):
+    """Return the name of the sync state of target (the default if None)."""
 
-    r_cursor = connection.cursor()
-    try:
-        rows = r_cursor.execute(sql).fetchall()
-    except pyodbc.Error as ex:
-        print("Database error ocurred", ex)
-        rows = None
-    return rows
+    return "upload" if target is None else target.table("upload")
 
 
-def get_locations_for_carto(connection, project):
-    """Return the new locations for project from the SQL Server connection."""
+def boundary_state_table(target=None):
+    """Return the name of the boundary fingerprint table of target."""
 
-    sql = """
-        select l.projectid, l.animalid, l.fixid, l.fixdate,
-        location.Lat, Location.Long from locations as l
-        left join ProjectExportBoundaries as b on b.Project = l.ProjectId
-        left join Locations_In_CartoDB as c on l.fixid = c.fixid
-        where c.FixId is null -- not in Carto
-        and l.ProjectID = '{project}' -- belongs to project
-        and l.[status] IS NULL -- not hidden
-        and (b.shape is null or b.Shape.STContains(l.Location) = 1)
-    """  # inside boundary
-    return fetch_rows(connection, sql.format(project=project))
+    table = "CartoDB_Boundary_State"
+    return table if target is None else target.table(table)
 
 
-def get_vectors_for_carto(connection, project):
-    """Return the new movements for project from the SQL Server connection."""
+def get_change_versions(connection, target=None):
+    """
+    Return the change tracking versions (last, current) for a sync.
 
+    last is the version of the last successful sync of target (the default
+    target if None), or None if there has not been one, or it is older than
+    the change tracking retention period.  In either case a full reconcile
+    is required.  current is the version to save when this sync succeeds, or
+    None if change tracking is not enabled on the source tables.
+    """
     sql = """
-        select m.Projectid, m.AnimalId, m.StartDate, m.EndDate, m.Duration, m.Distance, m.Speed,
-        m.Shape.ToString() from movements as m
-        inner join ProjectExportBoundaries as b on b.Project = m.ProjectId
-        left join Movements_In_CartoDB as c
-        on m.ProjectId = c.ProjectId and m.AnimalId = c.AnimalId
-        and m.StartDate = c.StartDate and m.EndDate = c.EndDate
-        where c.ProjectId IS NULL  -- not in Carto
-        and m.ProjectId = '{project}'  -- belongs to project
-        and Distance > 0  -- not a degenerate
-        and (b.shape is null or b.Shape.STContains(m.shape) = 1)
-    """  # inside boundary
-    return fetch_rows(connection, sql.format(project=project))
+        select s.Version, CHANGE_TRACKING_CURRENT_VERSION(),
+        CHANGE_TRACKING_MIN_VALID_VERSION(object_id('Locations')),
+        CHANGE_TRACKING_MIN_VALID_VERSION(object_id('Movements'))
+        from (select 1 as one) as t
+        left join CartoDB_Sync_State as s on s.Name = '{0}'
+    """.format(sync_state_name(target))
+    rows = fetch_rows(connection, sql)
+    if not rows:
+        return None, None
+    last, current, min_locations, min_movements = rows[0]
+    if current is None or min_locations is None or min_movements is None:
+        return None, None
+    if last is None or last < min_locations or last < min_movements:
+        return None, current
+    return last, current
+
+
+def save_change_version(connection, version, target=None):
+    """Execute SQL to save the change tracking version of a successful sync of target."""
 
+    sql = """
+        merge CartoDB_Sync_State as s
+        using (select '{0}' as Name) as n on s.Name = n.Name
+        when matched then update set Version = ?, SyncDate = sysdatetime()
+        when not matched then insert (Name, Version, SyncDate)
+          values ('{0}', ?, sysdatetime());
+    """.format(sync_state_name(target))
+    w_cursor = connection.cursor()
+    w_cursor.execute(sql, version, version)
+    try:
+        w_cursor.commit()
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        print("Unable to save the sync version", version)
 
-def fixlocationrow(row):
-    """Return a modified location row; from SQL Server to Postgres (carto)."""
 
-    text = "('{0}','{1}',{2},'{3}',ST_SetSRID(ST_Point({5},{4}),4326))"
-    return text.format(*row)
+def boundary_fingerprint(wkb):
+    """
+    Return the fingerprint (bytes) of the well known binary wkb of a boundary.
 
+    The fingerprint is the SHA-256 hash of wkb, the same as
+    HASHBYTES('SHA2_256', wkb) in SQL Server, but it is computed here, as
+    HASHBYTES is limited to 8000 bytes of input before SQL Server 2016.  It is
+    None if wkb is None (a null shape).
+    """
+    if wkb is None:
+        return None
+    return hashlib.sha256(bytes(wkb)).digest()
 
-def fixmovementrow(row):
-    """Return a modified movement row; from SQL Server to Postgres (carto)."""
 
-    text = "('{0}','{1}','{2}','{3}',{4},{5},{6},ST_GeometryFromText('{7}',4326))"
-    return text.format(*row)
+def get_current_fingerprints(connection):
+    """
+    Return a dictionary of the current boundary fingerprint of each project.
+
+    The fingerprint is of the project's shape in ProjectExportBoundaries (see
+    boundary_fingerprint()).  Return None if there was a database error.
+    """
+    sql = "select Project, Shape.STAsBinary() from ProjectExportBoundaries"
+    rows = fetch_rows(connection, sql)
+    if rows is None:
+        return None
+    return dict((row[0], boundary_fingerprint(row[1])) for row in rows)
 
 
-def insert(database, carto, l_rows, v_rows):
+def get_changed_boundaries(connection, current, target=None):
     """
-    Send locations and movement vectors from connection to carto.
+    Return the projects whose export boundary changed since the last sync.
 
-    locations (l_rows) and movement vectors (v_rows) will be marked as tracked
-    on the source SQL Server connection and inserted on the tables on carto.
+    current is the dictionary of the current fingerprints (see
+    get_current_fingerprints()).  A project is changed if its boundary was
+    added, removed, or edited since the last successful sync of target (the
+    default target if None).  Return None if the fingerprints could not be
+    read; all boundaries need to be checked.
     """
-    if not l_rows:
-        print("No locations to send to Carto.")
-    if not v_rows:
-        print("No movements to send to Carto.")
-    if not l_rows and not v_rows:
-        return
-    if v_rows:
-        try:
-            sql = """
-                insert into animal_movements
-                (projectid, animalid, startdate, enddate, duration,
-                distance, speed, the_geom) values
-            """
-            # Protection from really long lists, by executing multiple queries.
-            for chunk in chunks(v_rows, 900):
-                values = ",".join([fixmovementrow(row) for row in chunk])
-                # print(sql + values)
-                carto.send(sql + values)
-            try:
-                add_movements_to_carto_tracking_table(database, v_rows)
-                print("Wrote {0} movements to Carto.".format(len(v_rows)))
-            except pyodbc.Error as ex:
-                print("Database error ocurred", ex)
-        except CartoException as ex:
-            print("Carto error ocurred", ex)
-    if l_rows:
-        try:
-            sql = """
-                insert into animal_locations
-                (projectid,animalid,fixid,fixdate,the_geom) values
-            """
-            ids, values = zip(*[(row[2], fixlocationrow(row)) for row in l_rows])
-            # Protection from really long lists, by executing multiple queries.
-            for chunk in chunks(values, 900):
-                values = ",".join(chunk)
-                # (sql + values)
-                carto.send(sql + values)
-            try:
-                add_locations_to_carto_tracking_table(database, ids)
-                print("Wrote {0} locations to Carto.".format(len(ids)))
-            except pyodbc.Error as ex:
-                print("Database error ocurred", ex)
-        except CartoException as ex:
-            print("Carto error ocurred", ex)
+    sql = "select Project, Fingerprint from {0}".format(boundary_state_table(target))
+    saved = fetch_rows(connection, sql)
+    if current is None or saved is None:
+        return None
+    saved = dict((row[0], None if row[1] is None else bytes(row[1])) for row in saved)
+    projects = set(current) | set(saved)
+    return sorted(p for p in projects if current.get(p, -1) != saved.get(p, -1))
 
 
-def get_locations_to_remove(connection):
+def save_boundary_fingerprints(connection, fingerprints, target=None):
     """
-    Return the locations in SQL Server connection that should be removed from carto.
+    Execute SQL to save the boundary fingerprints after a sync of target.
 
-    Check the list of location in Carto with the current status of locations
-    (hidden or deleted) or the boundary shape may have changed.
+    fingerprints is the dictionary of the fingerprints read at the start of
+    the sync (see get_current_fingerprints()), so a boundary edited during
+    the sync is checked again by the next one.
     """
     sql = """
-        select c.fixid from Locations_In_CartoDB as c
-        left join Locations as l on l.FixId = c.fixid
-        left join ProjectExportBoundaries as b on b.Project = l.ProjectId
-        where l.FixId is null -- not in location table any longer
-        or l.status is not null -- location is now hidden
-        or (b.shape is not null and b.shape.STContains(l.Location) = 0)
-    """
-    return fetch_rows(connection, sql)
+        insert {0} (Project, Fingerprint, SaveDate)
+        values (?, convert(varbinary(32), ?), sysdatetime())
+    """.format(boundary_state_table(target))
+    w_cursor = connection.cursor()
+    try:
+        w_cursor.execute("delete {0}".format(boundary_state_table(target)))
+        if fingerprints:
+            w_cursor.executemany(sql, sorted(fingerprints.items()))
+        w_cursor.commit()
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        print("Unable to save the boundary fingerprints.")
 
 
-def get_vectors_to_remove(connection):
+def boundary_filter(alias, projects):
     """
-    Return the movements in SQL Server connection that should be removed from carto.
+    Return an SQL condition limiting the boundary check to projects.
 
-    Check the list of movements in Carto with the current status of movements
-    (deleted) or the boundary shape may have changed. Note: the attributes of a
-    movement are immutable, so we do not need to check them.
-    """
-    sql = """
-        select c.Projectid, c.AnimalId, c.StartDate, c.EndDate
-        from Movements_In_CartoDB as c left join movements as m
-        on m.ProjectId = c.ProjectId and m.AnimalId = c.AnimalId
-        and m.StartDate = c.StartDate and m.EndDate = c.EndDate
-        left join ProjectExportBoundaries as b on b.Project = m.ProjectId
-        where m.projectid is null -- not in movement database anylonger
-        or (b.shape is not null and b.shape.STContains(m.shape) = 0)
+    The condition is on the ProjectId column of the source table alias.
+    If projects is None, the boundary is checked for all projects.
     """
-    return fetch_rows(connection, sql)
+    if projects is None:
+        return ""
+    if not projects:
+        return "1 = 0 and"
+    names = ",".join(["'{0}'".format(project) for project in projects])
+    return "{0}.ProjectId in ({1}) and".format(alias, names)
 
 
-def remove(database, carto, l_rows, v_rows):
+def derived_filter(alias):
     """
-    Remove locations and movement vectors from carto.
+    Return a SQL filter for the movements not built from locations.
 
-    locations (l_rows) and movement vectors (v_rows) will be marked as un-tracked
-    on the source SQL Server connection and removed from the tables on carto.
+    The filter (with a trailing and) excludes the projects in
+    Config.derive_movements; it is empty if there are none.
     """
-    if not l_rows:
-        print("No locations to remove from Carto.")
-    if not v_rows:
-        print("No movements to remove from Carto.")
-    if not l_rows and not v_rows:
-        return
-    if v_rows:
-        try:
-            sql = """
-                delete from animal_movements where
-                projectid = '{0}' and animalid = '{1}'
-                and startdate = '{2}' and enddate = '{3}'
-            """
-            for row in v_rows:
-                sql1 = sql.format(row[0], row[1], row[2], row[3])
-                carto.send(sql1)
-            try:
-                remove_movements_from_carto_tracking_table(database, v_rows)
-                print("Removed {0} Movements from Carto.".format(len(v_rows)))
-            except pyodbc.Error as ex:
-                print(
-                    "SQLServer error occurred.  Movements removed from Carto, but not SQLServer",
-                    ex,
-                )
-        except CartoException as ex:
-            print("Carto error occurred removing movements.", ex)
-    if l_rows:
-        try:
-            sql = "delete from animal_locations where fixid in "
-            ids = [row[0] for row in l_rows]
-            # Protection from really long lists, by executing multiple queries.
-            for chunk in chunks(ids, 900):
-                id_str = "(" + ",".join(["{0}".format(i) for i in chunk]) + ")"
-                carto.send(sql + id_str)
-            try:
-                remove_locations_from_carto_tracking_table(database, ids)
-                print("Removed {0} locations from Carto.".format(len(ids)))
-            except pyodbc.Error as ex:
-                print(
-                    "SQLServer error occurred.  Locations removed from Carto, but not SQLServer",
-                    ex,
-                )
-        except CartoException as ex:
-            print("Carto error occurred removing locations.", ex)
+    if not Config.derive_movements:
+        return ""
+    names = ",".join(["'{0}'".format(project) for project in Config.derive_movements])
+    return "{0}.ProjectId not in ({1}) and".format(alias, names)
 
 
-def fix_format_of_vector_columns(carto):
+def changed(table, key, alias, since):
     """
-    Populate the derived/formatted text fields in the carto database.
+    Return the SQL source for rows in table, or only those changed since.
 
-    The Duration, Speed, and Duration values are numeric which display
-    a lot of noise.  For reasons now forgotten, I created text fields
-    with the values rounded to 1 decimal place.
+    The source is table with alias if since (a change tracking version) is
+    None, otherwise it is the change tracking table for table joined to the
+    current rows on the key columns; deleted rows are not included.
     """
+    if since is None:
+        return "{0} as {1}".format(table, alias)
+    join = " and ".join(["{0}.{1} = ct.{1}".format(alias, column) for column in key])
+    return "CHANGETABLE(CHANGES {0}, {1}) as ct join {0} as {2} on {3}".format(
+        table, int(since), alias, join
+    )
 
-    sql = """
-        update animal_movements
-        set distance_t=round(cast(distance as numeric),1)
-        where distance_t is null
-    """
-    execute_sql_in_cartodb(carto, sql)
-    sql = """
-        update animal_movements
-        set duration_t=round(cast(duration as numeric),1)
-        where duration_t is null
+
+def changed_keys(table, key, since, target=None):
     """
-    execute_sql_in_cartodb(carto, sql)
-    sql = """
-        update animal_movements
-        set speed_t=round(cast(speed as numeric),1)
-        where speed_t is null
+    Return the SQL source for tracking rows that may need to be removed.
+
+    The source is the tracking table of target (the default target if None)
+    for table (all rows if since is None) or just the tracked rows whose
+    source row has changed (or been deleted) since the change tracking
+    version since.
     """
-    execute_sql_in_cartodb(carto, sql)
+    tracking = tracking_table(table, target)
+    if since is None:
+        return "{0} as c".format(tracking)
+    join = " and ".join(["c.{0} = ct.{0}".format(column) for column in key])
+    return "CHANGETABLE(CHANGES {0}, {1}) as ct join {2} as c on {3}".format(
+        table, int(since), tracking, join
+    )
 
 
-def get_auth_carto_sql_connection():
-    """Return a authorized SQL connection to the carto database, using the secrets."""
+LOCATION_KEY = ["FixId"]
+MOVEMENT_KEY = ["ProjectId", "AnimalId", "StartDate", "EndDate"]
 
-    auth_client = APIKeyAuthClient(
-        api_key=carto_secrets.apikey,
-        base_url=Config.base_url,
-    )
-    return SQLClient(auth_client)
+# SQL Server expressions for a hash of the content of a location (l) or
+# movement (m) that is published to Carto; the key of a movement is not
+# included since a new key is a new movement.  Before SQL Server 2016,
+# hashbytes() is limited to 8000 bytes of input, which is far more than the
+# text of a location, or a movement's short line.
+LOCATION_HASH = """hashbytes('MD5', concat(l.ProjectId, '|', l.AnimalId, '|',
+        convert(varchar(27), l.FixDate, 121), '|',
+        convert(varchar(max), l.Location.STAsBinary(), 2)))"""
+MOVEMENT_HASH = """hashbytes('MD5', concat(
+        convert(varchar(max), cast(m.Duration as varbinary(8)), 2), '|',
+        convert(varchar(max), cast(m.Distance as varbinary(8)), 2), '|',
+        convert(varchar(max), cast(m.Speed as varbinary(8)), 2), '|',
+        convert(varchar(max), m.Shape.STAsBinary(), 2)))"""
 
 
-def make_carto_tables():
-    """Create the movement and location tables in Carto."""
+def target_sql(table, alias, key, targets, row_hash=None):
+    """
+    Return SQL (joins, condition, mask) for the rows of alias that targets need.
+
+    The joins join the rows to the tracking table for table (e.g. "Locations")
+    of each target in targets on the key columns, as c (one target) or c0,
+    c1, ... (several targets).  A target needs a row if it is not tracked, or
+    if row_hash (SQL for the content hash of the row) is not None, if it is
+    tracked with a different (or unknown) hash.  The condition is true if
+    any target needs the row.  With several targets, the mask is SQL for a
+    number with bit i set if targets[i] needs the row (see fan_out()); with
+    one target it is empty.
+    """
+    names = ["c"]
+    if len(targets) > 1:
+        names = ["c{0}".format(i) for i in range(len(targets))]
+    join = "join" if row_hash is not None and len(targets) == 1 else "left join"
+    joins = []
+    needs = []
+    for target, name in zip(targets, names):
+        on = " and ".join(["{0}.{1} = {2}.{1}".format(alias, c, name) for c in key])
+        table_name = tracking_table(table, target)
+        joins.append("{0} {1} as {2} on {3}".format(join, table_name, name, on))
+        if row_hash is None:
+            needs.append("{0}.{1} is null".format(name, key[0]))
+        elif len(targets) == 1:
+            needs.append(
+                "{0}.RowHash is null or {0}.RowHash <> {1}".format(name, row_hash)
+            )
+        else:
+            need = (
+                "({0}.{1} is not null and ({0}.RowHash is null or {0}.RowHash <> {2}))"
+            )
+            needs.append(need.format(name, key[0], row_hash))
+    mask = ""
+    if len(targets) > 1:
+        cases = [
+            "case when {0} then {1} else 0 end".format(need, 1 << i)
+            for i, need in enumerate(needs)
+        ]
+        mask = "({0})".format(" + ".join(cases))
+    return "\n        ".join(joins), " or ".join(needs), mask
+
+
+def execute_many(cursor, sql, params):
+    """
+    Execute the parameterized sql once for each tuple in params on cursor.
 
-    carto_conn = get_auth_carto_sql_connection()
-    make_location_table_in_cartodb(carto_conn)
-    make_movement_table_in_cartodb(carto_conn)
+    Uses the pyodbc fast_executemany option which sends the parameters to
+    SQL Server in large arrays instead of one round trip per row.  The
+    parameters are sent in chunks to limit the memory used by the driver.
+    """
+    cursor.fast_executemany = True
+    for chunk in chunks(params, Config.tracking_batch_size):
+        cursor.executemany(sql, chunk)
 
 
-def make_sqlserver_tables():
-    """Create the tracking tables in SQL Server."""
+def add_locations_to_carto_tracking_table(connection, fids, hashes=None, target=None):
+    """
+    Execute SQL to track location fids on the SQL Server connection.
 
-    am_conn = get_connection_or_die("inpakrovmais", "animal_movement")
-    make_cartodb_tracking_tables(am_conn)
+    If hashes is not None, it is a list with the content hash of each fid;
+    if it has no unknown (None) hashes, they are saved with the fids.
+    The fids are tracked for target (a Target), or the default target if None.
+    Return True if the fids were tracked, False otherwise.
+    """
 
+    if not fids:
+        return True
+    table = tracking_table("Locations", target)
+    w_cursor = connection.cursor()
+    if hashes and None not in hashes:
+        sql = "INSERT {0} (fixid, RowHash) values (?, ?)".format(table)
+        execute_many(w_cursor, sql, list(zip(fids, hashes)))
+    else:
+        sql = "INSERT {0} (fixid) values (?)".format(table)
+        execute_many(w_cursor, sql, [(fid,) for fid in fids])
+    try:
+        w_cursor.commit()
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        print("Unable to add these ids to the '{0}' table.".format(table))
+        print(fids)
+        return False
+    return True
 
-def main():
-    """Update the Carto tables with changes in the Animal Movements tables."""
 
-    carto_conn = get_auth_carto_sql_connection()
-    am_conn = get_connection_or_die("inpakrovmais", "animal_movement")
-    locations = get_locations_to_remove(am_conn)
-    vectors = get_vectors_to_remove(am_conn)
-    remove(am_conn, carto_conn, locations, vectors)
-    for project in ["KATM_BrownBear"]:
-        locations = get_locations_for_carto(am_conn, project)
-        vectors = get_vectors_for_carto(am_conn, project)
-        insert(am_conn, carto_conn, locations, vectors)
-    fix_format_of_vector_columns(carto_conn)
+def add_movements_to_carto_tracking_table(connection, rows, hashes=None, target=None):
+    """
+    Execute SQL to track movement rows on the SQL Server connection.
 
+    If hashes is not None, it is a list with the content hash of each row;
+    if it has no unknown (None) hashes, they are saved with the keys.
+    The rows are tracked for target (a Target), or the default target if None.
+    Return True if the rows were tracked, False otherwise.
+    """
 
-if __name__ == "__main__":
-    # make_carto_tables()
-    # make_sqlserver_tables()
-    main()
+    if not rows:
+        return True
+    table = tracking_table("Movements", target)
+    w_cursor = connection.cursor()
+    if hashes and None not in hashes:
+        sql = """
+            insert into {0}
+            (projectid, animalid, startdate, enddate, RowHash)
+            values (?, ?, ?, ?, ?)
+        """.format(table)
+        params = [tuple(row[:4]) + (value,) for row, value in zip(rows, hashes)]
+        execute_many(w_cursor, sql, params)
+    else:
+        sql = """
+            insert into {0}
+            (projectid, animalid, startdate, enddate) values (?, ?, ?, ?)
+        """.format(table)
+        execute_many(w_cursor, sql, [tuple(row[:4]) for row in rows])
+    try:
+        w_cursor.commit()
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        print("Unable to add these rows to the '{0}' table.".format(table))
+        print(rows)
+        return False
+    return True
+
+
+def remove_locations_from_carto_tracking_table(connection, fids, target=None):
+    """Execute SQL to un-track location fids of target on the SQL Server connection."""
+
+    if not fids:
+        return
+    table = tracking_table("Locations", target)
+    # Load the ids into a staging table, then delete with a single join.
+    w_cursor = connection.cursor()
+    w_cursor.execute(
+        """
+        if object_id('tempdb..#Locations_To_Remove') is not null
+          drop table #Locations_To_Remove
+        create table #Locations_To_Remove (fixid int NOT NULL PRIMARY KEY)
+    """
+    )
+    sql = "insert into #Locations_To_Remove (fixid) values (?)"
+    execute_many(w_cursor, sql, [(fid,) for fid in fids])
+    sql = """
+        delete c from {0} as c
+        join #Locations_To_Remove as r on r.fixid = c.fixid
+        drop table #Locations_To_Remove
+    """
+    w_cursor.execute(sql.format(table))
+    try:
+        w_cursor.commit()
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        print("Unable to delete these ids from the '{0}' table.".format(table))
+        print(fids)
+
+
+def remove_movements_from_carto_tracking_table(connection, rows, target=None):
+    """Execute SQL to un-track movement rows of target on the SQL Server connection."""
+
+    if not rows:
+        return
+    table = tracking_table("Movements", target)
+    # Load the keys into a staging table, then delete with a single join.
+    w_cursor = connection.cursor()
+    w_cursor.execute(
+        """
+        if object_id('tempdb..#Movements_To_Remove') is not null
+          drop table #Movements_To_Remove
+        create table #Movements_To_Remove (
+          ProjectId varchar(16) NOT NULL,
+          AnimalId varchar(16) NOT NULL,
+          StartDate datetime2(7) NOT NULL,
+          EndDate datetime2(7) NOT NULL)
+    """
+    )
+    sql = """
+        insert into #Movements_To_Remove
+        (projectid, animalid, startdate, enddate) values (?, ?, ?, ?)
+    """
+    execute_many(w_cursor, sql, [tuple(row[:4]) for row in rows])
+    sql = """
+        delete c from {0} as c
+        join #Movements_To_Remove as r
+        on r.ProjectId = c.ProjectId and r.AnimalId = c.AnimalId
+        and r.StartDate = c.StartDate and r.EndDate = c.EndDate
+        drop table #Movements_To_Remove
+    """
+    w_cursor.execute(sql.format(table))
+    try:
+        w_cursor.commit()
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        print("Unable to delete these rows from the '{0}' table.".format(table))
+        print(rows)
+
+
+def update_location_hashes(connection, fids, hashes, target=None):
+    """Execute SQL to save the new content hashes of location fids of target."""
+
+    if not fids:
+        return
+    # Load the hashes into a staging table, then update with a single join.
+    w_cursor = connection.cursor()
+    w_cursor.execute(
+        """
+        if object_id('tempdb..#Location_Hashes') is not null
+          drop table #Location_Hashes
+        create table #Location_Hashes (
+          fixid int NOT NULL PRIMARY KEY,
+          RowHash binary(16) NOT NULL)
+    """
+    )
+    sql = "insert into #Location_Hashes (fixid, RowHash) values (?, ?)"
+    execute_many(w_cursor, sql, list(zip(fids, hashes)))
+    sql = """
+        update c set RowHash = h.RowHash from {0} as c
+        join #Location_Hashes as h on h.fixid = c.fixid
+        drop table #Location_Hashes
+    """
+    w_cursor.execute(sql.format(tracking_table("Locations", target)))
+    w_cursor.commit()
+
+
+def update_movement_hashes(connection, rows, hashes, target=None):
+    """Execute SQL to save the new content hashes of movement rows of target."""
+
+    if not rows:
+        return
+    # Load the hashes into a staging table, then update with a single join.
+    w_cursor = connection.cursor()
+    w_cursor.execute(
+        """
+        if object_id('tempdb..#Movement_Hashes') is not null
+          drop table #Movement_Hashes
+        create table #Movement_Hashes (
+          ProjectId varchar(16) NOT NULL,
+          AnimalId varchar(16) NOT NULL,
+          StartDate datetime2(7) NOT NULL,
+          EndDate datetime2(7) NOT NULL,
+          RowHash binary(16) NOT NULL)
+    """
+    )
+    sql = """
+        insert into #Movement_Hashes
+        (projectid, animalid, startdate, enddate, RowHash) values (?, ?, ?, ?, ?)
+    """
+    params = [tuple(row[:4]) + (value,) for row, value in zip(rows, hashes)]
+    execute_many(w_cursor, sql, params)
+    sql = """
+        update c set RowHash = h.RowHash from {0} as c
+        join #Movement_Hashes as h
+        on h.ProjectId = c.ProjectId and h.AnimalId = c.AnimalId
+        and h.StartDate = c.StartDate and h.EndDate = c.EndDate
+        drop table #Movement_Hashes
+    """
+    w_cursor.execute(sql.format(tracking_table("Movements", target)))
+    w_cursor.commit()
+
+
+def fetch_rows(connection, sql):
+    """Execute SQL statement sql on the SQL Server connection and return rows."""
+
+    r_cursor = connection.cursor()
+    try:
+        rows = r_cursor.execute(sql).fetchall()
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        rows = None
+    return rows
+
+
+def fetch_batches(connection, sql, size):
+    """
+    Execute SQL statement sql on the SQL Server connection and yield rows.
+
+    Rows are fetched and yielded in lists of at most size rows, so the whole
+    result is never in memory.  The connection is busy until all the rows have
+    been fetched (or the generator is closed).  A database error is printed
+    and raised, so that a partial result is not mistaken for a complete one.
+    """
+
+    r_cursor = connection.cursor()
+    try:
+        r_cursor.execute(sql)
+        while True:
+            rows = r_cursor.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        raise
+    finally:
+        r_cursor.close()
+
+
+def prefetch(iterable, depth=2):
+    """
+    Yield the items in iterable while a thread works on the next depth items.
+
+    This lets the (slow) work of producing the items overlap with the work of
+    consuming them while limiting the number of items in memory.  An exception
+    in the producer is raised in the consumer.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        """Put item on the queue; return False if the consumer has stopped."""
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        """Put each item in iterable on the queue, followed by done."""
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+            put((done, None))
+        # pylint: disable=broad-except
+        # The exception is raised again in the consumer.
+        except Exception as ex:
+            put((done, ex))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def use_python_boundaries():
+    """Return True if the boundary tests should be done with boundary_index."""
+
+    if Config.boundary_engine != "python":
+        return False
+    if boundary_index is None:
+        print("NumPy is not installed; using SQL Server for the boundary tests.")
+        Config.boundary_engine = "sql"
+        return False
+    return True
+
+
+def use_key_cache():
+    """Return True if new rows should be found with the key cache (KEYS)."""
+
+    if not Config.use_key_cache:
+        return False
+    if KEYS is None:
+        print("NumPy is not installed; using the tracking tables to find new rows.")
+        Config.use_key_cache = False
+        return False
+    return True
+
+
+def open_key_cache(connection):
+    """
+    Open the key cache (KEYS), reading the tracking tables if needed.
+
+    The tracking tables are read from the SQL Server connection if the cache
+    was not saved by the last run, or is due to be validated.  After an error
+    the cache is not used; new rows are found with the tracking tables.
+    """
+    with METRICS.timer("key_cache") as counts:
+        try:
+            KEYS.open(lambda sql: fetch_batches(connection, sql, Config.batch_size))
+        except pyodbc.Error:
+            print("Unable to read the tracking tables; not using the key cache.")
+            KEYS.invalidate()
+            counts["errors"] = 1
+
+
+def save_key_cache():
+    """Save the key cache (KEYS) if it is open, for the next run."""
+
+    if KEYS is None or not KEYS.is_open():
+        return
+    try:
+        KEYS.save()
+    except (IOError, OSError) as ex:
+        print("Unable to save the key cache", ex)
+
+
+def derive_movements(project):
+    """Return True if the movements of project should be built from its locations."""
+
+    if project not in Config.derive_movements:
+        return False
+    if movement_builder is None:
+        print("NumPy is not installed; reading movements from the Movements table.")
+        Config.derive_movements = []
+        return False
+    return True
+
+
+def use_async_engine():
+    """Return True if Carto requests should be sent with async_engine."""
+
+    if Config.carto_engine != "asyncio" or Config.max_in_flight < 2:
+        return False
+    if async_engine is None:
+        print("The asyncio engine requires Python 3; sending one request at a time.")
+        Config.carto_engine = "sequential"
+        return False
+    return True
+
+
+def get_carto_clients(carto):
+    """
+    Return a list of (carto client, RequestSizer) pairs for sending requests.
+
+    The first client is carto.  If the asyncio engine is used, there are
+    Config.max_in_flight clients (for the same Carto server as carto), and
+    the others have their own HTTP session.  The other clients are made once
+    and kept with carto (like carto, they must only be used by one thread at
+    a time), so their connections are reused by the next call; close them
+    with close_carto_clients() when carto is closed.
+    """
+    clients = [(carto, RequestSizer())]
+    if use_async_engine():
+        extra = getattr(carto, "extra_clients", [])
+        auth = carto.auth_client
+        while len(extra) < Config.max_in_flight - 1:
+            session = carto_transport.CartoSession()
+            extra.append(get_carto_sql_client(auth.base_url, auth.api_key, session))
+        carto.extra_clients = extra
+        clients += [(client, RequestSizer()) for client in extra]
+    return clients
+
+
+def close_carto_clients(carto):
+    """Close the sessions of the other clients of carto (see get_carto_clients)."""
+
+    for client in getattr(carto, "extra_clients", []):
+        client.auth_client.session.close()
+    carto.extra_clients = []
+
+
+def send_statements(carto, template, texts):
+    """
+    Send template.format(",".join(chunk)) for successive chunks of texts.
+
+    The same as RequestSizer().send(), except that with the asyncio engine the
+    chunks are sent with several requests in flight.  The first error is
+    raised after the requests in flight have finished.
+    """
+    clients = get_carto_clients(carto)
+    if len(clients) == 1:
+        RequestSizer().send(carto, template, texts)
+        return
+    sizer = RequestSizer()
+    parts = []
+    start = 0
+    while start < len(texts):
+        parts.append(sizer.take(texts, start, utf8_length(template)))
+        start += len(parts[-1])
+
+    def send(client, part):
+        """Send part with the client's carto and sizer."""
+        client[1].send(client[0], template, part)
+
+    errors = async_engine.send_all(parts, send, lambda part, result: None, clients)
+    if errors:
+        raise errors[0]
+
+
+def get_boundary_indexes(connection, project=None):
+    """
+    Return a dictionary of BoundaryIndex objects keyed by project.
+
+    Only projects with a boundary shape are included.  If project is not
+    None, only that project's boundary is read.
+    """
+    sql = """
+        select Project, Shape.STAsText() from ProjectExportBoundaries
+        where Shape is not null
+    """
+    if project is not None:
+        sql += " and Project = '{0}'".format(project)
+    rows = fetch_rows(connection, sql)
+    if rows is None:
+        raise pyodbc.Error("Unable to read the project boundaries")
+    return dict((row[0], boundary_index.BoundaryIndex(row[1])) for row in rows)
+
+
+def filter_locations(batches, index):
+    """Yield the rows in each batch of locations that are inside index."""
+
+    for rows in batches:
+        with METRICS.timer("boundary_test", kind="locations") as counts:
+            counts["rows"] = len(rows)
+            inside = index.contains_points(
+                [row[5] for row in rows], [row[4] for row in rows]
+            )
+        rows = [row for row, keep in zip(rows, inside) if keep]
+        if rows:
+            yield rows
+
+
+def filter_movements(batches, index):
+    """Yield the rows in each batch of movements that are inside index."""
+
+    for rows in batches:
+        with METRICS.timer("boundary_test", kind="movements") as counts:
+            counts["rows"] = len(rows)
+            if Config.geometry_encoding == "ewkb":
+                lines = [boundary_index.parse_wkb_line(row[7]) for row in rows]
+            else:
+                lines = [boundary_index.parse_wkt_rings(row[7])[0] for row in rows]
+            inside = index.contains_lines(lines)
+        rows = [row for row, keep in zip(rows, inside) if keep]
+        if rows:
+            yield rows
+
+
+def get_generalizer(project):
+    """Return a Generalizer for the project, or None for full precision."""
+
+    digits = Config.coordinate_digits.get(project)
+    tolerance = Config.simplify_tolerance.get(project)
+    if digits is None and not tolerance:
+        return None
+    binary = Config.geometry_encoding == "ewkb"
+    return generalize.Generalizer(digits, tolerance, binary)
+
+
+def generalize_locations(batches, generalizer, project):
+    """Yield the batches of locations with rounded coordinates (other columns kept)."""
+
+    for rows in batches:
+        with METRICS.timer("generalize", kind="locations", project=project) as counts:
+            counts["rows"] = len(rows)
+            rounded = []
+            for row in rows:
+                lon, lat = generalizer.point(row[5], row[4])
+                rounded.append(tuple(row[:4]) + (lat, lon) + tuple(row[6:]))
+        yield rounded
+    if generalizer.count:
+        print("Generalized locations:", generalizer.summary())
+
+
+def generalize_movements(batches, generalizer, project):
+    """Yield the batches of movements with rounded and simplified shapes."""
+
+    for rows in batches:
+        with METRICS.timer("generalize", kind="movements", project=project) as counts:
+            counts["rows"] = len(rows)
+            rows = [
+                tuple(row[:7]) + (generalizer.line(row[7]),) + tuple(row[8:])
+                for row in rows
+            ]
+        yield rows
+    if generalizer.count:
+        print("Generalized movements:", generalizer.summary())
+
+
+def publishable_locations(batches, project, index):
+    """
+    Yield the batches of locations for project ready to publish.
+
+    If index (a BoundaryIndex) is not None, only the locations inside it are
+    kept.  The coordinates are rounded for the project (after the boundary
+    test) if Config.coordinate_digits has the project.
+    """
+    if index is not None:
+        batches = filter_locations(batches, index)
+    generalizer = get_generalizer(project)
+    if generalizer is not None:
+        batches = generalize_locations(batches, generalizer, project)
+    return batches
+
+
+def publishable_movements(batches, project, index):
+    """
+    Yield the batches of movements for project ready to publish.
+
+    If index (a BoundaryIndex) is not None, only the movements inside it are
+    kept.  The shapes are rounded and simplified for the project (after the
+    boundary test) if Config.coordinate_digits or Config.simplify_tolerance
+    has the project.
+    """
+    if index is not None:
+        batches = filter_movements(batches, index)
+    generalizer = get_generalizer(project)
+    if generalizer is not None:
+        batches = generalize_movements(batches, generalizer, project)
+    return batches
+
+
+# The staging tables for the keys of unpublished rows (see fetch_unpublished())
+UNPUBLISHED_TABLES = {
+    "locations": (
+        """
+        if object_id('tempdb..#Unpublished_Locations') is not null
+          drop table #Unpublished_Locations
+        create table #Unpublished_Locations (fixid int NOT NULL PRIMARY KEY)
+    """,
+        "insert into #Unpublished_Locations (fixid) values (?)",
+    ),
+    "movements": (
+        """
+        if object_id('tempdb..#Unpublished_Movements') is not null
+          drop table #Unpublished_Movements
+        create table #Unpublished_Movements (
+          ProjectId varchar(16) NOT NULL,
+          AnimalId varchar(16) NOT NULL,
+          StartDate datetime2(7) NOT NULL,
+          EndDate datetime2(7) NOT NULL,
+          PRIMARY KEY CLUSTERED (ProjectId, AnimalId, StartDate, EndDate))
+    """,
+        """
+        insert into #Unpublished_Movements
+        (projectid, animalid, startdate, enddate) values (?, ?, ?, ?)
+    """,
+    ),
+}
+
+
+def fetch_unpublished(connection, kind, project, key_sql, sql):
+    """
+    Yield batches of the rows of kind that are not in the key cache (KEYS).
+
+    The keys of the candidate rows are read with key_sql (a key-only scan) on
+    the SQL Server connection, and the keys in the cache are removed locally.
+    The rest are loaded into a staging table (see UNPUBLISHED_TABLES), which
+    sql joins to, and the rows from sql are yielded in batches.
+    """
+    create_sql, insert_sql = UNPUBLISHED_TABLES[kind["name"]]
+    with METRICS.timer("key_scan", kind=kind["name"], project=project) as counts:
+        keys = []
+        for rows in fetch_batches(connection, key_sql, Config.batch_size):
+            counts["rows"] += len(rows)
+            keys.extend(KEYS.unpublished(kind["name"], [tuple(row) for row in rows]))
+    if not keys:
+        return
+    w_cursor = connection.cursor()
+    try:
+        w_cursor.execute(create_sql)
+        execute_many(w_cursor, insert_sql, keys)
+        w_cursor.commit()
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        raise
+    finally:
+        w_cursor.close()
+    for rows in fetch_batches(connection, sql, Config.batch_size):
+        yield rows
+
+
+def target_columns(mask):
+    """
+    Return the SQL for the columns after a row for the target mask.
+
+    With a mask (several targets), the columns are the content hash (null if
+    Config.update_changed_rows is False, so the mask is always in the same
+    place) and the mask.
+    """
+    if not mask:
+        return ""
+    if Config.update_changed_rows:
+        return ", " + mask
+    return ", null, " + mask
+
+
+def get_locations_for_carto(connection, project, since=None, index=None, targets=None):
+    """
+    Yield batches of new locations for project from the SQL Server connection.
+
+    Only check locations that have changed since the change tracking version
+    since, unless it is None.  If index (a BoundaryIndex) is not None, the
+    locations are tested against the boundary with the index instead of in SQL
+    Server.  The coordinates are rounded for the project (after the boundary
+    test) if Config.coordinate_digits has the project.  If
+    Config.update_changed_rows is True, each row ends with its content hash.
+    A location is new if it is not in the tracking table of any of targets
+    (a list of Target; the default target if None); with several targets,
+    each row also ends with a mask of the targets that need it (see
+    target_sql()).  If the key cache is open, it is used to find the new
+    locations instead of the tracking table (see fetch_unpublished()).
+    """
+
+    sql = """
+        select l.projectid, l.animalid, l.fixid, l.fixdate,
+        location.Lat, Location.Long{hash} from {source}
+        left join ProjectExportBoundaries as b on b.Project = l.ProjectId
+        {tracking}
+        where l.ProjectID = '{project}' -- belongs to project
+        and l.[status] IS NULL -- not hidden
+        {untracked}
+        {inside}
+    """
+    inside = "and (b.shape is null or b.Shape.STContains(l.Location) = 1)"
+    if index is not None:
+        inside = ""
+    source = changed("Locations", LOCATION_KEY, "l", since)
+    joins, untracked, mask = target_sql(
+        "Locations", "l", LOCATION_KEY, targets or [None]
+    )
+    row_hash = ""
+    if Config.update_changed_rows:
+        row_hash = ", " + LOCATION_HASH
+    if KEYS is not None and KEYS.is_open():
+        key_sql = """
+            select l.FixId from {source}
+            where l.ProjectID = '{project}' and l.[status] IS NULL
+        """
+        key_sql = key_sql.format(project=project, source=source)
+        source = "#Unpublished_Locations as n join Locations as l on l.FixId = n.fixid"
+        sql = sql.format(
+            project=project,
+            source=source,
+            inside=inside,
+            hash=row_hash,
+            tracking="",
+            untracked="",
+        )
+        batches = fetch_unpublished(connection, LOCATIONS, project, key_sql, sql)
+    else:
+        sql = sql.format(
+            project=project,
+            source=source,
+            inside=inside,
+            hash=row_hash + target_columns(mask),
+            tracking=joins,
+            untracked="and ({0}) -- not in Carto".format(untracked),
+        )
+        batches = fetch_batches(connection, sql, Config.batch_size)
+    batches = METRICS.timed(batches, "fetch", kind="locations", project=project)
+    return publishable_locations(batches, project, index)
+
+
+def get_vectors_for_carto(connection, project, since=None, index=None, targets=None):
+    """
+    Yield batches of new movements for project from the SQL Server connection.
+
+    Only check movements that have changed since the change tracking version
+    since, unless it is None.  If index (a BoundaryIndex) is not None, the
+    movements are tested against the boundary with the index instead of in SQL
+    Server.  The shapes are rounded and simplified for the project (after the
+    boundary test) if Config.coordinate_digits or Config.simplify_tolerance
+    has the project.  If Config.update_changed_rows is True, each row ends
+    with its content hash.  See get_locations_for_carto() for targets.
+    If the key cache is open, it is used to find the new movements instead
+    of the tracking table (see fetch_unpublished()).
+    """
+
+    sql = """
+        select m.Projectid, m.AnimalId, m.StartDate, m.EndDate, m.Duration, m.Distance, m.Speed,
+        m.Shape.{shape}{hash} from {source}
+        inner join ProjectExportBoundaries as b on b.Project = m.ProjectId
+        {tracking}
+        where m.ProjectId = '{project}'  -- belongs to project
+        and Distance > 0  -- not a degenerate
+        {untracked}
+        {inside}
+    """
+    inside = "and (b.shape is null or b.Shape.STContains(m.shape) = 1)"
+    if index is not None:
+        inside = ""
+    source = changed("Movements", MOVEMENT_KEY, "m", since)
+    shape = "STAsBinary()" if Config.geometry_encoding == "ewkb" else "ToString()"
+    joins, untracked, mask = target_sql(
+        "Movements", "m", MOVEMENT_KEY, targets or [None]
+    )
+    row_hash = ""
+    if Config.update_changed_rows:
+        row_hash = ", " + MOVEMENT_HASH
+    if KEYS is not None and KEYS.is_open():
+        key_sql = """
+            select m.ProjectId, m.AnimalId, m.StartDate, m.EndDate from {source}
+            where m.ProjectId = '{project}' and Distance > 0
+        """
+        key_sql = key_sql.format(project=project, source=source)
+        source = """#Unpublished_Movements as n join Movements as m
+        on m.ProjectId = n.ProjectId and m.AnimalId = n.AnimalId
+        and m.StartDate = n.StartDate and m.EndDate = n.EndDate"""
+        sql = sql.format(
+            project=project,
+            source=source,
+            inside=inside,
+            shape=shape,
+            hash=row_hash,
+            tracking="",
+            untracked="",
+        )
+        batches = fetch_unpublished(connection, MOVEMENTS, project, key_sql, sql)
+    else:
+        sql = sql.format(
+            project=project,
+            source=source,
+            inside=inside,
+            shape=shape,
+            hash=row_hash + target_columns(mask),
+            tracking=joins,
+            untracked="and ({0})  -- not in Carto".format(untracked),
+        )
+        batches = fetch_batches(connection, sql, Config.batch_size)
+    batches = METRICS.timed(batches, "fetch", kind="movements", project=project)
+    return publishable_movements(batches, project, index)
+
+
+def get_changed_locations(connection, project, since=None, index=None, targets=None):
+    """
+    Yield batches of published locations for project that have changed.
+
+    A location has changed if its content hash (LOCATION_HASH) is not the one
+    saved in the tracking table on the SQL Server connection; an unknown
+    (null) hash counts as changed.  Each row ends with its new hash.  Only
+    check locations that have changed since the change tracking version
+    since, unless it is None.  See get_locations_for_carto() for index and
+    targets; a location is checked for the targets that have published it.
+    """
+
+    sql = """
+        select l.projectid, l.animalid, l.fixid, l.fixdate,
+        location.Lat, Location.Long, {hash}{mask} from {source}
+        {tracking}
+        left join ProjectExportBoundaries as b on b.Project = l.ProjectId
+        where l.ProjectID = '{project}' -- belongs to project
+        and l.[status] IS NULL -- not hidden
+        and ({changed}) -- changed in Animal Movement
+        {inside}
+    """
+    inside = "and (b.shape is null or b.Shape.STContains(l.Location) = 1)"
+    if index is not None:
+        inside = ""
+    source = changed("Locations", LOCATION_KEY, "l", since)
+    targets = targets or [None]
+    row_hash = LOCATION_HASH
+    if len(targets) > 1:
+        # The hash is compared with the tracking table of each target
+        source += " cross apply (select {0} as RowHash) as h".format(row_hash)
+        row_hash = "h.RowHash"
+    joins, changes, mask = target_sql("Locations", "l", LOCATION_KEY, targets, row_hash)
+    sql = sql.format(
+        project=project,
+        source=source,
+        inside=inside,
+        hash=row_hash,
+        mask=", " + mask if mask else "",
+        tracking=joins,
+        changed=changes,
+    )
+    batches = METRICS.timed(
+        fetch_batches(connection, sql, Config.batch_size),
+        "fetch_changed",
+        kind="locations",
+        project=project,
+    )
+    return publishable_locations(batches, project, index)
+
+
+def get_changed_vectors(connection, project, since=None, index=None, targets=None):
+    """
+    Yield batches of published movements for project that have changed.
+
+    A movement has changed if its content hash (MOVEMENT_HASH) is not the one
+    saved in the tracking table on the SQL Server connection; an unknown
+    (null) hash counts as changed.  Each row ends with its new hash.  Only
+    check movements that have changed since the change tracking version
+    since, unless it is None.  See get_vectors_for_carto() for index and
+    targets; a movement is checked for the targets that have published it.
+    """
+
+    sql = """
+        select m.Projectid, m.AnimalId, m.StartDate, m.EndDate, m.Duration, m.Distance, m.Speed,
+        m.Shape.{shape}, {hash}{mask} from {source}
+        {tracking}
+        inner join ProjectExportBoundaries as b on b.Project = m.ProjectId
+        where m.ProjectId = '{project}'  -- belongs to project
+        and ({changed})  -- changed in Animal Movement
+        {inside}
+    """
+    inside = "and (b.shape is null or b.Shape.STContains(m.shape) = 1)"
+    if index is not None:
+        inside = ""
+    source = changed("Movements", MOVEMENT_KEY, "m", since)
+    shape = "STAsBinary()" if Config.geometry_encoding == "ewkb" else "ToString()"
+    targets = targets or [None]
+    row_hash = MOVEMENT_HASH
+    if len(targets) > 1:
+        # The hash is compared with the tracking table of each target
+        source += " cross apply (select {0} as RowHash) as h".format(row_hash)
+        row_hash = "h.RowHash"
+    joins, changes, mask = target_sql("Movements", "m", MOVEMENT_KEY, targets, row_hash)
+    sql = sql.format(
+        project=project,
+        source=source,
+        inside=inside,
+        shape=shape,
+        hash=row_hash,
+        mask=", " + mask if mask else "",
+        tracking=joins,
+        changed=changes,
+    )
+    batches = METRICS.timed(
+        fetch_batches(connection, sql, Config.batch_size),
+        "fetch_changed",
+        kind="movements",
+        project=project,
+    )
+    return publishable_movements(batches, project, index)
+
+
+def derive_vectors_for_carto(
+    connection, project, since=None, index=None, changes=None, stale=None, targets=None
+):
+    """
+    Yield batches of new movements for project built from its locations.
+
+    The movements are built (see movement_builder.py) from the locations on
+    the SQL Server connection instead of read from the Movements table, and
+    compared with the tracking table of each of targets (see
+    get_vectors_for_carto()).  Only the animals with locations changed since
+    the change tracking version since are checked, unless it is None.  The
+    movements are tested against the boundary with index (a BoundaryIndex),
+    or the project's boundary if index is None.  If
+    Config.update_changed_rows is True, each row ends with its content hash.
+    Once the batches are exhausted, the changed movements (whose hash is not
+    the one in a tracking table) have been added to the list changes, and
+    the keys of the tracked movements that no longer exist (or are outside
+    the boundary) to the lists in stale (one for each target), unless they
+    are None.
+    """
+    targets = targets or [None]
+    batches = derive_movement_batches(
+        connection, project, since, index, changes, stale, targets
+    )
+    return publishable_movements(batches, project, None)
+
+
+def derive_movement_batches(connection, project, since, index, changes, stale, targets):
+    """Yield the batches for derive_vectors_for_carto() before generalizing."""
+
+    if index is None:
+        index = get_boundary_indexes(connection, project).get(project)
+    animals = ""
+    if since is not None:
+        source = changed("Locations", LOCATION_KEY, "x", since)
+        animals = "and {{0}}.AnimalId in (select x.AnimalId from {0} where x.ProjectId = '{1}')"
+        animals = animals.format(source, project)
+    row_hash = "c.RowHash" if Config.update_changed_rows else "null"
+    sql = """
+        select c.ProjectId, c.AnimalId, c.StartDate, c.EndDate, {0}
+        from {1} as c where c.ProjectId = '{2}' {3}
+    """
+    tracked = []
+    for target in targets:
+        table = tracking_table("Movements", target)
+        found = {}
+        with METRICS.timer(
+            "tracking_read", kind="movements", project=project
+        ) as counts:
+            query = sql.format(row_hash, table, project, animals.format("c"))
+            for rows in fetch_batches(connection, query, Config.batch_size):
+                counts["rows"] += len(rows)
+                found.update((tuple(row[:4]), row[4]) for row in rows)
+        tracked.append(found)
+    sql = """
+        select l.ProjectId, l.AnimalId, l.FixId, l.FixDate,
+        l.Location.Lat, l.Location.Long from Locations as l
+        where l.ProjectId = '{0}' and l.[status] IS NULL {1}
+        order by l.ProjectId, l.AnimalId, l.FixDate
+    """
+    sql = sql.format(project, animals.format("l"))
+    batches = METRICS.timed(
+        fetch_batches(connection, sql, Config.batch_size),
+        "fetch",
+        kind="locations",
+        project=project,
+    )
+    builder = movement_builder.MovementBuilder()
+    binary = Config.geometry_encoding == "ewkb"
+    several = len(targets) > 1
+    for rows in batches:
+        with METRICS.timer("derive", kind="movements", project=project) as counts:
+            keys, values = builder.add(rows)
+            if index is not None and keys:
+                inside = index.contains_lines(list(movement_builder.lines(values)))
+                keys = [key for key, keep in zip(keys, inside) if keep]
+                values = values[inside]
+            hashes = [None] * len(keys)
+            if Config.update_changed_rows:
+                hashes = movement_builder.content_hashes(values)
+            new = []
+            changed_rows = []
+            for i, (key, value) in enumerate(zip(keys, hashes)):
+                # bit n of a mask is set if targets[n] needs the movement
+                new_mask = 0
+                changed_mask = 0
+                for bit, found in enumerate(tracked):
+                    if key not in found:
+                        new_mask |= 1 << bit
+                    elif found.pop(key) != value and Config.update_changed_rows:
+                        changed_mask |= 1 << bit
+                if new_mask:
+                    new.append((i, new_mask))
+                if changed_mask:
+                    changed_rows.append((i, changed_mask))
+            counts["rows"] = len(keys)
+        for wanted, results in [(new, None), (changed_rows, changes)]:
+            if not wanted:
+                continue
+            picked = [i for i, _ in wanted]
+            movements = movement_builder.movement_rows(
+                [keys[i] for i in picked], values[picked], binary
+            )
+            if Config.update_changed_rows or several:
+                movements = [row + (hashes[i],) for row, i in zip(movements, picked)]
+            if several:
+                movements = [row + (mask,) for row, (_, mask) in zip(movements, wanted)]
+            if results is None:
+                yield movements
+            else:
+                results.extend(movements)
+    if stale is not None:
+        for found, keys in zip(tracked, stale):
+            keys.extend(found)
+
+
+def fixlocationrow(row):
+    """Return a modified location row; from SQL Server to Postgres (carto)."""
+
+    text = "('{0}','{1}',{2},'{3}',ST_SetSRID(ST_Point({5},{4}),4326))"
+    return text.format(*row)
+
+
+def format_tenths(value):
+    """
+    Return the number value as text rounded to 1 decimal place.
+
+    This matches round(cast(value as numeric),1) in Postgres for a real column;
+    a real is converted to numeric with 6 significant digits, and rounding is
+    half away from zero.
+    """
+
+    number = decimal.Decimal("{0:.6g}".format(value))
+    return "{0}".format(number.quantize(TENTH, rounding=decimal.ROUND_HALF_UP))
+
+
+TENTH = decimal.Decimal("0.1")
+
+
+def movement_text_columns(row):
+    """Return the formatted duration, distance and speed for a movement row."""
+
+    return [format_tenths(row[4]), format_tenths(row[5]), format_tenths(row[6])]
+
+
+def fixmovementrow(row):
+    """Return a modified movement row; from SQL Server to Postgres (carto)."""
+
+    text = (
+        "('{0}','{1}','{2}','{3}',{4},{5},{6},'{8}','{9}','{10}',"
+        "ST_GeometryFromText('{7}',4326))"
+    )
+    return text.format(*(list(row[:8]) + movement_text_columns(row)))
+
+
+def csv_line(values):
+    """Return a line of CSV text (with a newline) for the list of values."""
+
+    fields = []
+    for value in values:
+        text = "{0}".format(value)
+        if any(char in text for char in ',"\r\n'):
+            text = '"' + text.replace('"', '""') + '"'
+        fields.append(text)
+    return ",".join(fields) + "\n"
+
+
+def location_csv_line(row):
+    """Return a location row as CSV text for the COPY API; the_geom as EWKT."""
+
+    geom = "SRID=4326;POINT({0} {1})".format(row[5], row[4])
+    return csv_line([row[0], row[1], row[2], row[3], geom])
+
+
+def movement_csv_line(row):
+    """Return a movement row as CSV text for the COPY API; the_geom as EWKT."""
+
+    geom = "SRID=4326;{0}".format(row[7])
+    return csv_line(list(row[:7]) + movement_text_columns(row) + [geom])
+
+
+# EWKB geometry type flag for an SRID after the type
+EWKB_SRID_FLAG = 0x20000000
+
+
+def ewkb_hex(wkb, srid=4326):
+    """Return the OGC WKB (bytes) geometry as hex EWKB text with the srid."""
+
+    wkb = bytes(wkb)
+    order = "<" if wkb[0:1] == b"\x01" else ">"
+    geometry_type = struct.unpack(order + "I", wkb[1:5])[0]
+    header = struct.pack(order + "II", geometry_type | EWKB_SRID_FLAG, srid)
+    return binascii.hexlify(wkb[0:1] + header + wkb[5:]).decode("ascii").upper()
+
+
+def point_ewkb_hex(x, y, srid=4326):
+    """Return the point (x=longitude, y=latitude) as hex EWKB text with the srid."""
+
+    ewkb = struct.pack("<BIIdd", 1, 1 | EWKB_SRID_FLAG, srid, x, y)
+    return binascii.hexlify(ewkb).decode("ascii").upper()
+
+
+def location_ewkb_row(row):
+    """Return a location row as SQL values for carto; the_geom as hex EWKB."""
+
+    text = "('{0}','{1}',{2},'{3}','{4}')"
+    return text.format(row[0], row[1], row[2], row[3], point_ewkb_hex(row[5], row[4]))
+
+
+def movement_ewkb_row(row):
+    """Return a movement row (shape as WKB) as SQL values; the_geom as hex EWKB."""
+
+    text = "('{0}','{1}','{2}','{3}',{4},{5},{6},'{7}','{8}','{9}','{10}')"
+    values = list(row[:7]) + movement_text_columns(row) + [ewkb_hex(row[7])]
+    return text.format(*values)
+
+
+def location_ewkb_csv_line(row):
+    """Return a location row as CSV text for the COPY API; the_geom as hex EWKB."""
+
+    geom = point_ewkb_hex(row[5], row[4])
+    return csv_line([row[0], row[1], row[2], row[3], geom])
+
+
+def movement_ewkb_csv_line(row):
+    """Return a movement row (shape as WKB) as CSV text; the_geom as hex EWKB."""
+
+    geom = ewkb_hex(row[7])
+    return csv_line(list(row[:7]) + movement_text_columns(row) + [geom])
+
+
+def copy_lines_to_carto(carto, table, columns, lines):
+    """Stream CSV text lines into table on carto with the COPY API."""
+
+    copy_client = CopySQLClient(carto.auth_client)
+    sql = "COPY {0} ({1}) FROM stdin WITH (FORMAT csv)".format(table, ",".join(columns))
+    copy_client.copyfrom(sql, (line.encode("utf-8") for line in lines))
+
+
+def insert_values_to_carto(carto, sizer, table, columns, values):
+    """Send multi-row inserts of the SQL values strings into table on carto."""
+
+    sql = "insert into {0} ({1}) values ".format(table, ",".join(columns))
+    sizer.send(carto, sql + "{0}", values)
+
+
+def location_key(row):
+    """Return the key (fixid,) of a location row."""
+
+    return (row[2],)
+
+
+def movement_key(row):
+    """Return the key (projectid, animalid, startdate, enddate) of a movement row."""
+
+    return tuple(row[:4])
+
+
+def location_hash(row):
+    """Return the content hash at the end of a location row; None if not read."""
+
+    return row[6] if len(row) > 6 else None
+
+
+def movement_hash(row):
+    """Return the content hash at the end of a movement row; None if not read."""
+
+    return row[8] if len(row) > 8 else None
+
+
+def track_locations(connection, keys, hashes=None, target=None):
+    """Add the location keys (and hashes) to the tracking table of target."""
+
+    fids = [key[0] for key in keys]
+    return add_locations_to_carto_tracking_table(connection, fids, hashes, target)
+
+
+def rehash_locations(connection, keys, hashes, target=None):
+    """Save the new hashes of the location keys in the tracking table of target."""
+
+    update_location_hashes(connection, [key[0] for key in keys], hashes, target)
+
+
+def untrack_locations(connection, keys, target=None):
+    """Remove the location keys from the tracking table of target."""
+
+    fids = [key[0] for key in keys]
+    remove_locations_from_carto_tracking_table(connection, fids, target)
+
+
+def movement_days(keys):
+    """Return a sorted list of the (project, animal, day) of the movement keys."""
+
+    # The start date may be a datetime, or text from the journal
+    days = set((key[0], key[1], "{0}".format(key[2])[:10]) for key in keys)
+    return sorted(days)
+
+
+def track_days(kind, keys):
+    """
+    Return the (project, animal, day) of the keys of kind to save in the batch
+    journal for update_tracks(); none if Config.update_tracks is False.
+    """
+    if not Config.update_tracks:
+        return []
+    return kind["days"](keys)
+
+
+def no_days(keys):
+    """Return an empty list; locations do not change the animal tracks."""
+
+    # pylint: disable=unused-argument
+    return []
+
+
+def find_in_carto(carto, sql, texts):
+    """Return the rows from running sql with chunks of the SQL texts on carto."""
+
+    rows = []
+    # Only used to recover interrupted batches, so a simple fixed size is fine
+    for chunk in chunks(texts, 1000):
+        rows += carto.send(sql.format(",".join(chunk)))["rows"]
+    return rows
+
+
+def find_locations_in_carto(carto, keys):
+    """Return the location keys that are in the carto table."""
+
+    sql = "select distinct fixid from animal_locations where fixid in ({0})"
+    rows = find_in_carto(carto, sql, ["{0}".format(key[0]) for key in keys])
+    return [(row["fixid"],) for row in rows]
+
+
+def timestamp_text(value):
+    """
+    Return the timestamp value as the text of a datetime ("{0}".format()).
+
+    value is a datetime, the same text (from the batch journal), or the ISO
+    8601 text of a timestamp from Carto (e.g. "2020-06-01T00:00:00Z").
+    """
+    text = "{0}".format(value).replace("T", " ").rstrip("Z")
+    if "." in text:
+        text, fraction = text.split(".", 1)
+        fraction = fraction.rstrip("0")
+        if fraction:
+            text += "." + fraction.ljust(6, "0")
+    return text
+
+
+def find_movements_in_carto(carto, keys):
+    """
+    Return the movement keys that are in the carto table.
+
+    The keys found are returned as given (not as the timestamp text from
+    Carto), so they match the keys of the same rows read from SQL Server in
+    the tracking tables and the key cache.
+    """
+
+    sql = """
+        select d.projectid, d.animalid, d.startdate, d.enddate
+        from (values {0}) as d (projectid, animalid, startdate, enddate)
+        where exists (select 1 from animal_movements as m
+        where m.projectid = d.projectid and m.animalid = d.animalid
+        and m.startdate = d.startdate::timestamp
+        and m.enddate = d.enddate::timestamp)
+    """
+    texts = ["('{0}','{1}','{2}','{3}')".format(*key) for key in keys]
+    found = set(
+        (
+            row["projectid"],
+            row["animalid"],
+            timestamp_text(row["startdate"]),
+            timestamp_text(row["enddate"]),
+        )
+        for row in find_in_carto(carto, sql, texts)
+    )
+    return [
+        key
+        for key in keys
+        if (key[0], key[1], timestamp_text(key[2]), timestamp_text(key[3])) in found
+    ]
+
+
+# How to send each kind of row to carto and track it in SQL Server.
+LOCATIONS = {
+    "name": "locations",
+    "table": "animal_locations",
+    "columns": ["projectid", "animalid", "fixid", "fixdate", "the_geom"],
+    "to_csv": location_csv_line,
+    "to_values": fixlocationrow,
+    "ewkb_csv": location_ewkb_csv_line,
+    "ewkb_values": location_ewkb_row,
+    "key": location_key,
+    "key_columns": ["fixid"],
+    "hash": location_hash,
+    "rehash": rehash_locations,
+    "days": no_days,
+    "track": track_locations,
+    "untrack": untrack_locations,
+    "find": find_locations_in_carto,
+}
+MOVEMENTS = {
+    "name": "movements",
+    "table": "animal_movements",
+    "columns": [
+        "projectid",
+        "animalid",
+        "startdate",
+        "enddate",
+        "duration",
+        "distance",
+        "speed",
+        "duration_t",
+        "distance_t",
+        "speed_t",
+        "the_geom",
+    ],
+    "to_csv": movement_csv_line,
+    "to_values": fixmovementrow,
+    "ewkb_csv": movement_ewkb_csv_line,
+    "ewkb_values": movement_ewkb_row,
+    "key": movement_key,
+    "key_columns": ["projectid", "animalid", "startdate", "enddate"],
+    "hash": movement_hash,
+    "rehash": update_movement_hashes,
+    "days": movement_days,
+    "track": add_movements_to_carto_tracking_table,
+    "untrack": remove_movements_from_carto_tracking_table,
+    "find": find_movements_in_carto,
+}
+
+
+def ingest_state(mode=None):
+    """
+    Return the state of sending rows in the ingest mode (Config.ingest_mode if None).
+
+    state["mode"] is the mode of the next batches; it is changed to "insert"
+    when a COPY request fails (see send_batch()).  The state can be shared
+    by the senders of several targets (see fan_out()), so that they all fall
+    back together, and format each row for INSERT once (see insert_texts()).
+    """
+    return {
+        "mode": mode or Config.ingest_mode,
+        "lock": threading.Lock(),
+        "insert_texts": {},
+    }
+
+
+def serialize_batches(batches, kind, state):
+    """
+    Yield (rows, mode, texts) for each list of rows in batches.
+
+    The texts are the rows formatted for the ingest mode in state["mode"]
+    with the formatters for kind (LOCATIONS or MOVEMENTS).
+    """
+    for rows in batches:
+        mode = state["mode"]
+        yield rows, mode, serialize(rows, kind, mode)
+
+
+def serialize(rows, kind, mode):
+    """Return the rows of kind formatted for the ingest mode and geometry encoding."""
+
+    if Config.geometry_encoding == "ewkb":
+        to_text = kind["ewkb_csv"] if mode == "copy" else kind["ewkb_values"]
+    else:
+        to_text = kind["to_csv"] if mode == "copy" else kind["to_values"]
+    with METRICS.timer("serialize", kind=kind["name"], mode=mode) as counts:
+        texts = [to_text(row) for row in rows]
+        counts["rows"] = len(rows)
+        counts["size"] = sum(len(text) for text in texts)
+    return texts
+
+
+def insert_texts(rows, kind, state):
+    """
+    Return the rows of kind formatted for INSERT statements.
+
+    This is for rows formatted for COPY before a COPY request failed.  The
+    texts are saved by key in state (see ingest_state()), so a row sent to
+    several targets is only formatted again once.
+    """
+    keys = [kind["key"](row) for row in rows]
+    with state["lock"]:
+        saved = state["insert_texts"]
+        missing = [(key, row) for key, row in zip(keys, rows) if key not in saved]
+        if missing:
+            texts = serialize([row for _, row in missing], kind, "insert")
+            saved.update(zip([key for key, _ in missing], texts))
+        return [saved[key] for key in keys]
+
+
+def send_batch(carto, sizer, kind, state, rows, mode, texts):
+    """
+    Send a batch of rows of kind to carto.
+
+    texts are the rows formatted for the ingest mode.  A failed COPY request
+    does not write any rows, so the batch is sent again with INSERT statements
+    (sized by sizer), and state["mode"] (see ingest_state()) is changed to
+    "insert" for the remaining batches.
+    """
+    name, table, columns = kind["name"], kind["table"], kind["columns"]
+    if state["mode"] == "copy":
+        try:
+            with METRICS.timer("carto_write", kind=name, mode="copy") as counts:
+                counts["rows"] = len(rows)
+                copy_lines_to_carto(carto, table, columns, texts)
+            return
+        except CartoException as ex:
+            print("Carto COPY failed; falling back to INSERT.", ex)
+            state["mode"] = "insert"
+    if mode != "insert":
+        texts = insert_texts(rows, kind, state)
+    with METRICS.timer("carto_write", kind=name, mode="insert") as counts:
+        counts["rows"] = len(rows)
+        insert_values_to_carto(carto, sizer, table, columns, texts)
+
+
+def track_batch(database, kind, keys, hashes=None, target=None):
+    """
+    Add the keys (and hashes) of kind to the tracking table of target.
+
+    target is a Target, or None for the default target.
+    Return True if tracked.
+    """
+
+    with METRICS.timer("tracking_write", kind=kind["name"]) as counts:
+        counts["rows"] = len(keys)
+        tracked = kind["track"](database, keys, hashes, target)
+        counts["errors"] = int(not tracked)
+    if tracked and KEYS is not None and (target is None or target.is_default):
+        KEYS.add(kind["name"], keys)
+    return tracked
+
+
+def send_batches(database, carto, kind, batches, journal=None, target=None):
+    """
+    Send batches of rows of kind (LOCATIONS or MOVEMENTS) to carto.
+
+    Reading, formatting, and sending the batches are overlapped.  Each batch is
+    added to the tracking table (of target, see track_batch()) on the SQL
+    Server database connection as soon as carto has accepted it. A failed
+    COPY request does not write any rows, so the failed batch, and all
+    remaining batches, are sent with INSERT statements instead.  Stop at the
+    first error.
+    If journal (a BatchJournal) is not None, the keys of each batch are saved
+    in the journal before the batch is sent, and removed once they are
+    tracked (see recover_batches()); the days of the tracks changed by the
+    batch are saved then (see update_tracks()).
+    With the asyncio engine, several batches are sent at once (see
+    send_batches_in_flight()).
+    Return the number of rows sent and the number of errors.
+    """
+    state = ingest_state()
+    items = serialize_batches(prefetch(batches), kind, state)
+    return send_items(database, carto, kind, items, journal, target, state)
+
+
+def send_items(database, carto, kind, items, journal=None, target=None, state=None):
+    """
+    Send the (rows, mode, texts) items of kind from serialize_batches() to carto.
+
+    See send_batches() for the other parameters.  state is the state used to
+    serialize the items (see ingest_state()); the items are serialized in the
+    new mode after a COPY request fails.  If it is None, the items are all in
+    Config.ingest_mode.
+    Return the number of rows sent and the number of errors.
+    """
+    if state is None:
+        state = ingest_state()
+    sent = {"count": 0}
+    start = time.time()
+    clients = get_carto_clients(carto)
+    try:
+        if len(clients) > 1:
+            send_batches_in_flight(
+                database, clients, kind, items, journal, state, sent, target
+            )
+        else:
+            sizer = RequestSizer()
+            for rows, mode, texts in prefetch(items):
+                keys = [kind["key"](row) for row in rows]
+                batch_id = journal.begin(kind["name"], keys) if journal else None
+                send_batch(carto, sizer, kind, state, rows, mode, texts)
+                if journal:
+                    journal.acknowledge(batch_id)
+                sent["count"] += len(rows)
+                hashes = [kind["hash"](row) for row in rows]
+                if not track_batch(database, kind, keys, hashes, target):
+                    return sent["count"], 1
+                if journal:
+                    journal.finish(batch_id, track_days(kind, keys))
+    except CartoException as ex:
+        print("Carto error ocurred", ex)
+        return sent["count"], 1
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        return sent["count"], 1
+    finally:
+        if sent["count"]:
+            rate = sent["count"] / max(time.time() - start, 0.001)
+            print(
+                "Wrote {0} {1} to Carto{2} ({3}, {4:.0f} rows/sec).".format(
+                    sent["count"],
+                    kind["name"],
+                    target_label(target),
+                    state["mode"],
+                    rate,
+                )
+            )
+    if not sent["count"]:
+        print("No {0} to send to Carto{1}.".format(kind["name"], target_label(target)))
+    return sent["count"], 0
+
+
+def send_batches_in_flight(
+    database, clients, kind, items, journal, state, sent, target=None
+):
+    """
+    Send (rows, mode, texts) items of kind with a request in flight for each client.
+
+    clients is a list from get_carto_clients().  Batches are sent in any
+    order, but each one is only tracked (on the SQL Server database connection,
+    one at a time) after carto has accepted it.  After an error no more
+    batches are read; the batches in flight are finished, and then the first
+    error is raised.  sent["count"] is the number of rows sent.
+    See send_batches() for the other parameters.
+    """
+
+    def send(client, item):
+        """Send a (rows, mode, texts) item; return the keys and journal id."""
+        rows, mode, texts = item
+        keys = [kind["key"](row) for row in rows]
+        batch_id = journal.begin(kind["name"], keys) if journal else None
+        send_batch(client[0], client[1], kind, state, rows, mode, texts)
+        if journal:
+            journal.acknowledge(batch_id)
+        return keys, batch_id
+
+    def acknowledge(item, result):
+        """Track a batch that carto has accepted."""
+        keys, batch_id = result
+        sent["count"] += len(item[0])
+        hashes = [kind["hash"](row) for row in item[0]]
+        if not track_batch(database, kind, keys, hashes, target):
+            raise pyodbc.Error("Unable to track a batch of {0}".format(kind["name"]))
+        if journal:
+            journal.finish(batch_id, track_days(kind, keys))
+
+    errors = async_engine.send_all(items, send, acknowledge, clients)
+    if errors:
+        raise errors[0]
+
+
+def target_label(target):
+    """Return the text to name target (a Target) in a message; empty for the default."""
+
+    if target is None or target.is_default:
+        return ""
+    return " ({0})".format(target.name)
+
+
+def target_rows(rows, texts, bit):
+    """
+    Return the rows (without the mask) and texts for the target with bit.
+
+    Each row ends with the mask of the targets that need it (see
+    target_sql()); only the rows with bit set in the mask are returned.
+    """
+    picked = [i for i, row in enumerate(rows) if row[-1] & bit]
+    return [tuple(rows[i][:-1]) for i in picked], [texts[i] for i in picked]
+
+
+def fan_out(send, kind, items, outlets, state=None):
+    """
+    Send (rows, mode, texts) items of kind to the target of each outlet.
+
+    Each outlet is a dictionary with the target (a Target, or None for the
+    default target), and its SQL Server "database" connection, "carto"
+    client, and "journal" (see send_batches()).  The items are read and
+    formatted once.  The items are sent with send(database, carto, kind,
+    items, journal, target, state) (send_items() or send_update_items()).
+    state (see ingest_state()) is shared by the outlets, so a failed COPY
+    request switches all of them to INSERT statements, and the rows formatted
+    for COPY are only formatted again once.  With several outlets, each row
+    ends with the mask of the outlets that need it (bit i for outlets[i], see
+    target_sql()),
+    and each outlet is sent just its rows by its own thread, from its own
+    queue of at most Config.target_queue_batches items.  The items are only
+    read as fast as the fastest outlet takes them.  An outlet that stops
+    (after an error) is not sent any more items, and an outlet with a full
+    queue that is Config.target_lag_batches items behind the fastest outlet
+    is left behind (an error, so its rows are sent by the next sync);
+    neither holds back the other outlets.
+    Return a list of the (count, errors) for each outlet.
+    """
+    if len(outlets) == 1:
+        outlet = outlets[0]
+        return [
+            send(
+                outlet["database"],
+                outlet["carto"],
+                kind,
+                items,
+                outlet["journal"],
+                outlet["target"],
+                state,
+            )
+        ]
+    queues = [queue.Queue(maxsize=Config.target_queue_batches) for _ in outlets]
+    closed = [threading.Event() for _ in outlets]
+    stopped = [threading.Event() for _ in outlets]
+    behind = [False] * len(outlets)
+    taken = [0] * len(outlets)
+    results = [(0, 0) for _ in outlets]
+
+    def read(i):
+        """Yield the items for outlet i until it is closed."""
+        while True:
+            try:
+                item = queues[i].get(timeout=0.5)
+            except queue.Empty:
+                if closed[i].is_set() and queues[i].empty():
+                    return
+                continue
+            taken[i] += 1
+            yield item
+
+    def consume(i):
+        """Send the items for outlet i."""
+        outlet = outlets[i]
+        try:
+            results[i] = send(
+                outlet["database"],
+                outlet["carto"],
+                kind,
+                read(i),
+                outlet["journal"],
+                outlet["target"],
+                state,
+            )
+        # pylint: disable=broad-except
+        # One failed target must not stop the others.
+        except Exception as ex:
+            print("Error ocurred sending to", outlet["target"].name, ex)
+            results[i] = (0, 1)
+        finally:
+            stopped[i].set()
+
+    def lag(i):
+        """Return the number of items outlet i has taken less than the fastest."""
+        live = [j for j in range(len(outlets)) if not closed[j].is_set()]
+        return max(taken[j] for j in live) - taken[i]
+
+    def offer(i, item):
+        """Queue item for outlet i; return False if it has stopped or is too slow."""
+        while not stopped[i].is_set():
+            try:
+                queues[i].put_nowait(item)
+                return True
+            except queue.Full:
+                pass
+            if lag(i) >= Config.target_lag_batches:
+                print(
+                    "Leaving target {0} behind until the next sync.".format(
+                        outlets[i]["target"].name
+                    )
+                )
+                behind[i] = True
+                return False
+            # No outlet is far ahead of this one; wait for it
+            stopped[i].wait(0.05)
+        return False
+
+    def close(i):
+        """Send no more items to outlet i, and drop the items it has not read."""
+        closed[i].set()
+        try:
+            while True:
+                queues[i].get_nowait()
+        except queue.Empty:
+            pass
+
+    threads = [threading.Thread(target=consume, args=(i,)) for i in range(len(outlets))]
+    for thread in threads:
+        thread.start()
+    try:
+        for rows, mode, texts in items:
+            for i in range(len(outlets)):
+                if closed[i].is_set():
+                    continue
+                picked_rows, picked_texts = target_rows(rows, texts, 1 << i)
+                if picked_rows and not offer(i, (picked_rows, mode, picked_texts)):
+                    close(i)
+    finally:
+        for event in closed:
+            event.set()
+        for thread in threads:
+            thread.join()
+    return [
+        (count, errors + int(late)) for (count, errors), late in zip(results, behind)
+    ]
+
+
+def insert(outlets, l_batches, v_batches):
+    """
+    Send batches of locations and movement vectors to the target of each outlet.
+
+    locations (l_batches) and movement vectors (v_batches) are iterables of
+    lists of rows.  The rows will be inserted on the tables on each target
+    and marked as tracked on the outlet's SQL Server database connection one
+    batch at a time (see fan_out() for the outlets).
+    The batches are usually generators reading from a SQL Server connection,
+    which must not be a database connection, and can only read one query at
+    a time, so the movements are read and sent before the locations.
+    Each batch is recorded in the outlet's journal (a BatchJournal) until it
+    is tracked, unless the journal is None.
+
+    The number of locations and movements written and the number of errors
+    encountered are added to the "summary" dictionary of each outlet.
+    """
+    for kind, batches in [(MOVEMENTS, v_batches), (LOCATIONS, l_batches)]:
+        state = ingest_state()
+        items = serialize_batches(prefetch(batches), kind, state)
+        results = fan_out(send_items, kind, items, outlets, state)
+        for outlet, (count, errors) in zip(outlets, results):
+            outlet["summary"][kind["name"]] = count
+            outlet["summary"]["errors"] += errors
+
+
+def upsert_sql(kind):
+    """Return the template of an insert of kind that updates rows with the same key."""
+
+    columns = kind["columns"]
+    changes = [
+        "{0} = excluded.{0}".format(column)
+        for column in columns
+        if column not in kind["key_columns"]
+    ]
+    sql = "insert into {0} ({1}) values {{0}} on conflict ({2}) do update set {3}"
+    return sql.format(
+        kind["table"],
+        ",".join(columns),
+        ",".join(kind["key_columns"]),
+        ",".join(changes),
+    )
+
+
+def send_updates(database, carto, kind, batches, journal=None, target=None):
+    """
+    Send batches of changed rows of kind (LOCATIONS or MOVEMENTS) to carto.
+
+    The rows (each ending with its new content hash) replace the rows with
+    the same key in carto (or are added if they are missing) with batched
+    INSERT ... ON CONFLICT DO UPDATE statements.  The new hashes are saved in
+    the tracking table (of target) on the SQL Server database connection
+    after carto has accepted each batch; if that fails the batch is sent
+    again by the next sync, which does no harm.  The days of the tracks
+    changed by a batch are saved in journal (a BatchJournal) first, unless
+    it is None.  Stop at the first error.
+    Return the number of rows updated and the number of errors.
+    """
+    items = update_items(batches, kind)
+    return send_update_items(database, carto, kind, items, journal, target)
+
+
+def update_items(batches, kind):
+    """Yield (rows, "insert", texts) for each list of rows of kind in batches."""
+
+    for rows in batches:
+        yield rows, "insert", serialize(rows, kind, "insert")
+
+
+def send_update_items(
+    database, carto, kind, items, journal=None, target=None, state=None
+):
+    """
+    Send the (rows, mode, texts) items of kind from update_items() to carto.
+
+    See send_updates().  state is not used.
+    Return the number of rows updated and the number of errors.
+    """
+    # pylint: disable=unused-argument
+    count = 0
+    sizer = RequestSizer()
+    sql = upsert_sql(kind)
+    try:
+        for rows, _, texts in prefetch(items):
+            keys = [kind["key"](row) for row in rows]
+            hashes = [kind["hash"](row) for row in rows]
+            if journal:
+                journal.add_days(track_days(kind, keys))
+            with METRICS.timer("carto_update", kind=kind["name"]) as counts:
+                counts["rows"] = len(rows)
+                sizer.send(carto, sql, texts)
+            with METRICS.timer("tracking_update", kind=kind["name"]) as counts:
+                counts["rows"] = len(rows)
+                kind["rehash"](database, keys, hashes, target)
+            count += len(rows)
+    except CartoException as ex:
+        print("Carto error ocurred", ex)
+        return count, 1
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        return count, 1
+    finally:
+        if count:
+            print(
+                "Updated {0} changed {1} in Carto{2}.".format(
+                    count, kind["name"], target_label(target)
+                )
+            )
+    return count, 0
+
+
+def update(outlets, l_batches, v_batches):
+    """
+    Send batches of changed locations and movement vectors to each outlet.
+
+    See insert() for the parameters, and send_updates() for how the rows are
+    sent.  The number of rows updated and the number of errors encountered
+    are added to the "summary" dictionary of each outlet.
+    """
+    for kind, batches in [(MOVEMENTS, v_batches), (LOCATIONS, l_batches)]:
+        items = update_items(prefetch(batches), kind)
+        results = fan_out(send_update_items, kind, items, outlets)
+        for outlet, (count, errors) in zip(outlets, results):
+            outlet["summary"]["updated"] += count
+            outlet["summary"]["errors"] += errors
+
+
+def recover_batches(database, carto, journal, target=None):
+    """
+    Finish the interrupted batches in journal (a BatchJournal).
+
+    A batch in the journal was saved before it was sent to carto, but was not
+    tracked on the SQL Server database connection; the run died or the
+    tracking failed.  If carto accepted the batch, all of its keys are tracked
+    (in the tracking tables of target, or the default target if None),
+    otherwise only the keys found in carto are tracked.  Untracked keys are
+    sent again by the next sync, so nothing is duplicated in carto.
+    Return the number of errors encountered.
+    """
+    kinds = dict((kind["name"], kind) for kind in (LOCATIONS, MOVEMENTS))
+    errors = 0
+    for batch_id, name, status, keys in journal.unfinished():
+        kind = kinds[name]
+        try:
+            if status != batch_journal.ACKNOWLEDGED:
+                keys = kind["find"](carto, keys)
+            # Some of the keys may have been tracked before the interruption
+            kind["untrack"](database, keys, target)
+            if not kind["track"](database, keys, None, target):
+                errors += 1
+                continue
+            if KEYS is not None and (target is None or target.is_default):
+                KEYS.add(name, keys)
+        except CartoException as ex:
+            print("Carto error ocurred", ex)
+            errors += 1
+            continue
+        except pyodbc.Error as ex:
+            print("Database error ocurred", ex)
+            errors += 1
+            continue
+        journal.finish(batch_id, track_days(kind, keys))
+        print(
+            "Recovered an interrupted batch; tracked {0} {1} found in Carto{2}.".format(
+                len(keys), name, target_label(target)
+            )
+        )
+    return errors
+
+
+def get_locations_to_remove(
+    connection, since=None, boundary_projects=None, target=None
+):
+    """
+    Return the locations in SQL Server connection that should be removed from carto.
+
+    Check the list of location in Carto with the current status of locations
+    (hidden or deleted) or the boundary shape may have changed.
+    If since is not None, only check the locations that have changed since that
+    change tracking version.  If boundary_projects is not None, only check the
+    boundary for locations in those projects.  The locations in Carto are
+    the locations tracked for target (the default target if None).
+    """
+    sql = """
+        select c.fixid from {source}
+        left join Locations as l on l.FixId = c.fixid
+        left join ProjectExportBoundaries as b on b.Project = l.ProjectId
+        where l.FixId is null -- not in location table any longer
+        or l.status is not null -- location is now hidden
+        or ({boundary} b.shape is not null and b.shape.STContains(l.Location) = 0)
+    """
+    source = changed_keys("Locations", LOCATION_KEY, since, target)
+    boundary = boundary_filter("l", boundary_projects)
+    return fetch_rows(connection, sql.format(source=source, boundary=boundary))
+
+
+def get_vectors_to_remove(connection, since=None, boundary_projects=None, target=None):
+    """
+    Return the movements in SQL Server connection that should be removed from carto.
+
+    Check the list of movements in Carto with the current status of movements
+    (deleted) or the boundary shape may have changed. Note: the attributes of a
+    movement are immutable, so we do not need to check them.
+    If since is not None, only check the movements that have changed since that
+    change tracking version.  If boundary_projects is not None, only check the
+    boundary for movements in those projects.  The movements in Carto are the
+    movements tracked for target (the default target if None).  The movements
+    of the projects in Config.derive_movements are not in the Movements
+    table, so they are not checked here (see derive_vectors_for_carto()).
+    """
+    sql = """
+        select c.Projectid, c.AnimalId, c.StartDate, c.EndDate
+        from {source} left join movements as m
+        on m.ProjectId = c.ProjectId and m.AnimalId = c.AnimalId
+        and m.StartDate = c.StartDate and m.EndDate = c.EndDate
+        left join ProjectExportBoundaries as b on b.Project = m.ProjectId
+        where {derived} (m.projectid is null -- not in movement database anylonger
+        or ({boundary} b.shape is not null and b.shape.STContains(m.shape) = 0))
+    """
+    source = changed_keys("Movements", MOVEMENT_KEY, since, target)
+    boundary = boundary_filter("m", boundary_projects)
+    derived = derived_filter("c")
+    sql = sql.format(source=source, boundary=boundary, derived=derived)
+    return fetch_rows(connection, sql)
+
+
+def get_rows_to_remove(connection, since=None, boundary_projects=None, target=None):
+    """
+    Return the locations and movements that should be removed from carto.
+
+    Rows changed since the change tracking version since (or all rows if since
+    is None) are checked for deletion, hiding, and boundary changes.  Rows in
+    the boundary_projects are checked against the boundary even if they have
+    not changed.  If boundary_projects is None, all rows are checked against the
+    boundary.  The rows are the rows tracked for target (a Target, or the
+    default target if None).  Either list of rows is None if there was a
+    database error.
+    """
+    if use_python_boundaries():
+        return get_rows_to_remove_with_index(
+            connection, since, boundary_projects, target
+        )
+    if since is None:
+        locations = get_locations_to_remove(connection, None, boundary_projects, target)
+        vectors = get_vectors_to_remove(connection, None, boundary_projects, target)
+        return locations, vectors
+    locations = get_locations_to_remove(connection, since, None, target)
+    vectors = get_vectors_to_remove(connection, since, None, target)
+    if boundary_projects is None or boundary_projects:
+        more_locations = get_locations_to_remove(
+            connection, None, boundary_projects, target
+        )
+        more_vectors = get_vectors_to_remove(
+            connection, None, boundary_projects, target
+        )
+        locations = union_rows(locations, more_locations)
+        vectors = union_rows(vectors, more_vectors)
+    return locations, vectors
+
+
+def get_rows_to_remove_with_index(
+    connection, since=None, boundary_projects=None, target=None
+):
+    """
+    Return the locations and movements that should be removed from carto.
+
+    The same as get_rows_to_remove(), except the boundary tests are done with
+    a BoundaryIndex for each project instead of in SQL Server.
+    """
+    try:
+        indexes = get_boundary_indexes(connection)
+    except pyodbc.Error:
+        return None, None
+    locations = get_locations_to_remove(connection, since, [], target)
+    vectors = get_vectors_to_remove(connection, since, [], target)
+    checks = [(since, boundary_projects)]
+    if since is not None:
+        checks = [(since, None)]
+        if boundary_projects is None or boundary_projects:
+            checks.append((None, boundary_projects))
+    for check_since, projects in checks:
+        if projects is not None and not projects:
+            continue
+        try:
+            outside = get_locations_outside(
+                connection, indexes, check_since, projects, target
+            )
+            locations = union_rows(locations, outside)
+            outside = get_vectors_outside(
+                connection, indexes, check_since, projects, target
+            )
+            vectors = union_rows(vectors, outside)
+        except pyodbc.Error:
+            return None, None
+    return locations, vectors
+
+
+def get_locations_outside(connection, indexes, since=None, projects=None, target=None):
+    """
+    Return the tracked locations that are outside their project boundary.
+
+    indexes is a dictionary of BoundaryIndex by project.  Only check the
+    locations changed since the change tracking version since (unless it is
+    None), and in projects (unless it is None).  The locations are tracked
+    for target (the default target if None).  Return a list of (fixid,).
+    """
+    sql = """
+        select c.fixid, l.ProjectId, l.Location.Lat, l.Location.Long
+        from {source} join Locations as l on l.FixId = c.fixid
+        where {projects} l.status is null
+    """
+    source = changed_keys("Locations", LOCATION_KEY, since, target)
+    sql = sql.format(source=source, projects=boundary_filter("l", projects))
+    outside = []
+    for rows in fetch_batches(connection, sql, Config.batch_size):
+        for project, index in indexes.items():
+            rows2 = [row for row in rows if row[1] == project]
+            if not rows2:
+                continue
+            lats = [row[2] for row in rows2]
+            inside = index.contains_points([row[3] for row in rows2], lats)
+            outside += [(row[0],) for row, keep in zip(rows2, inside) if not keep]
+    return outside
+
+
+def get_vectors_outside(connection, indexes, since=None, projects=None, target=None):
+    """
+    Return the tracked movements that are outside their project boundary.
+
+    indexes is a dictionary of BoundaryIndex by project.  Only check the
+    movements changed since the change tracking version since (unless it is
+    None), and in projects (unless it is None).  The movements are tracked
+    for target (the default target if None).  Return a list of movement keys.
+    """
+    sql = """
+        select c.ProjectId, c.AnimalId, c.StartDate, c.EndDate, m.Shape.ToString()
+        from {source} join Movements as m
+        on m.ProjectId = c.ProjectId and m.AnimalId = c.AnimalId
+        and m.StartDate = c.StartDate and m.EndDate = c.EndDate
+        where {projects} 1 = 1
+    """
+    source = changed_keys("Movements", MOVEMENT_KEY, since, target)
+    sql = sql.format(source=source, projects=boundary_filter("m", projects))
+    outside = []
+    for rows in fetch_batches(connection, sql, Config.batch_size):
+        for project, index in indexes.items():
+            rows2 = [row for row in rows if row[0] == project]
+            if not rows2:
+                continue
+            lines = [boundary_index.parse_wkt_rings(row[4])[0] for row in rows2]
+            inside = index.contains_lines(lines)
+            outside += [tuple(row[:4]) for row, keep in zip(rows2, inside) if not keep]
+    return outside
+
+
+def union_rows(rows1, rows2):
+    """Return the distinct rows in rows1 and rows2; None if either is None."""
+
+    if rows1 is None or rows2 is None:
+        return None
+    distinct = dict((tuple(row), row) for row in rows1)
+    distinct.update((tuple(row), row) for row in rows2)
+    return list(distinct.values())
+
+
+def remove(database, carto, l_rows, v_rows, journal=None, target=None):
+    """
+    Remove locations and movement vectors from carto.
+
+    locations (l_rows) and movement vectors (v_rows) will be marked as un-tracked
+    (for target, or the default target if None) on the source SQL Server
+    connection and removed from the tables on carto.
+    Each kind is only un-tracked after all of its rows are removed from carto.
+    The days of the tracks changed by removing movements are saved in journal
+    (a BatchJournal) first, unless it is None (see update_tracks()).
+
+    Return a summary dictionary with the number of locations and movements
+    removed and the number of errors encountered.
+    """
+    summary = {"locations": 0, "movements": 0, "errors": 0}
+    label = target_label(target)
+    use_keys = KEYS is not None and (target is None or target.is_default)
+    if not l_rows:
+        print("No locations to remove from Carto{0}.".format(label))
+    if not v_rows:
+        print("No movements to remove from Carto{0}.".format(label))
+    if not l_rows and not v_rows:
+        return summary
+    if v_rows:
+        try:
+            # Delete a batch of movements with a join on the composite key
+            sql = """
+                delete from animal_movements as m using (values {0})
+                as d (projectid, animalid, startdate, enddate)
+                where m.projectid = d.projectid and m.animalid = d.animalid
+                and m.startdate = d.startdate::timestamp
+                and m.enddate = d.enddate::timestamp
+            """
+            keys = ["('{0}','{1}','{2}','{3}')".format(*row[:4]) for row in v_rows]
+            if journal:
+                journal.add_days(track_days(MOVEMENTS, v_rows))
+            with METRICS.timer("carto_delete", kind="movements") as counts:
+                counts["rows"] = len(keys)
+                send_statements(carto, sql, keys)
+            try:
+                with METRICS.timer("tracking_delete", kind="movements") as counts:
+                    counts["rows"] = len(v_rows)
+                    remove_movements_from_carto_tracking_table(database, v_rows, target)
+                if use_keys:
+                    KEYS.remove("movements", [movement_key(row) for row in v_rows])
+                print("Removed {0} Movements from Carto{1}.".format(len(v_rows), label))
+                summary["movements"] = len(v_rows)
+            except pyodbc.Error as ex:
+                print(
+                    "SQLServer error occurred.  Movements removed from Carto, but not SQLServer",
+                    ex,
+                )
+                summary["errors"] += 1
+        except CartoException as ex:
+            print("Carto error occurred removing movements.", ex)
+            summary["errors"] += 1
+    if l_rows:
+        try:
+            sql = "delete from animal_locations where fixid in ({0})"
+            ids = [row[0] for row in l_rows]
+            with METRICS.timer("carto_delete", kind="locations") as counts:
+                counts["rows"] = len(ids)
+                send_statements(carto, sql, ["{0}".format(i) for i in ids])
+            try:
+                with METRICS.timer("tracking_delete", kind="locations") as counts:
+                    counts["rows"] = len(ids)
+                    remove_locations_from_carto_tracking_table(database, ids, target)
+                if use_keys:
+                    KEYS.remove("locations", [(i,) for i in ids])
+                print("Removed {0} locations from Carto{1}.".format(len(ids), label))
+                summary["locations"] = len(ids)
+            except pyodbc.Error as ex:
+                print(
+                    "SQLServer error occurred.  Locations removed from Carto, but not SQLServer",
+                    ex,
+                )
+                summary["errors"] += 1
+        except CartoException as ex:
+            print("Carto error occurred removing locations.", ex)
+            summary["errors"] += 1
+    return summary
+
+
+def update_tracks(carto, journal):
+    """
+    Rebuild the animal tracks in carto for the days saved in journal.
+
+    Each track is the movements of an animal that start on a day, merged into
+    one line in time order.  A day is forgotten once its track is rebuilt; a
+    day with no movements left has no track.
+    Return the number of errors.
+    """
+    # The statements in a request are run in one transaction.  The old
+    # tracks are deleted first, so the new ones do not violate the unique key.
+    sql = """
+        delete from animal_tracks as t using (values {0}) as d (projectid, animalid, day)
+        where t.projectid = d.projectid and t.animalid = d.animalid
+        and t.day = d.day::date;
+        insert into animal_tracks
+        (projectid, animalid, day, startdate, enddate, movements, distance, the_geom)
+        select m.projectid, m.animalid, d.day::date, min(m.startdate),
+        max(m.enddate), count(*), sum(m.distance),
+        ST_RemoveRepeatedPoints(ST_MakeLine(m.the_geom order by m.startdate))
+        from animal_movements as m join (values {0}) as d (projectid, animalid, day)
+        on m.projectid = d.projectid and m.animalid = d.animalid
+        and m.startdate >= d.day::date and m.startdate < d.day::date + 1
+        group by m.projectid, m.animalid, d.day
+    """
+    days = journal.changed_days()
+    if not days:
+        print("No animal tracks to update in Carto.")
+        return 0
+    count = 0
+    try:
+        for chunk in chunks(days, Config.tracks_per_request):
+            values = ",".join("('{0}','{1}','{2}')".format(*day) for day in chunk)
+            with METRICS.timer("tracks") as counts:
+                counts["rows"] = len(chunk)
+                carto.send(sql.format(values))
+            journal.clear_days(chunk)
+            count += len(chunk)
+    except CartoException as ex:
+        print("Carto error occurred updating the animal tracks.", ex)
+        print("Is the animal_tracks table missing? Run `python schema.py`.")
+        return 1
+    finally:
+        if count:
+            print("Updated {0} days of animal tracks in Carto.".format(count))
+    return 0
+
+
+def fix_format_of_vector_columns(carto):
+    """
+    Populate the derived/formatted text fields in the carto database.
+
+    The Duration, Speed, and Duration values are numeric which display
+    a lot of noise.  For reasons now forgotten, I created text fields
+    with the values rounded to 1 decimal place.
+
+    New movements are now inserted with the text fields (see
+    movement_text_columns), so this is only needed once, to backfill the
+    movements inserted before that change (`upload.py --backfill`).
+    """
+
+    sql = """
+        update animal_movements set
+        distance_t=coalesce(distance_t, round(cast(distance as numeric),1)::text),
+        duration_t=coalesce(duration_t, round(cast(duration as numeric),1)::text),
+        speed_t=coalesce(speed_t, round(cast(speed as numeric),1)::text)
+        where distance_t is null or duration_t is null or speed_t is null
+    """
+    with METRICS.timer("backfill"):
+        execute_sql_in_cartodb(carto, sql)
+
+
+def get_auth_carto_sql_connection(session=None, target=None):
+    """
+    Return a authorized SQL connection to the carto database, using the secrets.
+
+    The connection is to target (a Target), or the default target if None.
+    It uses the pooled, compressing, retrying HTTP session for the
+    current thread (see `carto_transport.py`), unless a session is given.
+    Each request is added to the "carto_request" stage of the run metrics.
+    """
+
+    target = target or Target()
+    return get_carto_sql_client(target.base_url, target.apikey(), session)
+
+
+def get_carto_sql_client(base_url, apikey, session=None):
+    """Return a SQL connection to the carto server at base_url (see above)."""
+
+    session = session or carto_transport.get_session()
+    if METRICS.observe_request not in session.observers:
+        session.observers.append(METRICS.observe_request)
+    auth_client = carto_transport.get_auth_client(base_url, apikey, session)
+    return SQLClient(auth_client)
+
+
+def make_carto_tables(target=None):
+    """
+    Create the movement and location tables in Carto, with their indexes.
+
+    The tables are for target (a Target, or a name in Config.more_targets),
+    or the default target if None.
+    """
+
+    if target is not None and not isinstance(target, Target):
+        target = Target(target)
+    carto_conn = get_auth_carto_sql_connection(target=target)
+    make_location_table_in_cartodb(carto_conn)
+    make_movement_table_in_cartodb(carto_conn)
+    make_track_table_in_cartodb(carto_conn)
+    schema.migrate_carto(carto_conn)
+
+
+def make_sqlserver_tables(target=None):
+    """
+    Create the tracking tables in SQL Server, with their keys.
+
+    The tables are for target (a Target, or a name in Config.more_targets),
+    or the default target if None.
+    """
+
+    if target is not None and not isinstance(target, Target):
+        target = Target(target)
+    am_conn = get_connection_or_die(Config.am_server, Config.am_database)
+    make_cartodb_tracking_tables(am_conn, target)
+    if target is None or target.is_default:
+        schema.migrate_sqlserver(am_conn)
+
+
+def close_connection(connection):
+    """Close the SQL Server connection, ignoring errors; it may be broken."""
+
+    try:
+        connection.close()
+    except pyodbc.Error:
+        pass
+
+
+def close_worker_connections(item):
+    """Close the (reader, writers) connections of a project worker."""
+
+    reader, writers = item
+    close_connection(reader)
+    for writer, carto_conn in writers:
+        close_connection(writer)
+        close_carto_clients(carto_conn)
+        carto_conn.auth_client.session.close()
+
+
+class ConnectionPool(object):
+    """
+    Idle connections for the project workers, so they can be reused.
+
+    Each item is a (reader, writers) tuple of a SQL Server connection to read
+    the new rows, and a (writer, carto) pair for each of targets (a list of
+    Target; the default target if None): a SQL Server connection for its
+    tracking tables and a Carto client with its own HTTP session (and the
+    clients it keeps for requests in flight, see get_carto_clients()).  An
+    item is only used by one worker at a time.
+    """
+
+    def __init__(self, targets=None):
+        self.targets = targets or [Target()]
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def get(self):
+        """Return an idle item, or a new one; None if unable to connect."""
+
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        connections = [
+            get_connection(Config.am_server, Config.am_database)
+            for _ in range(len(self.targets) + 1)
+        ]
+        if None in connections:
+            for connection in connections:
+                if connection is not None:
+                    connection.close()
+            return None
+        cartos = [
+            get_auth_carto_sql_connection(carto_transport.CartoSession(), target)
+            for target in self.targets
+        ]
+        return connections[0], list(zip(connections[1:], cartos))
+
+    def put(self, item):
+        """Return the item to the pool for reuse."""
+
+        with self.lock:
+            self.idle.append(item)
+
+    def close(self):
+        """Close all the idle items."""
+
+        with self.lock:
+            items, self.idle = self.idle, []
+        for item in items:
+            close_worker_connections(item)
+
+
+def sync_project(project, since=None, pool=None, targets=None):
+    """
+    Send the new (and if Config.update_changed_rows, the changed) locations
+    and movements for project to each of targets (a list of Target; the
+    default target if None).  If the movements of project are built from its
+    locations (see Config.derive_movements), the movements that no longer
+    exist are also removed.
+
+    Only check the rows changed since the change tracking version since, unless
+    it is None.
+
+    The rows are read and formatted once, and sent to the targets that need
+    them at the same time (see fan_out()).  A target with an error is not
+    sent the changed rows; the other targets are.
+
+    This is run in a worker thread, so it uses its own SQL Server connections
+    and Carto clients (from pool, which must be for the same targets, or new
+    ones if pool is None), and batch journals; none of them are shared with
+    another thread while in use.  New rows are streamed from one connection
+    while each batch is tracked (and committed) on a second connection for
+    each target.  If there is an error, the connections are closed instead
+    of being returned to the pool.
+    Return a list of the summary dictionary of the project for each target.
+    """
+    start = time.time()
+    targets = targets or [Target()]
+    summaries = [
+        {
+            "project": project,
+            "target": target.name,
+            "locations": 0,
+            "movements": 0,
+            "updated": 0,
+            "errors": 0,
+        }
+        for target in targets
+    ]
+    item = (pool or ConnectionPool(targets)).get()
+    if item is None:
+        print("Unable to connect to the database for project", project)
+        for summary in summaries:
+            summary["errors"] += 1
+            summary["seconds"] = time.time() - start
+        return summaries
+    reader, writers = item
+    outlets = [
+        {
+            "target": target,
+            "database": writer,
+            "carto": carto_conn,
+            "journal": None,
+            "summary": summary,
+        }
+        for target, (writer, carto_conn), summary in zip(targets, writers, summaries)
+    ]
+    try:
+        for outlet in outlets:
+            outlet["journal"] = outlet["target"].journal()
+        index = None
+        if use_python_boundaries():
+            index = get_boundary_indexes(reader, project).get(project)
+        derive = derive_movements(project)
+        changes, stale = [], [[] for _ in targets]
+        locations = get_locations_for_carto(reader, project, since, index, targets)
+        if derive:
+            vectors = derive_vectors_for_carto(
+                reader, project, since, index, changes, stale, targets
+            )
+        else:
+            vectors = get_vectors_for_carto(reader, project, since, index, targets)
+        insert(outlets, locations, vectors)
+        live = [i for i, summary in enumerate(summaries) if not summary["errors"]]
+        if Config.update_changed_rows and live:
+            live_targets = [targets[i] for i in live]
+            locations = get_changed_locations(
+                reader, project, since, index, live_targets
+            )
+            if derive:
+                changes = select_targets(changes, live, len(targets))
+                vectors = chunks(changes, Config.batch_size)
+            else:
+                vectors = get_changed_vectors(
+                    reader, project, since, index, live_targets
+                )
+            update([outlets[i] for i in live], locations, vectors)
+        for outlet, keys in zip(outlets, stale):
+            if keys and not outlet["summary"]["errors"]:
+                removed = remove(
+                    outlet["database"],
+                    outlet["carto"],
+                    [],
+                    keys,
+                    outlet["journal"],
+                    outlet["target"],
+                )
+                outlet["summary"]["errors"] += removed["errors"]
+    # pylint: disable=broad-except
+    # One failed project must not stop the other workers.
+    except Exception as ex:
+        print("Error ocurred syncing project", project, ex)
+        for summary in summaries:
+            summary["errors"] += 1
+    finally:
+        for outlet in outlets:
+            if outlet["journal"] is not None:
+                outlet["journal"].close()
+        if pool is None or any(summary["errors"] for summary in summaries):
+            close_worker_connections(item)
+        else:
+            pool.put(item)
+    seconds = time.time() - start
+    for summary in summaries:
+        summary["seconds"] = seconds
+        METRICS.add(
+            "sync",
+            seconds,
+            rows=summary["locations"] + summary["movements"] + summary["updated"],
+            errors=summary["errors"],
+            project=project,
+            target=summary["target"],
+        )
+    return summaries
+
+
+def select_targets(rows, positions, count):
+    """
+    Return the rows for the targets at positions (in a list of count targets).
+
+    With several targets, each row ends with the mask of the targets that
+    need it (see target_sql()); the masks are changed to be for just the
+    targets at positions (or removed if there is one), and the rows those
+    targets do not need are dropped.
+    """
+    if count == 1:
+        return rows
+    selected = []
+    for row in rows:
+        mask = 0
+        for bit, position in enumerate(positions):
+            if row[-1] & (1 << position):
+                mask |= 1 << bit
+        if mask:
+            selected.append(tuple(row[:-1]) + ((mask,) if len(positions) > 1 else ()))
+    return selected
+
+
+def sync_projects(
+    projects, max_workers, since=None, boundary_projects=None, pool=None, targets=None
+):
+    """
+    Sync each project in projects with a pool of at most max_workers threads.
+
+    Only check the rows changed since the change tracking version since, unless
+    it is None.  All rows are checked for the projects in boundary_projects
+    (whose boundary has changed), or for all projects if it is None.
+    The rows are sent to each of targets (see sync_project()).
+    The workers use (and return) the connections in pool, if it is not None.
+
+    Return a list of the project summaries for each target, in the same order
+    as projects.
+    """
+    work = queue.Queue()
+    for project in projects:
+        work.put(project)
+    summaries = {}
+
+    def worker():
+        """Sync projects from the work queue until it is empty."""
+        while True:
+            try:
+                project = work.get_nowait()
+            except queue.Empty:
+                return
+            if boundary_projects is None or project in boundary_projects:
+                summaries[project] = sync_project(project, None, pool, targets)
+            else:
+                summaries[project] = sync_project(project, since, pool, targets)
+
+    count = max(1, min(max_workers, len(projects)))
+    threads = [threading.Thread(target=worker) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [summary for project in projects for summary in summaries[project]]
+
+
+def print_summary(summaries):
+    """Print a one line summary for each project summary in summaries."""
+
+    template = (
+        "{0:<24} {locations:>10} {movements:>10} {updated:>8} {errors:>7}"
+        " {seconds:>8.1f}"
+    )
+    print(
+        "{0:<24} {1:>10} {2:>10} {3:>8} {4:>7} {5:>8}".format(
+            "Project", "Locations", "Movements", "Updated", "Errors", "Seconds"
+        )
+    )
+    for summary in summaries:
+        name = summary["project"]
+        if summary.get("target", DEFAULT_TARGET) != DEFAULT_TARGET:
+            name += " ({0})".format(summary["target"])
+        print(template.format(name, **summary))
+
+
+def write_metrics(**summary):
+    """
+    Save the run metrics with the summary items.
+
+    See Config.metrics_log and Config.metrics_textfile.
+    """
+    record = METRICS.record(**summary)
+    try:
+        if Config.metrics_log:
+            METRICS.write_json(record, Config.metrics_log)
+        if Config.metrics_textfile:
+            METRICS.write_prometheus(record, Config.metrics_textfile)
+    except (IOError, OSError) as ex:
+        print("Unable to save the run metrics", ex)
+
+
+def sync(am_conn, targets=None, pool=None, full=False, defer_indexes=False):
+    """
+    Update the Carto tables with changes in the Animal Movements tables.
+
+    am_conn is a connection to the SQL Server database, and targets is a list
+    of the Target to update (the default target if None).  The workers use
+    the connections in pool (which must be for the same targets), or new
+    connections if pool is None.
+
+    If change tracking is enabled on the source tables, only the rows that
+    changed since the last successful sync are checked, unless full is True.
+    A full reconcile checks every row, and is done automatically when there is
+    no valid record of the last sync.
+
+    The (expensive) check of every row against the project boundary is only
+    done for projects whose boundary has changed since the last successful
+    sync, unless full is True.
+
+    Each target has its own record of the last successful sync.  The rows
+    removed from a target are found with its own record; the new and changed
+    rows are read once for all the targets, since the oldest record (see
+    sync_project()).  The targets are updated at the same time, and a target
+    with errors does not hold back the others, or save its record.
+
+    If defer_indexes is True, the Carto indexes that the sync does not use are
+    dropped while new rows are sent, and built again after (see `schema.py`);
+    this is faster for a big load.
+
+    If Config.use_key_cache is True and the default target is the only
+    target, the key cache is opened first, and new rows are found with it;
+    it is saved last (see open_key_cache()).
+    Batches left in the journal by an interrupted run are finished first.
+    The animal tracks for the days changed by this (or an earlier) run are
+    rebuilt last, if Config.update_tracks is True.  The days are kept in the
+    journal until they are rebuilt, so an error rebuilding them does not stop
+    the record of this sync from being saved.
+    The time taken by each stage of the run is saved (see write_metrics()).
+    Return the number of errors.
+    """
+
+    METRICS.reset()
+    targets = targets or [Target()]
+    if use_key_cache():
+        if len(targets) == 1 and targets[0].is_default:
+            open_key_cache(am_conn)
+        else:
+            print("The key cache is only used to sync the default target alone.")
+    own_pool = pool is None
+    pool = pool or ConnectionPool(targets)
+    item = pool.get()
+    if item is None:
+        print("Unable to connect to the database.")
+        if own_pool:
+            pool.close()
+        return 1
+    writers = item[1]
+    journals = [target.journal() for target in targets]
+    versions = [get_change_versions(am_conn, target) for target in targets]
+    current = versions[0][1]
+    lasts = [None if full else version[0] for version in versions]
+    # Saved at the end, so the boundaries are the ones the sync checked
+    fingerprints = get_current_fingerprints(am_conn)
+    boundaries = [
+        None if full else get_changed_boundaries(am_conn, fingerprints, target)
+        for target in targets
+    ]
+    if current is None:
+        print("Change tracking is not enabled; doing a full reconcile.")
+    else:
+        for target, last in zip(targets, lasts):
+            if last is None:
+                print("Doing a full reconcile{0}.".format(target_label(target)))
+    since = None if None in lasts else min(lasts)
+    if since is None and Config.update_changed_rows and KEYS is not None:
+        if KEYS.is_open():
+            print("Hashing every published row to find changed rows (not cached).")
+    boundary_projects = None
+    if None not in boundaries:
+        boundary_projects = sorted(set().union(*boundaries))
+    if boundary_projects:
+        print("Checking the changed boundaries of", ", ".join(boundary_projects))
+    removed = [{"locations": 0, "movements": 0, "errors": 0} for _ in targets]
+
+    def prepare(i):
+        """Finish the interrupted batches of target i, and remove its old rows."""
+        target = targets[i]
+        database, carto_conn = writers[i]
+        with METRICS.timer("recover") as counts:
+            errors = recover_batches(database, carto_conn, journals[i], target)
+            counts["errors"] = errors
+        with METRICS.timer("remove_query") as counts:
+            locations, vectors = get_rows_to_remove(
+                database, lasts[i], boundaries[i], target
+            )
+            counts["rows"] = len(locations or []) + len(vectors or [])
+            counts["errors"] = int(locations is None) + int(vectors is None)
+        errors += int(locations is None) + int(vectors is None)
+        removed[i] = remove(
+            database, carto_conn, locations, vectors, journals[i], target
+        )
+        errors += removed[i]["errors"]
+        if defer_indexes:
+            with METRICS.timer("drop_indexes"):
+                schema.drop_deferred_indexes(carto_conn)
+        return errors
+
+    def finish(i):
+        """Build the deferred indexes of target i."""
+        if defer_indexes:
+            with METRICS.timer("create_indexes"):
+                schema.create_deferred_indexes(writers[i][1])
+        return 0
+
+    def refresh_tracks(i):
+        """Rebuild the changed animal tracks of target i."""
+        return update_tracks(writers[i][1], journals[i])
+
+    summaries = []
+    track_errors = [0] * len(targets)
+    try:
+        errors = for_each_target(targets, prepare)
+        if any(errors):
+            close_worker_connections(item)
+        else:
+            pool.put(item)
+        item = None
+        try:
+            summaries = sync_projects(
+                Config.projects,
+                Config.max_workers,
+                since,
+                boundary_projects,
+                pool,
+                targets,
+            )
+        finally:
+            if item is None:
+                item = pool.get()
+            if item is not None:
+                writers = item[1]
+                more = for_each_target(targets, finish)
+                errors = [count + extra for count, extra in zip(errors, more)]
+                if Config.update_tracks:
+                    track_errors = for_each_target(targets, refresh_tracks)
+                else:
+                    for journal in journals:
+                        journal.forget_days()
+            else:
+                errors = [count + 1 for count in errors]
+    finally:
+        for journal in journals:
+            journal.close()
+        save_key_cache()
+        if item is not None:
+            pool.put(item)
+        if own_pool:
+            pool.close()
+    names = [target.name for target in targets]
+    for summary in summaries:
+        errors[names.index(summary["target"])] += summary["errors"]
+    print_summary(summaries)
+    write_metrics(
+        errors=sum(errors) + sum(track_errors),
+        locations=sum(summary["locations"] for summary in summaries),
+        movements=sum(summary["movements"] for summary in summaries),
+        updated=sum(summary["updated"] for summary in summaries),
+        removed=sum(summary["locations"] + summary["movements"] for summary in removed),
+        projects=summaries,
+    )
+    for target, count in zip(targets, errors):
+        if count:
+            print(
+                "There were errors{0}; the next sync will recheck these changes.".format(
+                    target_label(target)
+                )
+            )
+        else:
+            if fingerprints is not None:
+                save_boundary_fingerprints(am_conn, fingerprints, target)
+            if current is not None:
+                save_change_version(am_conn, current, target)
+    for target, count in zip(targets, track_errors):
+        if count:
+            print(
+                "The animal tracks{0} will be rebuilt by the next sync.".format(
+                    target_label(target)
+                )
+            )
+    return sum(errors) + sum(track_errors)
+
+
+def for_each_target(targets, work):
+    """
+    Return the list of work(i) (a number of errors) for each target in targets.
+
+    With several targets, each runs in its own thread, so a slow target does
+    not hold back the others.  An error raised by work is printed, and
+    counted as one error.
+    """
+    results = [1] * len(targets)
+
+    def run(i):
+        """Save the result of work(i)."""
+        try:
+            results[i] = work(i)
+        # pylint: disable=broad-except
+        # One failed target must not stop the others.
+        except Exception as ex:
+            print("Error ocurred{0}".format(target_label(targets[i])), ex)
+
+    if len(targets) == 1:
+        run(0)
+        return results
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(targets))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def main(full=False, defer_indexes=False, targets=None):
+    """
+    Sync the changes once (see sync()); check every row if full is True.
+
+    targets is a list of the names of the targets to sync (the default
+    target and the ones in Config.more_targets); all of them if None.
+    If defer_indexes is True, the map's Carto indexes are built after the load.
+    """
+    targets = get_targets(targets)
+    am_conn = get_connection_or_die(Config.am_server, Config.am_database)
+    try:
+        check_row_hashes_or_die(am_conn, targets)
+        sync(am_conn, targets, full=full, defer_indexes=defer_indexes)
+    finally:
+        am_conn.close()
+
+
+def get_sync_token(connection):
+    """
+    Return a token that changes when there may be something new to sync.
+
+    The token is the change tracking version of the database on the SQL
+    Server connection (None if change tracking is not enabled), and a checksum
+    of the project boundaries.  The checksum is of the size, length, and area
+    of each boundary, not a hash of its shape (see boundary_fingerprint()),
+    so it works on any size of boundary.  This is one cheap query.
+    Raise pyodbc.Error if the database can not be read.
+    """
+    sql = """
+        select CHANGE_TRACKING_CURRENT_VERSION(),
+        (select checksum_agg(checksum(Project, Shape.STNumPoints(),
+           Shape.STLength(), Shape.STArea()))
+         from ProjectExportBoundaries)
+    """
+    r_cursor = connection.cursor()
+    try:
+        return tuple(r_cursor.execute(sql).fetchone())
+    finally:
+        r_cursor.close()
+
+
+def serve(poll_seconds=None, targets=None):
+    """
+    Sync changes as they happen, until stopped with Ctrl+C (or SIGTERM).
+
+    targets is a list of the names of the targets to sync; all if None.
+
+    The SQL Server and Carto connections are kept open between syncs.  Every
+    poll_seconds (Config.poll_seconds if None), a sync token is read (see
+    get_sync_token()); if it is the same as at the last successful sync, there
+    is nothing to do.  The token can only tell that nothing changed with
+    change tracking, so without it (every poll would be a full sync) the
+    service exits with an error status, as it does when the RowHash columns
+    are missing.  After an error, all connections are closed and reopened for
+    the next poll; a poll that finds change tracking off, or (after a
+    reconnect) the RowHash columns missing, is skipped.  A stop request waits
+    for the current sync to finish.
+    """
+    poll_seconds = poll_seconds or Config.poll_seconds
+    pool = ConnectionPool(get_targets(targets))
+    am_conn = get_connection_or_die(Config.am_server, Config.am_database)
+    try:
+        check_row_hashes_or_die(am_conn, pool.targets)
+        if get_sync_token(am_conn)[0] is None:
+            print("Service mode needs change tracking on the source tables.")
+            print("Run enable_change_tracking(), or sync with `upload.py`.")
+            sys.exit(1)
+    except pyodbc.Error as ex:
+        print("Database error ocurred", ex)
+        sys.exit(1)
+    finally:
+        close_connection(am_conn)
+    stop = threading.Event()
+
+    def request_stop(signum, _frame):
+        """Stop the service after the current sync."""
+        print("Received signal {0}; stopping.".format(signum))
+        stop.set()
+
+    for name in ("SIGINT", "SIGTERM", "SIGBREAK"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), request_stop)
+
+    am_conn = None
+    token = None
+    delay = Config.reconnect_seconds
+    print("Checking for changes every {0} seconds.".format(poll_seconds))
+    try:
+        while not stop.is_set():
+            if am_conn is None:
+                am_conn = get_connection(Config.am_server, Config.am_database)
+                if am_conn is None:
+                    print("Trying again in {0} seconds.".format(delay))
+                    stop.wait(delay)
+                    delay = min(delay * 2, Config.reconnect_max_seconds)
+                    continue
+                delay = Config.reconnect_seconds
+            try:
+                latest = get_sync_token(am_conn)
+                errors = 0
+                if latest[0] is None:
+                    print("Change tracking is off; skipping this poll.")
+                    errors = 1
+                elif token is None and report_missing_row_hashes(am_conn, pool.targets):
+                    print("Skipping this poll.")
+                    errors = 1
+                elif latest != token:
+                    errors = sync(am_conn, pool.targets, pool)
+            except pyodbc.Error as ex:
+                print("Database error ocurred", ex)
+                errors = 1
+            if errors:
+                # Start over with new connections, and sync at the next poll
+                token = None
+                pool.close()
+                close_connection(am_conn)
+                am_conn = None
+            else:
+                token = latest
+            stop.wait(poll_seconds)
+    finally:
+        pool.close()
+        if am_conn is not None:
+            close_connection(am_conn)
+
+
+if __name__ == "__main__":
+    # make_carto_tables()
+    # make_sqlserver_tables()
+    # enable_change_tracking(get_connection_or_die(Config.am_server, Config.am_database))
+    parser = argparse.ArgumentParser(
+        description="Publish Animal Movement data to Carto."
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="check every row, not just the rows changed since the last sync",
+    )
+    parser.add_argument(
+        "--defer-indexes",
+        action="store_true",
+        help="build the map's Carto indexes after the sync (for a big load)",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="keep running, and sync changes as they happen (see Config.poll_seconds)",
+    )
+    parser.add_argument(
+        "--target",
+        action="append",
+        help="sync just this target (see Config.more_targets); may be repeated",
+    )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="fill in the movement text columns (once, for old movements) and exit",
+    )
+    args = parser.parse_args()
+    if args.backfill:
+        fix_format_of_vector_columns(get_auth_carto_sql_connection())
+    elif args.serve:
+        serve(targets=args.target)
+    else:
+        main(full=args.full, defer_indexes=args.defer_indexes, targets=args.target)